@@ -0,0 +1,233 @@
+# analytics.py
+# Sales rollups for the staff reports.
+#
+# Reports never read orders or order_items. Two rollup tables are kept up to
+# date in the same transaction as the order writes in crud.py:
+#
+#   sales_hourly      orders and revenue per UTC hour and status
+#   item_sales_daily  units and revenue per UTC day, menu item and status
+#
+# Every order contributes +1 under its current status; a status change takes
+# it out under the old status and adds it back under the new one. Report
+# cost depends on the date range asked for, not on how many orders exist.
+# Money is kept in centavos so repeated +/- never drifts.
+#
+# History is backfilled by order id in chunks of BACKFILL_CHUNK orders, each
+# its own short write transaction aggregated inside SQLite, so nothing is
+# loaded into memory and checkouts can commit between chunks. While a
+# backfill is running, analytics_state says which ids are already counted
+# (id <= backfilled or id > backfill_end); writes to orders the backfill
+# hasn't reached leave the rollups alone and the backfill picks up their
+# final state when it gets there.
+#
+# Orders moved to the archive (archive.py) stay counted: archiving never
+# touches the rollups, and only orders already counted are archived. A
+# rebuild counts the archive first, then the live orders.
+#
+#   python analytics.py             # finish any pending backfill
+#   python analytics.py rebuild     # recount everything from the orders
+BACKFILL_CHUNK = 5000
+EXCLUDED_STATUSES = ("cancelled",)  # not counted as sales in reports
+
+# true for orders (aliased o) that are already in the rollups
+COUNTED = (
+    "(o.id <= (SELECT backfilled FROM analytics_state)"
+    " OR o.id > (SELECT backfill_end FROM analytics_state))"
+)
+
+_ADD_SALES = (
+    "INSERT INTO sales_hourly (hour, status, orders, revenue_cents)"
+    " SELECT strftime('%Y-%m-%d %H:00:00', o.created_at), COALESCE(o.status, ''),"
+    " ? * COUNT(*), ? * SUM(CAST(ROUND(o.total * 100) AS INTEGER))"
+    " FROM {schema}.orders o WHERE {where} AND o.created_at IS NOT NULL GROUP BY 1, 2"
+    " ON CONFLICT (hour, status) DO UPDATE SET"
+    " orders = orders + excluded.orders, revenue_cents = revenue_cents + excluded.revenue_cents"
+)
+
+_ADD_ITEMS = (
+    "INSERT INTO item_sales_daily (day, status, item_id, name, units, revenue_cents)"
+    " SELECT date(o.created_at), COALESCE(o.status, ''), COALESCE(oi.menu_item_id, 0), oi.name,"
+    " ? * SUM(oi.qty), ? * SUM(CAST(ROUND(oi.qty * oi.unit_price * 100) AS INTEGER))"
+    " FROM {schema}.orders o JOIN {schema}.order_items oi ON oi.order_id = o.id"
+    " WHERE {where} AND o.created_at IS NOT NULL GROUP BY 1, 2, 3, 4"
+    " ON CONFLICT (day, status, item_id, name) DO UPDATE SET"
+    " units = units + excluded.units, revenue_cents = revenue_cents + excluded.revenue_cents"
+)
+
+_ORDER_SALES = _ADD_SALES.format(schema="main", where=f"o.id = ? AND {COUNTED}")
+_ORDER_ITEMS = _ADD_ITEMS.format(schema="main", where=f"o.id = ? AND {COUNTED}")
+_RANGE_SALES = {schema: _ADD_SALES.format(schema=schema, where="o.id > ? AND o.id <= ?") for schema in ("main", "archive")}
+_RANGE_ITEMS = {schema: _ADD_ITEMS.format(schema=schema, where="o.id > ? AND o.id <= ?") for schema in ("main", "archive")}
+
+
+def create_tables(conn):
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS sales_hourly ("
+        " hour TEXT NOT NULL,"
+        " status TEXT NOT NULL,"
+        " orders INTEGER NOT NULL,"
+        " revenue_cents INTEGER NOT NULL,"
+        " PRIMARY KEY (hour, status)) WITHOUT ROWID"
+    )
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS item_sales_daily ("
+        " day TEXT NOT NULL,"
+        " status TEXT NOT NULL,"
+        " item_id INTEGER NOT NULL,"  # 0 for lines that aren't on the menu
+        " name TEXT NOT NULL,"
+        " units INTEGER NOT NULL,"
+        " revenue_cents INTEGER NOT NULL,"
+        " PRIMARY KEY (day, status, item_id, name)) WITHOUT ROWID"
+    )
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS analytics_state ("
+        " backfilled INTEGER NOT NULL,"
+        " backfill_end INTEGER NOT NULL)"
+    )
+    conn.execute(
+        "INSERT INTO analytics_state (backfilled, backfill_end)"
+        " SELECT 0, COALESCE(MAX(id), 0) FROM orders WHERE NOT EXISTS (SELECT 1 FROM analytics_state)"
+    )
+    conn.commit()
+
+
+# INCREMENTAL UPDATES
+# Called by crud.py with the order's write transaction open.
+def add_order(cursor, order_id, sign=1):
+    cursor.execute(_ORDER_SALES, (sign, sign, order_id))
+    cursor.execute(_ORDER_ITEMS, (sign, sign, order_id))
+
+def remove_order(cursor, order_id):
+    add_order(cursor, order_id, -1)
+
+def add_orders(cursor, after_id, through_id, schema="main"):
+    # Count orders after_id < id <= through_id, for bulk loads that insert
+    # into orders directly rather than through crud
+    cursor.execute(_RANGE_SALES[schema], (1, 1, after_id, through_id))
+    cursor.execute(_RANGE_ITEMS[schema], (1, 1, after_id, through_id))
+
+
+# BACKFILL
+def backfill(conn, chunk=BACKFILL_CHUNK):
+    # Returns the number of orders counted
+    counted = 0
+    while True:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            done, end = conn.execute("SELECT backfilled, backfill_end FROM analytics_state").fetchone()
+            upto = conn.execute(
+                "SELECT MAX(id), COUNT(*) FROM (SELECT id FROM orders WHERE id > ? AND id <= ? ORDER BY id LIMIT ?)",
+                (done, end, chunk)
+            ).fetchone()
+            if upto[0] is None:
+                conn.execute("UPDATE analytics_state SET backfilled = backfill_end")
+                conn.commit()
+                return counted
+            add_orders(conn, done, upto[0])
+            conn.execute("UPDATE analytics_state SET backfilled = ?", (upto[0],))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        counted += upto[1]
+
+def _count_archive(conn, chunk):
+    # While a rebuild is pending nothing is archived (archive.py only moves
+    # counted orders), so the archive can be walked a chunk at a time
+    done = counted = 0
+    while True:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            upto = conn.execute(
+                "SELECT MAX(id), COUNT(*) FROM (SELECT id FROM archive.orders WHERE id > ? ORDER BY id LIMIT ?)",
+                (done, chunk)
+            ).fetchone()
+            if upto[0] is None:
+                conn.rollback()
+                return counted
+            add_orders(conn, done, upto[0], "archive")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        done = upto[0]
+        counted += upto[1]
+
+def rebuild(conn, chunk=BACKFILL_CHUNK):
+    # Drop the rollups and count every order again from scratch. If it is
+    # interrupted, run it again rather than a plain backfill.
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute("DELETE FROM sales_hourly")
+        conn.execute("DELETE FROM item_sales_daily")
+        conn.execute("UPDATE analytics_state SET backfilled = 0, backfill_end = (SELECT COALESCE(MAX(id), 0) FROM orders)")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return _count_archive(conn, chunk) + backfill(conn, chunk)
+
+
+# REPORTS
+# start and end are UTC dates ("YYYY-MM-DD"), both inclusive.
+def _excluded():
+    return ", ".join("?" * len(EXCLUDED_STATUSES))
+
+def sales(conn, start, end, by="day"):
+    # [{"period", "orders", "revenue", "average_ticket"}], by "hour" or "day"
+    period = "hour" if by == "hour" else "substr(hour, 1, 10)"
+    rows = conn.execute(
+        f"SELECT {period} AS period, SUM(orders), SUM(revenue_cents) FROM sales_hourly"
+        " WHERE hour >= date(?) AND hour < date(?, '+1 day')"
+        f" AND status NOT IN ({_excluded()}) GROUP BY 1 HAVING SUM(orders) > 0 ORDER BY 1",
+        (start, end, *EXCLUDED_STATUSES)
+    ).fetchall()
+    return [_sales_row(row[0], row[1], row[2]) for row in rows]
+
+def summary(conn, start, end):
+    row = conn.execute(
+        "SELECT SUM(orders), SUM(revenue_cents) FROM sales_hourly"
+        " WHERE hour >= date(?) AND hour < date(?, '+1 day')"
+        f" AND status NOT IN ({_excluded()})",
+        (start, end, *EXCLUDED_STATUSES)
+    ).fetchone()
+    return _sales_row(None, row[0] or 0, row[1] or 0)
+
+def top_items(conn, start, end, limit=10):
+    # [{"id", "name", "units", "revenue"}], best sellers by units
+    rows = conn.execute(
+        "SELECT item_id, name, SUM(units), SUM(revenue_cents) FROM item_sales_daily"
+        " WHERE day >= ? AND day <= ?"
+        f" AND status NOT IN ({_excluded()}) GROUP BY item_id, name HAVING SUM(units) > 0"
+        " ORDER BY 3 DESC, 4 DESC LIMIT ?",
+        (start, end, *EXCLUDED_STATUSES, limit)
+    ).fetchall()
+    return [
+        {"id": row[0] or None, "name": row[1], "units": row[2], "revenue": row[3] / 100}
+        for row in rows
+    ]
+
+def _sales_row(period, orders, cents):
+    return {
+        "period": period,
+        "orders": orders,
+        "revenue": cents / 100,
+        "average_ticket": cents / 100 / orders if orders else 0.0,
+    }
+
+
+def main():
+    import sys
+
+    import crud
+
+    crud.migrate()
+    conn = crud.get_connection()
+    if sys.argv[1:] == ["rebuild"]:
+        print(f"Counted {rebuild(conn)} orders")
+    else:
+        print(f"Backfilled {backfill(conn)} orders")
+
+
+if __name__ == "__main__":
+    main()
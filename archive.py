@@ -0,0 +1,167 @@
+# archive.py
+# Moves old, finished orders out of the live tables.
+#
+# Orders older than the retention period that are no longer pending move,
+# with their order_items, to the same tables in the archive database
+# (crud.archive_path(), attached to every connection as "archive"). The
+# live tables then only hold recent orders, which is what checkout and the
+# kitchen screens touch; order lookups and history read both (see
+# crud._all_orders). Sales reports come from the rollups, which archiving
+# leaves alone.
+#
+# Work goes a chunk of ARCHIVE_CHUNK orders at a time: candidates are found
+# with a plain read, then each chunk is copied and deleted in short
+# IMMEDIATE transactions, with a pause between chunks so checkouts get the
+# write lock in between. Only orders the analytics rollups already count
+# are moved. WAL makes each database's commit atomic but not a commit that
+# spans both, so no transaction writes to both: the copy into the archive
+# commits first, and a second transaction deletes from main only the orders
+# whose copy is there. A crash in between leaves the chunk in both, where
+# reads take the archived copy (crud._all_orders); copies overwrite, and
+# the next run finishes moving it.
+#
+# The QR codes rendered for archived orders are deleted as they go, and
+# anything older than qr.QR_MAX_AGE with them.
+#
+#   python archive.py                  # orders finished more than 90 days ago
+#   python archive.py --days 30 --dry-run
+import argparse
+import os
+import time
+from datetime import datetime, timedelta, timezone
+
+import analytics
+import crud
+import qr
+
+RETENTION_DAYS = 90
+ARCHIVE_CHUNK = 500
+ARCHIVE_PAUSE = 0.01  # seconds between chunks
+ACTIVE_STATUSES = ("pending",)  # never archived, however old
+
+# +created_at keeps SQLite walking the primary key in id order: picking a
+# chunk through the created_at index would sort every candidate each time
+_CANDIDATES = (
+    "FROM main.orders o WHERE +o.created_at < ?"
+    f" AND COALESCE(o.status, '') NOT IN ({', '.join('?' * len(ACTIVE_STATUSES))})"
+    f" AND {analytics.COUNTED}"
+)
+_IN_CHUNK = "IN (SELECT id FROM temp.archive_chunk)"
+
+
+def cutoff(days=RETENTION_DAYS):
+    # created_at is stored as UTC "YYYY-MM-DD HH:MM:SS"
+    return (datetime.now(timezone.utc) - timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%S")
+
+def count_candidates(conn, before):
+    return conn.execute(f"SELECT COUNT(*) {_CANDIDATES}", (before, *ACTIVE_STATUSES)).fetchone()[0]
+
+def _move(conn, first, last, before):
+    # One chunk in two transactions; returns the number of orders moved. The
+    # conditions are checked again under the write lock in case an order
+    # changed since it was picked.
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS archive_chunk (id INTEGER PRIMARY KEY)")
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute("DELETE FROM temp.archive_chunk")
+        conn.execute(
+            f"INSERT INTO temp.archive_chunk (id) SELECT o.id {_CANDIDATES} AND o.id BETWEEN ? AND ?",
+            (before, *ACTIVE_STATUSES, first, last)
+        )
+        # first the copy, committed on its own: only archive is written
+        conn.execute(
+            "INSERT OR REPLACE INTO archive.orders (id, user_id, items, total, status, created_at)"
+            f" SELECT id, user_id, items, total, status, created_at FROM main.orders WHERE id {_IN_CHUNK}"
+        )
+        conn.execute(f"DELETE FROM archive.order_items WHERE order_id {_IN_CHUNK}")
+        conn.execute(
+            "INSERT INTO archive.order_items (order_id, menu_item_id, name, qty, unit_price)"
+            f" SELECT order_id, menu_item_id, name, qty, unit_price FROM main.order_items"
+            f" WHERE order_id {_IN_CHUNK} ORDER BY rowid"
+        )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        # then the delete, only main is written: an order leaves main only
+        # once its copy is in the archive, and only if it hasn't changed
+        # since (one that has is copied again by the next run)
+        conn.execute(
+            "DELETE FROM temp.archive_chunk WHERE id NOT IN (SELECT o.id FROM main.orders o"
+            " JOIN archive.orders a ON a.id = o.id AND a.status IS o.status AND a.total = o.total"
+            f" WHERE o.id {_IN_CHUNK})"
+        )
+        conn.execute(f"DELETE FROM main.order_items WHERE order_id {_IN_CHUNK}")
+        moved = conn.execute(f"DELETE FROM main.orders WHERE id {_IN_CHUNK}").rowcount
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return moved
+
+def _prune_qr(conn, first, last, existing):
+    # Delete the QR images of the archived orders with ids first..last;
+    # `existing` is the set of file names in the QR folder
+    orders = conn.execute(
+        "SELECT id, total FROM archive.orders WHERE id BETWEEN ? AND ?", (first, last)
+    ).fetchall()
+    items = crud.get_items_for_orders([order["id"] for order in orders])
+    removed = 0
+    for order in orders:
+        name = f"{qr.qr_key(qr.order_payload(order['id'], items[order['id']], order['total']))}.png"
+        if name in existing:
+            try:
+                os.remove(os.path.join(qr.QR_FOLDER, name))
+                removed += 1
+            except FileNotFoundError:
+                pass
+            existing.discard(name)
+    return removed
+
+def archive_orders(conn, before, chunk=ARCHIVE_CHUNK, pause=ARCHIVE_PAUSE):
+    # Returns (orders archived, QR images removed)
+    try:
+        existing = {entry.name for entry in os.scandir(qr.QR_FOLDER) if entry.name.endswith(".png")}
+    except FileNotFoundError:
+        existing = set()
+    archived = removed = 0
+    after = 0
+    while True:
+        first, last = conn.execute(
+            f"SELECT MIN(id), MAX(id) FROM (SELECT o.id {_CANDIDATES} AND o.id > ? ORDER BY o.id LIMIT ?)",
+            (before, *ACTIVE_STATUSES, after, chunk)
+        ).fetchone()
+        if first is None:
+            break
+        archived += _move(conn, first, last, before)
+        if existing:
+            removed += _prune_qr(conn, first, last, existing)
+        after = last
+        time.sleep(pause)
+    return archived, removed + qr.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Move old, finished orders to the archive database")
+    parser.add_argument("--days", type=float, default=RETENTION_DAYS, help="keep orders this recent live")
+    parser.add_argument("--chunk", type=int, default=ARCHIVE_CHUNK, help="orders per transaction")
+    parser.add_argument("--pause", type=float, default=ARCHIVE_PAUSE, help="seconds between chunks")
+    parser.add_argument("--dry-run", action="store_true", help="only count the orders that would move")
+    args = parser.parse_args()
+
+    crud.migrate()
+    conn = crud.get_connection()
+    before = cutoff(args.days)
+    if args.dry_run:
+        print(f"Would archive {count_candidates(conn, before)} orders from before {before} UTC")
+        return
+    start = time.perf_counter()
+    archived, removed = archive_orders(conn, before, args.chunk, args.pause)
+    print(f"Archived {archived} orders from before {before} UTC to {crud.archive_path()} "
+          f"in {time.perf_counter() - start:.1f}s; removed {removed} QR images")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+# asgi.py
+# Serves the app over ASGI, for kitchen screens that keep connections open.
+#
+# The threaded WSGI server spends one thread per open connection, and an
+# /orders/stream screen holds its thread for as long as it is connected. Here
+# connections belong to an asyncio event loop and cost no thread while idle:
+#
+#   - Each request runs the unchanged Flask app on a bounded thread pool of
+#     REQUEST_THREADS. Views call crud.py synchronously, so this pool is also
+#     where all SQLite access happens, and it caps the connections in use.
+#   - /orders/stream hands its stream back to the event loop once the
+#     headers are ready (events.EventBus.astream), so screens wait on futures.
+#   - QR codes and PDF receipts render on a pool of RENDER_PROCESSES
+#     processes, keeping that CPU work off the GIL the request threads share.
+#
+# Any ASGI server will do; uvicorn is used when started from here.
+#
+#   python asgi.py --port 8000
+#   uvicorn --factory asgi:create_asgi_app --port 8000
+import argparse
+import asyncio
+import io
+import multiprocessing
+import sys
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import qr
+from restaurant import create_app
+
+REQUEST_THREADS = 16
+RENDER_PROCESSES = 2
+STREAM_KEY = "restaurant.async_stream"  # see restaurant.orders_stream
+
+
+def _load_renderers():
+    # Run once in each render process so the first receipt doesn't wait
+    # for reportlab and qrcode to import
+    import qrcode  # noqa: F401
+    import receipt  # noqa: F401
+
+
+class ASGIAdapter:
+    def __init__(self, app, threads=REQUEST_THREADS, processes=RENDER_PROCESSES):
+        self.app = app
+        self.threads = threads
+        self.processes = processes
+        self.executor = None
+        self.render_pool = None
+
+    def start(self):
+        self.executor = ThreadPoolExecutor(self.threads, thread_name_prefix="request")
+        if self.processes:
+            # spawned, not forked: this process already runs the order writer
+            # and pool threads, which a fork would copy mid-flight
+            self.render_pool = ProcessPoolExecutor(self.processes, mp_context=multiprocessing.get_context("spawn"))
+            for _ in range(self.processes):
+                self.render_pool.submit(_load_renderers)
+            qr.use_executor(self.render_pool)
+            self.app.extensions["render_pool"] = self.render_pool
+
+    def stop(self):
+        self.app.extensions.pop("render_pool", None)
+        if self.render_pool is not None:
+            self.render_pool.shutdown(cancel_futures=True)
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http":
+            if self.executor is None:
+                self.start()  # a server that doesn't send lifespan events
+            await self._http(scope, receive, send)
+        else:
+            raise ValueError(f"unsupported ASGI scope type {scope['type']!r}")
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                self.start()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self.stop()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _http(self, scope, receive, send):
+        body = bytearray()
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                break
+        environ = _environ(scope, bytes(body))
+        loop = asyncio.get_running_loop()
+        status, headers, chunks = await loop.run_in_executor(self.executor, self._call_app, environ)
+        stream = environ.get(STREAM_KEY)
+        if stream is not None:
+            headers = [(name, value) for name, value in headers if name.lower() != b"content-length"]
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        if stream is None:
+            await send({"type": "http.response.body", "body": b"".join(chunks)})
+        else:
+            await self._stream(stream, receive, send)
+
+    def _call_app(self, environ):
+        # On a request thread: run the WSGI app and collect the whole response
+        response = []
+
+        def start_response(status, headers, exc_info=None):
+            response[:] = [int(status.split(" ", 1)[0]),
+                           [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers]]
+
+        result = self.app(environ, start_response)
+        try:
+            chunks = list(result)
+        finally:
+            if hasattr(result, "close"):
+                result.close()
+        return response[0], response[1], chunks
+
+    async def _stream(self, stream, receive, send):
+        # Relay an async generator of text until it ends or the client leaves
+        disconnected = asyncio.ensure_future(_disconnect(receive))
+        try:
+            while True:
+                chunk = asyncio.ensure_future(stream.__anext__())
+                await asyncio.wait((chunk, disconnected), return_when=asyncio.FIRST_COMPLETED)
+                if not chunk.done():
+                    chunk.cancel()
+                    await asyncio.wait((chunk,))  # let the generator unwind before closing it
+                    return
+                try:
+                    text = chunk.result()
+                except StopAsyncIteration:
+                    break
+                await send({"type": "http.response.body", "body": text.encode("utf-8"), "more_body": True})
+            await send({"type": "http.response.body", "body": b""})
+        except OSError:
+            pass  # the client went away mid-send
+        finally:
+            disconnected.cancel()
+            await stream.aclose()
+
+
+async def _disconnect(receive):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+def _environ(scope, body):
+    # The WSGI environ for an ASGI HTTP scope (PEP 3333 strings are latin-1)
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": client[0],
+        "REMOTE_PORT": str(client[1]),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+        STREAM_KEY: None,
+    }
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            environ[name] = value
+            continue
+        key = f"HTTP_{name}"
+        if key in environ:
+            value = f"{environ[key]}{'; ' if name == 'COOKIE' else ','}{value}"
+        environ[key] = value
+    return environ
+
+
+def create_asgi_app(config=None, threads=REQUEST_THREADS, processes=RENDER_PROCESSES):
+    return ASGIAdapter(create_app(config), threads, processes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the restaurant app over ASGI with uvicorn")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--threads", type=int, default=REQUEST_THREADS, help="request (and SQLite) threads")
+    parser.add_argument("--processes", type=int, default=RENDER_PROCESSES, help="QR and PDF render processes")
+    args = parser.parse_args()
+    try:
+        import uvicorn
+    except ImportError:
+        sys.exit("uvicorn is not installed; pip install uvicorn, or run create_asgi_app() under another ASGI server")
+    uvicorn.run(create_asgi_app(threads=args.threads, processes=args.processes),
+                host=args.host, port=args.port, lifespan="on", log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1406 @@
+# benchmark.py
+# Benchmarks that run against a throwaway copy of the database.
+#
+#   python benchmark.py load --clients 16 --seconds 10 --path /
+#   python benchmark.py receipt --items 40 --runs 50
+#   python benchmark.py order-numbers --processes 4 --threads 8 --count 200
+#   python benchmark.py order-writes --threads 1,8,32 --count 50
+#   python benchmark.py stock --processes 4 --threads 8 --stock 500
+#   python benchmark.py checkout-keys --processes 4 --threads 8 --taps 4
+#   python benchmark.py kdf --runs 20
+#   python benchmark.py suggest --items 300 --budget 5000
+#   python benchmark.py menu-search --menu-items 5000
+#   python benchmark.py menu-import --items 2000
+#   python benchmark.py page --path / --menu-items 200
+#   python benchmark.py reports --orders 10000,100000,1000000
+#   python benchmark.py archive --orders 2000000 --days 730
+#   python benchmark.py startup --workers 8
+#   python benchmark.py serve-modes --screens 0,200,1000 --customers 16
+#   python benchmark.py rush --concurrency 1,8,32 --seconds 10 --json rush.json
+#   python benchmark.py compare before.json after.json
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta, timezone
+
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+import crud
+
+
+def copy_database(workdir):
+    path = os.path.join(workdir, "database.db")
+    shutil.copyfile(crud.DATABASE, path)
+    crud.DATABASE = path
+    return path
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+def start_server(app):
+    server = make_server("127.0.0.1", 0, app, threaded=True, request_handler=QuietRequestHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+def run_load(base_url, path, clients, seconds):
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.perf_counter() + seconds
+
+    def worker():
+        local = []
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                with urllib.request.urlopen(base_url + path) as resp:
+                    resp.read()
+            except Exception:
+                with lock:
+                    errors[0] += 1
+                continue
+            local.append(time.perf_counter() - start)
+        with lock:
+            latencies.extend(local)
+
+    threads = [threading.Thread(target=worker) for _ in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return latencies, errors[0]
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+def bench_load(args):
+    from restaurant import create_app
+    app = create_app()
+    server = start_server(app)
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    latencies, errors = run_load(base_url, args.path, args.clients, args.seconds)
+    server.shutdown()
+
+    print(f"path={args.path} clients={args.clients} seconds={args.seconds}")
+    print(f"requests={len(latencies)} errors={errors} req/s={len(latencies) / args.seconds:.1f}")
+    if latencies:
+        print(f"mean={statistics.mean(latencies) * 1000:.2f}ms "
+              f"p50={percentile(latencies, 50) * 1000:.2f}ms "
+              f"p95={percentile(latencies, 95) * 1000:.2f}ms "
+              f"p99={percentile(latencies, 99) * 1000:.2f}ms")
+
+def bench_page(args):
+    # CPU per request for one page, rendered in full and revalidated
+    # with If-None-Match, for a logged-in customer with a few cart lines
+    seed_database(args.menu_items, 1, 0, 1)
+    from restaurant import create_app
+    app = create_app()
+    client = app.test_client()
+    client.post("/login", data={"username": "rush1", "password": SEED_PASSWORD})
+    for item_id in (1, 2, 3):
+        client.post("/update_cart", data={"item_id": str(item_id), "change": "1"})
+    client.post("/budget_mode", data={"budget_value": "400"})
+    client.get(args.path)  # shows and clears the flashed messages
+    etag = client.get(args.path).headers.get("ETag")
+
+    variants = [("full", {})]
+    if etag:
+        variants.append(("304", {"If-None-Match": etag}))
+    for label, headers in variants:
+        for _ in range(50):
+            client.get(args.path, headers=headers)
+        start = time.process_time()
+        for _ in range(args.runs):
+            resp = client.get(args.path, headers=headers)
+        cpu = (time.process_time() - start) / args.runs
+        print(f"page {args.path} {label} menu_items=+{args.menu_items}: cpu={cpu * 1e6:.0f}us/request "
+              f"status={resp.status_code} bytes={len(resp.data)}")
+
+def bench_receipt(args):
+    # Check out one order of --items lines, then time GET /download_receipt
+    from restaurant import create_app
+    app = create_app()
+    client = app.test_client()
+    client.post("/register", data={"username": "bench", "password": "bench", "confirm_password": "bench"})
+    client.post("/login", data={"username": "bench", "password": "bench"})
+    for i in range(args.items):
+        client.post("/update_cart", data={"item_id": str(i % 9 + 1), "change": "1"})
+    client.post("/confirm_checkout")
+    client.get("/download_receipt")  # warm-up
+
+    latencies = []
+    tracemalloc.start()
+    for _ in range(args.runs):
+        start = time.perf_counter()
+        resp = client.get("/download_receipt")
+        latencies.append(time.perf_counter() - start)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    print(f"receipt items={args.items} runs={args.runs} status={resp.status_code} bytes={len(resp.data)}")
+    print(f"mean={statistics.mean(latencies) * 1000:.2f}ms "
+          f"p95={percentile(latencies, 95) * 1000:.2f}ms peak_alloc={peak / 1024:.0f}KiB")
+
+def _run_threads(worker, threads):
+    # Run worker(n) for n in range(threads), each on its own thread with its
+    # own connection; returns their results in order, or raises the first
+    # error a worker hit once all of them are done
+    results = [None] * threads
+    errors = []
+
+    def run(n):
+        try:
+            results[n] = worker(n)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            crud.close_db()
+
+    pool = [threading.Thread(target=run, args=(n,)) for n in range(threads)]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    if errors:
+        raise errors[0]  # from a pool process, back to the parent
+    return results
+
+def _allocate_numbers(database, threads, count, insert):
+    crud.DATABASE = database
+
+    def worker(n):
+        if insert:
+            return [crud.create_order(None, "[]", 0) for _ in range(count)]
+        return [crud.get_next_order_number() for _ in range(count)]
+
+    return [number for batch in _run_threads(worker, threads) for number in batch]
+
+def bench_order_numbers(args):
+    # Hammer the order sequence from several processes x threads and check
+    # that every number handed out (and every committed order id) is unique
+    crud.migrate()
+    start = time.perf_counter()
+    with multiprocessing.Pool(args.processes) as pool:
+        batches = pool.starmap(
+            _allocate_numbers,
+            [(crud.DATABASE, args.threads, args.count, args.insert)] * args.processes
+        )
+    elapsed = time.perf_counter() - start
+    numbers = [n for batch in batches for n in batch]
+    duplicates = len(numbers) - len(set(numbers))
+    print(f"order-numbers processes={args.processes} threads={args.threads} "
+          f"insert={args.insert} allocated={len(numbers)} duplicates={duplicates} "
+          f"per_sec={len(numbers) / elapsed:.0f}")
+    if duplicates or len(numbers) != args.processes * args.threads * args.count:
+        raise SystemExit(1)
+
+def _write_orders(create, threads, count):
+    items = [{"id": 1, "name": "Longsilog", "qty": 2, "price": 100.0, "subtotal": 200.0}]
+
+    def worker(n):
+        latencies = []
+        ids = []
+        busy = 0
+        for _ in range(count):
+            start = time.perf_counter()
+            try:
+                ids.append(create(None, items, 200.0))
+            except crud.OrderQueueFull:
+                busy += 1
+                continue
+            latencies.append(time.perf_counter() - start)
+        return latencies, ids, busy
+
+    start = time.perf_counter()
+    results = _run_threads(worker, threads)
+    elapsed = time.perf_counter() - start
+    return ([latency for latencies, _, _ in results for latency in latencies],
+            [order_id for _, ids, _ in results for order_id in ids],
+            sum(busy for _, _, busy in results), elapsed)
+
+def bench_order_writes(args):
+    # Checkout bursts: per-call commits on the request thread vs the group
+    # committing order writer, every commit synchronous = FULL (the writer
+    # always is) so each returned order is on disk
+    crud.migrate()
+    crud.PRAGMAS = crud.PRAGMAS + ("PRAGMA synchronous = FULL",)
+    crud.close_pool()
+    crud.order_writer = crud.OrderWriter(queue_size=args.queue_size)
+    modes = [("per-call", crud.create_order_direct), ("group", crud.create_order)]
+    for threads in args.threads:
+        for label, create in modes:
+            before = crud.get_connection().execute("SELECT COUNT(*) FROM orders").fetchone()[0]
+            latencies, ids, busy, elapsed = _write_orders(create, threads, args.count)
+            stored = crud.get_connection().execute("SELECT COUNT(*) FROM orders").fetchone()[0] - before
+            duplicates = len(ids) - len(set(ids))
+            print(f"order-writes {label:<8} threads={threads:<3} orders={len(ids)} stored={stored} "
+                  f"duplicates={duplicates} queue_full={busy} orders/s={len(ids) / elapsed:.0f} "
+                  f"p50={percentile(latencies, 50) * 1000:.1f}ms p99={percentile(latencies, 99) * 1000:.1f}ms")
+            if duplicates or stored != len(ids):
+                raise SystemExit(1)
+
+def _buy_stock(database, threads, count, item_ids, seed):
+    # Checkouts of 1-3 servings of a random item; returns ({item_id: units
+    # sold}, orders rejected as out of stock)
+    crud.DATABASE = database
+    menu = crud.get_menu()
+
+    def worker(n):
+        rng = random.Random(seed * 1000 + n)
+        sold = Counter()
+        rejected = 0
+        for _ in range(count):
+            item = menu.by_id[rng.choice(item_ids)]
+            qty = rng.randint(1, 3)
+            try:
+                crud.create_order(None, [{"id": item["id"], "name": item["name"], "qty": qty, "price": item["price"]}],
+                                  item["price"] * qty)
+            except crud.OutOfStock:
+                rejected += 1
+                continue
+            sold[item["id"]] += qty
+        return sold, rejected
+
+    results = _run_threads(worker, threads)
+    return dict(sum((sold for sold, _ in results), Counter())), sum(rejected for _, rejected in results)
+
+def bench_stock(args):
+    # Several processes x threads checking out the same few items, with the
+    # items uncounted and then counted: checkout throughput both ways, and
+    # proof that counted items never sell more than their stock
+    crud.migrate()
+    item_ids = [item["id"] for item in crud.get_menu().items[:args.items]]
+    conn = crud.get_connection()
+    for counted in (False, True):
+        for item_id in item_ids:
+            crud.set_stock(item_id, args.stock if counted else None)
+        first_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM orders").fetchone()[0]
+        crud.close_pool()
+        start = time.perf_counter()
+        with multiprocessing.Pool(args.processes) as pool:
+            results = pool.starmap(
+                _buy_stock,
+                [(crud.DATABASE, args.threads, args.count, item_ids, seed) for seed in range(args.processes)]
+            )
+        elapsed = time.perf_counter() - start
+        sold = Counter()
+        for batch, _ in results:
+            sold.update(batch)
+        rejected = sum(r for _, r in results)
+        attempts = args.processes * args.threads * args.count
+
+        conn = crud.get_connection()
+        stored = Counter(dict(conn.execute(
+            "SELECT menu_item_id, SUM(qty) FROM order_items WHERE order_id > ? GROUP BY 1", (first_id,)
+        ).fetchall()))
+        left = crud.get_stock()
+        oversold = sum(max(sold[item_id] - args.stock, 0) for item_id in item_ids) if counted else 0
+        mismatched = stored != sold or (counted and any(left[i] != args.stock - sold[i] for i in item_ids))
+        print(f"stock counted={counted!s:<5} processes={args.processes} threads={args.threads} "
+              f"checkouts={attempts} sold={sum(sold.values())} rejected={rejected} "
+              f"left={sum(left.get(i, 0) for i in item_ids) if counted else '-'} oversold={oversold} "
+              f"checkouts/s={attempts / elapsed:.0f}")
+        if oversold or mismatched or min(left.values(), default=0) < 0:
+            raise SystemExit(1)
+
+def _submit_keys(database, threads, keys, seed):
+    # Every thread submits an order for every key, in its own random order;
+    # returns [(key, order id)] with the id of the order each submit got,
+    # placed or replayed
+    crud.DATABASE = database
+    item = crud.get_menu().items[0]
+    line = [{"id": item["id"], "name": item["name"], "qty": 1, "price": item["price"]}]
+    start = threading.Barrier(threads)
+
+    def worker(n):
+        order = list(keys)
+        random.Random(seed * 1000 + n).shuffle(order)
+        results = []
+        start.wait()
+        for key in order:
+            try:
+                results.append((key, crud.create_order(None, line, item["price"], checkout_key=key)))
+            except crud.DuplicateCheckout as e:
+                results.append((key, e.order_id))
+        return results
+
+    return [result for batch in _run_threads(worker, threads) for result in batch]
+
+def _fetch(browser, method, path, data=None):
+    body = urllib.parse.urlencode(data).encode() if data is not None else None
+    req = urllib.request.Request(browser.base_url + path, data=body, method=method)
+    try:
+        with browser.opener.open(req) as resp:
+            return resp.status, resp.read().decode()
+    except urllib.error.HTTPError as e:
+        return e.code, e.read().decode()
+
+def bench_checkout_keys(args):
+    # Parallel submits of the same checkout: first straight through crud from
+    # several processes, then as double taps on /confirm_checkout. Each key
+    # must come out as exactly one order, with every submit answered with it.
+    import passwords
+
+    usernames = seed_database(0, args.customers, 0, 1)
+    first_id = crud.get_connection().execute("SELECT COALESCE(MAX(id), 0) FROM orders").fetchone()[0]
+    keys = [f"bench-{n}" for n in range(args.keys)]
+    crud.close_pool()
+    start = time.perf_counter()
+    with multiprocessing.Pool(args.processes) as pool:
+        results = pool.starmap(
+            _submit_keys, [(crud.DATABASE, args.threads, keys, seed) for seed in range(args.processes)]
+        )
+    elapsed = time.perf_counter() - start
+    answers = defaultdict(set)
+    for batch in results:
+        for key, order_id in batch:
+            answers[key].add(order_id)
+    conn = crud.get_connection()
+    placed = conn.execute("SELECT COUNT(*) FROM orders WHERE id > ?", (first_id,)).fetchone()[0]
+    split = sum(len(ids) > 1 for ids in answers.values())
+    submits = args.processes * args.threads * len(keys)
+    print(f"checkout-keys crud processes={args.processes} threads={args.threads} keys={len(keys)} "
+          f"submits={submits} orders={placed} split_keys={split} submits/s={submits / elapsed:.0f}")
+    if placed != len(keys) or split or len(answers) != len(keys):
+        raise SystemExit(1)
+
+    passwords.username_limiter = passwords.TokenBucket(rate=1e6, burst=1e6)
+    passwords.ip_limiter = passwords.TokenBucket(rate=1e6, burst=1e6)
+    from restaurant import create_app
+    server = start_server(create_app())
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    item_id = crud.get_menu().items[0]["id"]
+    conn = crud.get_connection()
+    first_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM orders").fetchone()[0]
+    try:
+        customers = []
+        for username in usernames:
+            browser = HTTPSession(base_url)
+            browser.request("POST", "/login", {"username": username, "password": SEED_PASSWORD})
+            browser.request("POST", "/update_cart", {"item_id": item_id, "change": 1})
+            _, page = _fetch(browser, "POST", "/checkout_confirm")
+            key = page.split('name="checkout_key" value="', 1)[1].split('"', 1)[0]
+            customers.append((browser, key))
+
+        taps = []
+        lock = threading.Lock()
+        barrier = threading.Barrier(len(customers) * args.taps)
+
+        def tap(browser, key):
+            barrier.wait()
+            tapped = time.perf_counter()
+            status, page = _fetch(browser, "POST", "/confirm_checkout", {"checkout_key": key})
+            qr_image = page.split('alt="QR Code Receipt"', 1)[0].rsplit('src="', 1)[-1] if status == 200 else None
+            with lock:
+                taps.append((key, status, qr_image, time.perf_counter() - tapped))
+
+        pool = [threading.Thread(target=tap, args=customer) for customer in customers for _ in range(args.taps)]
+        for t in pool:
+            t.start()
+        for t in pool:
+            t.join()
+    finally:
+        server.shutdown()
+
+    pages = defaultdict(set)
+    for key, status, qr_image, _ in taps:
+        pages[key].add(qr_image)
+    failed = sum(status != 200 for _, status, _, _ in taps)
+    placed = conn.execute("SELECT COUNT(*) FROM orders WHERE id > ?", (first_id,)).fetchone()[0]
+    split = sum(len(images) > 1 for images in pages.values())
+    latencies = [elapsed for *_, elapsed in taps]
+    print(f"checkout-keys http customers={len(customers)} taps={args.taps} submits={len(taps)} orders={placed} "
+          f"failed={failed} split_keys={split} p50={percentile(latencies, 50) * 1000:.1f}ms "
+          f"p99={percentile(latencies, 99) * 1000:.1f}ms")
+    if placed != len(customers) or failed or split:
+        raise SystemExit(1)
+
+def bench_kdf(args):
+    # Cost of each KDF setting, then login throughput through the bounded pool
+    import passwords
+
+    settings = [("scrypt", n, None) for n in (2 ** 13, 2 ** 14, 2 ** 15)]
+    settings += [("pbkdf2_sha256", None, i) for i in (200000, 600000)]
+    for algorithm, n, iterations in settings:
+        passwords.ALGORITHM = algorithm
+        passwords.SCRYPT_N = n or passwords.SCRYPT_N
+        passwords.PBKDF2_ITERATIONS = iterations or passwords.PBKDF2_ITERATIONS
+        stored = passwords.hash_password("correct horse")
+        latencies = []
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            passwords.verify_password(stored, "correct horse")
+            latencies.append(time.perf_counter() - start)
+        label = f"n={n}" if n else f"iterations={iterations}"
+        print(f"kdf {algorithm} {label}: mean={statistics.mean(latencies) * 1000:.1f}ms")
+
+    passwords.ALGORITHM, passwords.SCRYPT_N = "scrypt", 2 ** 14
+    stored = passwords.hash_password("correct horse")
+    done = [0]
+    busy = [0]
+    lock = threading.Lock()
+
+    def login():
+        for _ in range(args.runs):
+            try:
+                passwords.verify_password_async(stored, "correct horse")
+                with lock:
+                    done[0] += 1
+            except passwords.Busy:
+                with lock:
+                    busy[0] += 1
+
+    start = time.perf_counter()
+    pool = [threading.Thread(target=login) for _ in range(args.clients)]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    elapsed = time.perf_counter() - start
+    print(f"kdf pool workers={passwords.KDF_WORKERS} clients={args.clients}: "
+          f"verified={done[0]} rejected_busy={busy[0]} per_sec={done[0] / elapsed:.1f}")
+
+def bench_suggest(args):
+    # Budget combos over a synthetic menu: cold (new menu version, so the DP
+    # runs) and warm (memoized) lookups, plus the popularity and drink variants
+    import suggest
+
+    rng = random.Random(1)
+    rows = [{"id": i, "name": f"Item {i}", "price": float(rng.randrange(40, 400, 5)), "image": ""}
+            for i in range(1, args.items + 1)]
+    popularity = {i: rng.randrange(100) for i in range(1, args.items + 1)}
+    drinks = [range(1, args.items + 1, 10)]
+    variants = [
+        ("value", {}),
+        ("popularity", {"rank": "popularity", "popularity": popularity}),
+        ("with drink", {"require": drinks}),
+    ]
+    for label, options in variants:
+        cold = []
+        warm = []
+        for run in range(args.runs):
+            menu = crud.MenuSnapshot(("bench", label, run), rows)
+            start = time.perf_counter()
+            combos = suggest.suggest_combos(menu, args.budget, **options)
+            cold.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            suggest.suggest_combos(menu, args.budget, **options)
+            warm.append(time.perf_counter() - start)
+        best = combos[0]["total"] if combos else 0
+        print(f"suggest {label} items={args.items} budget={args.budget}: "
+              f"cold mean={statistics.mean(cold) * 1000:.2f}ms p95={percentile(cold, 95) * 1000:.2f}ms "
+              f"warm mean={statistics.mean(warm) * 1e6:.0f}us best_total={best:.2f}")
+
+# LUNCH RUSH
+SEED_PASSWORD = "rush-password"
+
+
+def seed_database(menu_items, users, orders, days, seed=1):
+    # Grow the working copy to a realistic size: extra menu items, customer
+    # accounts sharing one password hash, and `orders` orders spread over
+    # the last `days` days. Returns the seeded usernames.
+    import analytics
+    import passwords
+
+    rng = random.Random(seed)
+    crud.migrate()
+    conn = crud.get_connection()
+    images = sorted(f"images/{name}" for name in os.listdir("static/images") if name.endswith(".jpg"))
+    conn.executemany(
+        "INSERT INTO menu_items (name, price, image) VALUES (?, ?, ?)",
+        [(f"Rush Special {i}", float(rng.randrange(60, 300, 5)), rng.choice(images)) for i in range(1, menu_items + 1)]
+    )
+    crud.rebuild_menu_search(conn)
+    stored = passwords.hash_password(SEED_PASSWORD)
+    usernames = [f"rush{i}" for i in range(1, users + 1)]
+    conn.executemany(
+        "INSERT OR IGNORE INTO users (username, password) VALUES (?, ?)",
+        [(username, stored) for username in usernames]
+    )
+    conn.commit()
+    crud.invalidate_menu()
+
+    menu = crud.get_menu().items
+    user_ids = [row[0] for row in conn.execute("SELECT id FROM users")]
+    now = datetime.now(timezone.utc)
+    next_id = conn.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM orders").fetchone()[0]
+    order_rows = []
+    item_rows = []
+    for order_id in range(next_id, next_id + orders):
+        lines = rng.sample(menu, min(len(menu), rng.randint(1, 5)))
+        qtys = [rng.randint(1, 3) for _ in lines]
+        total = sum(line["price"] * qty for line, qty in zip(lines, qtys))
+        created = now - timedelta(seconds=rng.randrange(days * 86400))
+        status = "pending" if created > now - timedelta(hours=1) else "done"
+        order_rows.append((order_id, rng.choice(user_ids), total, status, created.strftime("%Y-%m-%d %H:%M:%S")))
+        item_rows.extend((order_id, line["id"], line["name"], qty, line["price"]) for line, qty in zip(lines, qtys))
+    conn.executemany(
+        "INSERT INTO orders (id, user_id, items, total, status, created_at) VALUES (?, ?, '', ?, ?, ?)", order_rows
+    )
+    conn.executemany(
+        "INSERT INTO order_items (order_id, menu_item_id, name, qty, unit_price) VALUES (?, ?, ?, ?, ?)", item_rows
+    )
+    analytics.add_orders(conn, next_id - 1, next_id + orders - 1)
+    conn.commit()
+    crud.close_pool()
+    return usernames
+
+
+def sql_snapshot():
+    # (statements, new connections) per route so far, from the metrics module
+    import metrics
+
+    statements = Counter({route: values[-1] for route, values in metrics.sql_statements.collect().items()})
+    connections = Counter({route: values[0] for route, values in metrics.sql_connections.collect().items()})
+    return statements, connections
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class HTTPSession:
+    # One browser: its own cookie jar, redirects left to the caller
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(), _NoRedirect)
+
+    def request(self, method, path, data=None):
+        body = urllib.parse.urlencode(data).encode() if data is not None else None
+        req = urllib.request.Request(self.base_url + path, data=body, method=method)
+        try:
+            with self.opener.open(req) as resp:
+                resp.read()
+                return resp.status
+        except urllib.error.HTTPError as e:
+            e.read()
+            return e.code
+
+
+class TestClientSession:
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, data=None):
+        resp = self.client.open(path, method=method, data=data)
+        resp.get_data()
+        resp.close()
+        return resp.status_code
+
+
+def customer_flow(browser, username, menu_ids, rng, record, deadline):
+    # Log in once, then order lunch until the deadline:
+    # menu -> cart -> budget mode -> checkout -> receipt
+    def call(route, method, path, data=None):
+        start = time.perf_counter()
+        try:
+            status = browser.request(method, path, data)
+        except Exception:
+            status = 0
+        record(route, time.perf_counter() - start, status)
+        return status
+
+    call("index", "GET", "/")
+    while call("login", "POST", "/login", {"username": username, "password": SEED_PASSWORD}) != 302:
+        if time.perf_counter() >= deadline:
+            return
+        time.sleep(0.05)  # 429/503 from the limiter or a saturated KDF pool
+    while time.perf_counter() < deadline:
+        call("index", "GET", "/")
+        for item_id in rng.sample(menu_ids, min(3, len(menu_ids))):
+            call("update_cart", "POST", "/update_cart", {"item_id": item_id, "change": rng.randint(1, 2)})
+        call("budget_mode", "POST", "/budget_mode", {"budget_value": 5000})
+        call("checkout_confirm", "POST", "/checkout_confirm")
+        call("confirm_checkout", "POST", "/confirm_checkout")
+        call("download_receipt", "GET", "/download_receipt")
+
+def run_rush(make_browser, usernames, clients, seconds):
+    latencies = defaultdict(list)
+    errors = Counter()
+    lock = threading.Lock()
+    menu_ids = [item["id"] for item in crud.get_menu().items]
+    crud.close_db()
+    deadline = time.perf_counter() + seconds
+
+    def worker(n):
+        local = defaultdict(list)
+        local_errors = Counter()
+
+        def record(route, elapsed, status):
+            local[route].append(elapsed)
+            if not 200 <= status < 400:
+                local_errors[route] += 1
+
+        customer_flow(make_browser(), usernames[n % len(usernames)], menu_ids, random.Random(n), record, deadline)
+        crud.close_db()
+        with lock:
+            for route, values in local.items():
+                latencies[route].extend(values)
+            errors.update(local_errors)
+
+    statements_before, connections_before = sql_snapshot()
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    statements, connections = sql_snapshot()
+    statements.subtract(statements_before)
+    connections.subtract(connections_before)
+
+    routes = {}
+    for route, values in sorted(latencies.items()):
+        queries = statements[route]
+        routes[route] = {
+            "requests": len(values),
+            "errors": errors[route],
+            "rps": len(values) / elapsed,
+            "mean_ms": statistics.mean(values) * 1000,
+            "p50_ms": percentile(values, 50) * 1000,
+            "p95_ms": percentile(values, 95) * 1000,
+            "p99_ms": percentile(values, 99) * 1000,
+            "queries": queries,
+            "queries_per_request": queries / len(values),
+            "connections": connections[route],
+        }
+    everything = [v for values in latencies.values() for v in values]
+    return {
+        "concurrency": clients,
+        "seconds": elapsed,
+        "requests": len(everything),
+        "errors": sum(errors.values()),
+        "rps": len(everything) / elapsed,
+        "p50_ms": percentile(everything, 50) * 1000,
+        "p95_ms": percentile(everything, 95) * 1000,
+        "p99_ms": percentile(everything, 99) * 1000,
+        "connections": sum(connections.values()),
+        "routes": routes,
+    }
+
+def _git_version():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+MENU_WORDS = (
+    "adobo sinigang tapa longganisa tocino bangus hotdog lechon kare-kare sisig bistek pancit bihon"
+    " canton lumpia lugaw arroz caldo tinola nilaga bulalo inasal liempo chicken pork beef fish"
+    " shrimp squid garlic rice egg spicy sweet sour crispy fried grilled special combo meal family"
+    " platter halo-halo mango shake iced tea buko"
+).split()
+
+# Runs in a fresh interpreter so nothing is already imported. Prints one JSON
+# line per process: boot time, first request time, RSS and private memory
+# (USS). With "preload" the app is created once and the workers are forked
+# from it; with "spawn" every worker starts from scratch.
+STARTUP_PROBE = r"""
+import json, os, sys, time
+started = time.perf_counter()
+mode, workers, database = sys.argv[1], int(sys.argv[2]), sys.argv[3]
+
+def memory():
+    fields = {}
+    with open("/proc/self/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == "kB":
+                fields[parts[0].rstrip(":")] = int(parts[1]) / 1024
+    return fields["Rss"], fields["Private_Clean"] + fields["Private_Dirty"]
+
+def boot():
+    import restaurant
+    return restaurant.create_app({"DATABASE": database})
+
+def serve(app, role, boot_ms):
+    client = app.test_client()
+    start = time.perf_counter()
+    client.get("/")
+    first_ms = (time.perf_counter() - start) * 1000
+    rss, uss = memory()
+    heavy = sorted(m for m in ("qrcode", "reportlab") if m in sys.modules)
+    print(json.dumps({"role": role, "boot_ms": boot_ms, "first_ms": first_ms, "rss": rss, "uss": uss, "heavy": heavy}), flush=True)
+
+if mode == "preload":
+    app = boot()
+    boot_ms = (time.perf_counter() - started) * 1000
+    rss, uss = memory()
+    print(json.dumps({"role": "master", "boot_ms": boot_ms, "rss": rss, "uss": uss}), flush=True)
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            serve(app, "worker", 0.0)
+            os._exit(0)
+        os.waitpid(pid, 0)  # one at a time, so the numbers don't interleave
+else:
+    app = boot()
+    serve(app, "worker", (time.perf_counter() - started) * 1000)
+"""
+
+def bench_startup(args):
+    # Start-up cost and memory per worker, preloaded vs started separately
+    # migrate the scratch copy and build the image variants first, so the
+    # timings are for a routine restart
+    crud.migrate()
+    crud.get_menu()
+    crud.close_pool()
+    env = dict(os.environ, PYTHONPATH=os.getcwd())
+    for mode in ("spawn", "preload"):
+        results = []
+        runs = args.workers if mode == "spawn" else 1
+        for _ in range(runs):
+            out = subprocess.run(
+                [sys.executable, "-c", STARTUP_PROBE, mode, str(args.workers), crud.DATABASE],
+                capture_output=True, text=True, env=env, check=True,
+            ).stdout
+            results.extend(json.loads(line) for line in out.splitlines() if line.startswith("{"))
+        workers = [r for r in results if r["role"] == "worker"]
+        master = [r for r in results if r["role"] == "master"]
+        total_uss = sum(r["uss"] for r in workers) + sum(r["uss"] for r in master)
+        print(f"startup {mode:<7} workers={len(workers)} "
+              f"boot={statistics.median(r['boot_ms'] for r in master or workers):.0f}ms "
+              f"first_request={statistics.median(r['first_ms'] for r in workers):.1f}ms "
+              f"worker_rss={statistics.median(r['rss'] for r in workers):.1f}MiB "
+              f"worker_uss={statistics.median(r['uss'] for r in workers):.1f}MiB "
+              f"total_uss={total_uss:.1f}MiB lazy_imports_loaded={workers[0]['heavy']}")
+
+# Runs one server in its own interpreter, so its threads and memory can be
+# read from /proc: "wsgi" is the threaded Werkzeug server, "asgi" is asgi.py
+# under uvicorn.
+SERVE_PROBE = r"""
+import sys
+mode, database, port, threads = sys.argv[1], sys.argv[2], int(sys.argv[3]), int(sys.argv[4])
+if __name__ == "__main__":
+    import passwords
+    # every simulated customer logs in from 127.0.0.1
+    passwords.username_limiter = passwords.TokenBucket(rate=1e6, burst=1e6)
+    passwords.ip_limiter = passwords.TokenBucket(rate=1e6, burst=1e6)
+    if mode == "wsgi":
+        from werkzeug.serving import WSGIRequestHandler, make_server
+        from restaurant import create_app
+
+        class Quiet(WSGIRequestHandler):
+            def log_request(self, *args, **kwargs):
+                pass
+
+        make_server("127.0.0.1", port, create_app({"DATABASE": database}), threaded=True,
+                    request_handler=Quiet).serve_forever()
+    else:
+        import uvicorn
+        from asgi import create_asgi_app
+        uvicorn.run(create_asgi_app({"DATABASE": database}, threads=threads), host="127.0.0.1", port=port,
+                    lifespan="on", log_level="error", timeout_keep_alive=1)
+"""
+
+async def _request(port, method, path, cookie, data=None, timeout=10.0):
+    # (status, headers, body) over a fresh connection
+    import asyncio
+
+    body = urllib.parse.urlencode(data).encode() if data is not None else b""
+    head = f"{method} {path} HTTP/1.1\r\nHost: 127.0.0.1\r\nConnection: close\r\n"
+    if cookie:
+        head += f"Cookie: {cookie}\r\n"
+    if data is not None:
+        head += f"Content-Type: application/x-www-form-urlencoded\r\nContent-Length: {len(body)}\r\n"
+    reader, writer = await asyncio.wait_for(asyncio.open_connection("127.0.0.1", port), timeout)
+    try:
+        writer.write(head.encode() + b"\r\n" + body)
+        response = await asyncio.wait_for(reader.read(), timeout)
+    finally:
+        writer.close()
+    head, _, payload = response.partition(b"\r\n\r\n")
+    lines = head.decode("latin-1").split("\r\n")
+    return int(lines[0].split()[1]), lines[1:], payload
+
+def _session_cookie(headers, cookie):
+    for line in headers:
+        if line.lower().startswith("set-cookie:") and "session=" in line:
+            return line.split(":", 1)[1].strip().split(";", 1)[0]
+    return cookie
+
+async def _kitchen_screen(port, cookie, opened, received):
+    # One /orders/stream connection, held until cancelled
+    import asyncio
+
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    try:
+        writer.write(f"GET /orders/stream HTTP/1.1\r\nHost: 127.0.0.1\r\nCookie: {cookie}\r\n\r\n".encode())
+        if b" 200 " not in await reader.readline():
+            return
+        opened.append(1)
+        while line := await reader.readline():
+            if line.startswith(b"event: order_created"):
+                received.append(1)
+    finally:
+        writer.close()
+
+async def _serve_level(port, screens, customers, seconds):
+    import asyncio
+
+    staff = None
+    status, headers, _ = await _request(port, "POST", "/login", None, {"username": "rush1", "password": SEED_PASSWORD})
+    staff = _session_cookie(headers, staff)
+    opened, received = [], []
+    holders = [asyncio.ensure_future(_kitchen_screen(port, staff, opened, received)) for _ in range(screens)]
+    await asyncio.sleep(1 + screens / 500)  # let the screens connect
+
+    latencies = defaultdict(list)
+    errors = Counter()
+    deadline = time.perf_counter() + seconds
+
+    async def call(route, cookie, method, path, data=None):
+        start = time.perf_counter()
+        try:
+            status, headers, _ = await _request(port, method, path, cookie, data)
+        except (OSError, asyncio.TimeoutError):
+            status, headers = 0, []
+        latencies[route].append(time.perf_counter() - start)
+        if status >= 400 or status == 0:
+            errors[route] += 1
+        return _session_cookie(headers, cookie)
+
+    async def customer(username):
+        cookie = await call("login", None, "POST", "/login", {"username": username, "password": SEED_PASSWORD})
+        rng = random.Random(username)
+        while time.perf_counter() < deadline:
+            cookie = await call("index", cookie, "GET", "/")
+            cookie = await call("update_cart", cookie, "POST", "/update_cart", {"item_id": rng.randint(1, 5), "change": 1})
+            cookie = await call("checkout_confirm", cookie, "POST", "/checkout_confirm")
+            cookie = await call("confirm_checkout", cookie, "POST", "/confirm_checkout")
+            cookie = await call("download_receipt", cookie, "GET", "/download_receipt")
+
+    start = time.perf_counter()
+    await asyncio.gather(*(customer(f"rush{n}") for n in range(2, customers + 2)))
+    elapsed = time.perf_counter() - start
+    await asyncio.sleep(0.5)  # the last order events reach the screens
+    for holder in holders:
+        holder.cancel()
+    await asyncio.gather(*holders, return_exceptions=True)
+    return latencies, errors, elapsed, len(opened), len(received)
+
+def _proc_status(pid):
+    fields = {}
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            name, _, value = line.partition(":")
+            fields[name] = value.split()[0] if value.split() else ""
+    return int(fields["Threads"]), int(fields["VmRSS"]) / 1024
+
+def bench_serve_modes(args):
+    # Customers going through checkout (with its QR and PDF work) while
+    # kitchen screens hold /orders/stream open: threaded WSGI against
+    # asgi.py. Per level: screens that got connected and order events they
+    # received, customer latency and errors, and the server's threads and RSS.
+    import asyncio
+    import socket
+
+    seed_database(0, args.customers + 1, 0, 1)
+    conn = crud.get_connection()
+    conn.execute("UPDATE users SET is_staff = 1 WHERE username = 'rush1'")
+    conn.commit()
+    crud.close_pool()
+    env = dict(os.environ, PYTHONPATH=os.getcwd())
+    for mode in args.modes:
+        for screens in args.screens:
+            with socket.socket() as s:
+                s.bind(("127.0.0.1", 0))
+                port = s.getsockname()[1]
+            server = subprocess.Popen([sys.executable, "-c", SERVE_PROBE, mode, crud.DATABASE, str(port), str(args.threads)],
+                                      env=env)
+            try:
+                for _ in range(100):
+                    try:
+                        urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics").read()
+                        break
+                    except OSError:
+                        time.sleep(0.1)
+                peak = [0, 0.0]
+                sampling = threading.Event()
+
+                def sample():
+                    while not sampling.wait(0.2):
+                        threads, rss = _proc_status(server.pid)
+                        peak[0], peak[1] = max(peak[0], threads), max(peak[1], rss)
+
+                sampler = threading.Thread(target=sample)
+                sampler.start()
+                try:
+                    latencies, errors, elapsed, opened, received = asyncio.run(
+                        _serve_level(port, screens, args.customers, args.seconds)
+                    )
+                finally:
+                    sampling.set()
+                    sampler.join()
+            finally:
+                server.terminate()
+                try:
+                    server.wait(10)
+                except subprocess.TimeoutExpired:
+                    server.kill()
+                    server.wait()
+            everything = [v for values in latencies.values() for v in values]
+            checkouts = len(latencies["confirm_checkout"])
+            print(f"serve mode={mode} screens={opened}/{screens} customers={args.customers} "
+                  f"requests={len(everything)} errors={sum(errors.values())} req/s={len(everything) / elapsed:.1f} "
+                  f"p50={percentile(everything, 50) * 1000:.1f}ms p99={percentile(everything, 99) * 1000:.1f}ms "
+                  f"events_per_screen={received / opened if opened else 0:.1f}/{checkouts} "
+                  f"peak_threads={peak[0]} peak_rss={peak[1]:.0f}MiB")
+            for route in ("index", "confirm_checkout", "download_receipt"):
+                print(f"  {route:<17} n={len(latencies[route]):<5} err={errors[route]:<4} "
+                      f"p50={percentile(latencies[route], 50) * 1000:7.1f}ms "
+                      f"p99={percentile(latencies[route], 99) * 1000:7.1f}ms")
+
+def bench_menu_search(args):
+    # Search latency on a large menu with names made from a shared word
+    # list: queries matching a few, a tenth and most of the items, with and
+    # without a price range
+    rng = random.Random(1)
+    crud.migrate()
+    conn = crud.get_connection()
+    images = sorted(f"images/{name}" for name in os.listdir("static/images") if name.endswith(".jpg"))
+    conn.executemany(
+        "INSERT INTO menu_items (name, price, image, description) VALUES (?, ?, ?, ?)",
+        [(" ".join(rng.sample(MENU_WORDS, rng.randint(2, 4))).title(), float(rng.randrange(60, 400, 5)),
+          rng.choice(images), " ".join(rng.sample(MENU_WORDS, 6))) for _ in range(args.menu_items)]
+    )
+    crud.rebuild_menu_search(conn)
+    crud.invalidate_menu()
+    queries = [
+        ("pork crispy rice", None, None),
+        ("silog", None, None),
+        ("sisig", None, None),
+        ("chicken", 100, 200),
+        ("chi", None, None),
+        ("", 100, 150),
+    ]
+    menu = crud.get_menu()
+    for query, low, high in queries:
+        # cold: the search cache emptied before every call; cached: repeats
+        timings = {"cold": [], "cached": []}
+        for label, runs in timings.items():
+            for _ in range(args.runs):
+                if label == "cold":
+                    crud._search_cache.clear()
+                start = time.perf_counter()
+                results = crud.search_menu(query, low, high, menu=menu)
+                runs.append(time.perf_counter() - start)
+        matched = sum(facet["count"] for facet in results["facets"])
+        print(f"menu-search items={len(menu.items)} q={query!r:<18} price={low}-{high} matched={matched:<5} "
+              + " ".join(f"{label} p50={percentile(runs, 50) * 1000:.3f}ms p99={percentile(runs, 99) * 1000:.3f}ms"
+                         for label, runs in timings.items()))
+
+def bench_menu_import(args):
+    # Adding a batch of menu items one create_menu_item() call at a time
+    # against one import of the same batch, then a dry run and a re-import
+    # that changes every price
+    import catalog
+
+    crud.migrate()
+    images = sorted(f"images/{name}" for name in os.listdir("static/images") if name.endswith(".jpg"))
+    rows = [
+        {"name": f"{label} {i}", "price": float(60 + i % 240), "image": images[i % len(images)],
+         "description": f"{MENU_WORDS[i % len(MENU_WORDS)]} special"}
+        for label in ("Single", "Batch") for i in range(args.items)
+    ]
+    singles, batch = rows[:args.items], rows[args.items:]
+
+    start = time.perf_counter()
+    for row in singles:
+        crud.create_menu_item(row["name"], row["price"], row["image"], row["description"])
+    one_by_one = time.perf_counter() - start
+
+    csv_file = os.path.join(os.path.dirname(crud.DATABASE), "import.csv")
+    with open(csv_file, "w", newline="") as f:
+        catalog.write_items(f, batch)
+    start = time.perf_counter()
+    plan, _ = catalog.import_file(csv_file)
+    imported = time.perf_counter() - start
+    assert len(plan["add"]) == args.items
+
+    for row in batch:
+        row["price"] += 5
+    with open(csv_file, "w", newline="") as f:
+        catalog.write_items(f, batch)
+    start = time.perf_counter()
+    plan, _ = catalog.import_file(csv_file, dry_run=True)
+    dry_run = time.perf_counter() - start
+    start = time.perf_counter()
+    catalog.import_file(csv_file)
+    updated = time.perf_counter() - start
+    assert len(plan["update"]) == args.items
+    print(f"menu-import items={args.items} one_by_one={one_by_one * 1000:.0f}ms import={imported * 1000:.0f}ms "
+          f"dry_run={dry_run * 1000:.0f}ms update_all={updated * 1000:.0f}ms")
+
+def bench_reports(args):
+    # Report latency as order history grows: the rollups against the same
+    # numbers computed from orders / order_items
+    import analytics
+
+    seeded = 0
+    for orders in args.orders:
+        seed_database(0, 20, orders - seeded, args.days)
+        seeded = orders
+        conn = crud.get_connection()
+        end = datetime.now(timezone.utc).date()
+        start = (end - timedelta(days=args.range_days - 1)).isoformat()
+        end = end.isoformat()
+        naive = (
+            "SELECT date(created_at), COUNT(*), SUM(total), AVG(total) FROM orders"
+            " WHERE created_at >= date(?) AND created_at < date(?, '+1 day') GROUP BY 1",
+            "SELECT oi.menu_item_id, oi.name, SUM(oi.qty) FROM orders o JOIN order_items oi ON oi.order_id = o.id"
+            " WHERE o.created_at >= date(?) AND o.created_at < date(?, '+1 day')"
+            " GROUP BY 1, 2 ORDER BY 3 DESC LIMIT 10",
+        )
+        # timed apart, so the full scans don't push the rollups out of the page cache
+        timings = {"rollups": [], "orders": []}
+        for _ in range(args.runs):
+            started = time.perf_counter()
+            crud.get_sales_report(start, end)
+            timings["rollups"].append(time.perf_counter() - started)
+        for _ in range(args.runs):
+            started = time.perf_counter()
+            for sql in naive:
+                conn.execute(sql, (start, end)).fetchall()
+            timings["orders"].append(time.perf_counter() - started)
+        rollup = crud.get_sales_report(start, end)["summary"]
+        direct = conn.execute(
+            "SELECT COUNT(*), SUM(CAST(ROUND(total * 100) AS INTEGER)) FROM orders"
+            " WHERE created_at >= date(?) AND created_at < date(?, '+1 day') AND status != 'cancelled'",
+            (start, end)
+        ).fetchone()
+        matches = (rollup["orders"], round(rollup["revenue"] * 100)) == (direct[0], direct[1] or 0)
+        print(f"reports orders={orders:<8} days={args.range_days} "
+              f"rollups p50={percentile(timings['rollups'], 50) * 1000:.2f}ms "
+              f"orders p50={percentile(timings['orders'], 50) * 1000:.2f}ms "
+              f"totals_match={matches}")
+        crud.close_db()
+
+    # a full recount, chunked, for the backfill path
+    started = time.perf_counter()
+    counted = analytics.rebuild(crud.get_connection())
+    print(f"rebuild orders={counted} seconds={time.perf_counter() - started:.1f}")
+
+def _order_reads(user_id, old_id, day):
+    # {label: seconds} for the order reads that grow with the history
+    reads = {
+        "get_orders": crud.get_orders,
+        "pending_since": lambda: crud.get_pending_orders_since(day),
+        "user_history": lambda: crud.get_orders_for_user(user_id),
+        "old_order": lambda: (crud.get_order(old_id), crud.get_order_items(old_id)),
+        "top_sellers_old_day": lambda: crud.get_top_sellers(day),
+    }
+    timings = {}
+    for label, read in reads.items():
+        runs = []
+        for _ in range(3 if label == "get_orders" else 20):
+            started = time.perf_counter()
+            read()
+            runs.append(time.perf_counter() - started)
+        timings[label] = statistics.median(runs)
+    return timings
+
+def bench_archive(args):
+    # Archive a long synthetic history while checkouts keep coming: how long
+    # it takes, how much it delays the checkouts, and the order reads before
+    # and after. Reports must come out the same.
+    import analytics
+    import archive
+
+    seeded = 0
+    while seeded < args.orders:
+        batch = min(250000, args.orders - seeded)
+        seed_database(0, 20, batch, args.days, seed=seeded + 1)
+        seeded += batch
+    conn = crud.get_connection()
+    user_id = conn.execute("SELECT user_id FROM orders WHERE user_id IS NOT NULL ORDER BY id DESC LIMIT 1").fetchone()[0]
+    old_id = conn.execute("SELECT MIN(id) FROM orders").fetchone()[0]
+    old_day = conn.execute("SELECT date(created_at) FROM orders WHERE id = ?", (old_id,)).fetchone()[0]
+    first_day = (datetime.now(timezone.utc) - timedelta(days=args.days + 1)).date().isoformat()
+    today = datetime.now(timezone.utc).date().isoformat()
+    report = crud.get_sales_report(first_day, today)
+    total = conn.execute("SELECT COUNT(*) FROM orders").fetchone()[0]
+    before = _order_reads(user_id, old_id, old_day)
+
+    latencies = []
+    stop = threading.Event()
+
+    def checkouts():
+        items = [{"id": 1, "name": "Longsilog", "qty": 1, "price": 100.0}]
+        while not stop.is_set():
+            started = time.perf_counter()
+            crud.create_order(user_id, items, 100.0)
+            latencies.append(time.perf_counter() - started)
+            time.sleep(0.005)
+
+    idle = threading.Thread(target=checkouts)
+    idle.start()
+    time.sleep(2)
+    stop.set()
+    idle.join()
+    quiet = latencies[:]
+    latencies.clear()
+    stop.clear()
+
+    busy = threading.Thread(target=checkouts)
+    busy.start()
+    started = time.perf_counter()
+    archived, removed = archive.archive_orders(conn, archive.cutoff(args.retention_days), args.chunk)
+    elapsed = time.perf_counter() - started
+    stop.set()
+    busy.join()
+    after = _order_reads(user_id, old_id, old_day)
+
+    hot = conn.execute("SELECT COUNT(*) FROM main.orders").fetchone()[0]
+    cold = conn.execute("SELECT COUNT(*) FROM archive.orders").fetchone()[0]
+    print(f"archive orders={total} archived={archived} seconds={elapsed:.1f} "
+          f"orders/s={archived / elapsed:.0f} hot={hot} archive={cold} qr_removed={removed}")
+    for label, runs in (("idle", quiet), ("while archiving", latencies)):
+        print(f"archive checkout {label:<15} n={len(runs)} p50={percentile(runs, 50) * 1000:.1f}ms "
+              f"p99={percentile(runs, 99) * 1000:.1f}ms max={max(runs) * 1000:.1f}ms")
+    for label in before:
+        print(f"archive read {label:<20} before={before[label] * 1000:.2f}ms after={after[label] * 1000:.2f}ms")
+
+    # the rollups are left alone, and a rebuild over both tables agrees
+    kept = crud.get_sales_report(first_day, today)["summary"]
+    same = kept["orders"] == report["summary"]["orders"] + len(quiet) + len(latencies)
+    started = time.perf_counter()
+    counted = analytics.rebuild(conn)
+    rebuilt = crud.get_sales_report(first_day, today)["summary"] == kept
+    print(f"archive totals_kept={same} rebuild_orders={counted} rebuild_matches={rebuilt} "
+          f"rebuild_seconds={time.perf_counter() - started:.1f}")
+    if hot + cold != total + len(quiet) + len(latencies) or not same or not rebuilt:
+        raise SystemExit(1)
+
+def bench_rush(args):
+    # Lunch rush: seeded database, concurrent customers going through the
+    # whole ordering flow, latency / throughput / SQL per route
+    import passwords
+
+    usernames = seed_database(args.menu_items, args.users, args.orders, args.days)
+    # every simulated customer comes from 127.0.0.1; the login limiters
+    # would otherwise turn most of them away
+    passwords.username_limiter = passwords.TokenBucket(rate=1e6, burst=1e6)
+    passwords.ip_limiter = passwords.TokenBucket(rate=1e6, burst=1e6)
+
+    from restaurant import create_app
+    app = create_app()
+    server = None
+    if args.mode == "server":
+        server = start_server(app)
+        base_url = f"http://127.0.0.1:{server.server_port}"
+        make_browser = lambda: HTTPSession(base_url)
+    else:
+        make_browser = lambda: TestClientSession(app)
+
+    levels = []
+    try:
+        for clients in args.concurrency:
+            result = run_rush(make_browser, usernames, clients, args.seconds)
+            levels.append(result)
+            print(f"concurrency={clients} mode={args.mode} requests={result['requests']} "
+                  f"errors={result['errors']} req/s={result['rps']:.1f} p50={result['p50_ms']:.1f}ms "
+                  f"p95={result['p95_ms']:.1f}ms p99={result['p99_ms']:.1f}ms connections={result['connections']}")
+            for route, stats in result["routes"].items():
+                print(f"  {route:<17} n={stats['requests']:<6} err={stats['errors']:<4} "
+                      f"p50={stats['p50_ms']:7.1f}ms p95={stats['p95_ms']:7.1f}ms p99={stats['p99_ms']:7.1f}ms "
+                      f"sql/req={stats['queries_per_request']:.1f} conns={stats['connections']}")
+    finally:
+        if server is not None:
+            server.shutdown()
+
+    if args.json:
+        report = {
+            "version": _git_version(),
+            "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "mode": args.mode,
+            "scale": {"menu_items": args.menu_items, "users": args.users, "orders": args.orders, "days": args.days},
+            "levels": levels,
+        }
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Wrote {args.json}")
+
+def bench_compare(args):
+    # Per route and concurrency level: p95 and req/s of `after` vs `before`;
+    # exits 1 when any p95 got worse by more than --threshold percent
+    with open(args.before) as f:
+        before = {level["concurrency"]: level for level in json.load(f)["levels"]}
+    with open(args.after) as f:
+        after = {level["concurrency"]: level for level in json.load(f)["levels"]}
+
+    regressions = 0
+    for clients in sorted(before.keys() & after.keys()):
+        print(f"concurrency={clients}")
+        old_routes, new_routes = before[clients]["routes"], after[clients]["routes"]
+        for route in sorted(old_routes.keys() & new_routes.keys()):
+            old, new = old_routes[route], new_routes[route]
+            change = (new["p95_ms"] - old["p95_ms"]) / old["p95_ms"] * 100 if old["p95_ms"] else 0.0
+            flag = ""
+            if change > args.threshold:
+                flag = "  REGRESSION"
+                regressions += 1
+            print(f"  {route:<17} p95 {old['p95_ms']:7.1f} -> {new['p95_ms']:7.1f}ms ({change:+.0f}%) "
+                  f"req/s {old['rps']:7.1f} -> {new['rps']:7.1f} "
+                  f"sql/req {old['queries_per_request']:.1f} -> {new['queries_per_request']:.1f}{flag}")
+    if regressions:
+        raise SystemExit(1)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for restaurant.py")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    load = commands.add_parser("load", help="concurrent HTTP load on one path")
+    load.add_argument("--clients", type=int, default=16)
+    load.add_argument("--seconds", type=float, default=10)
+    load.add_argument("--path", default="/")
+    load.set_defaults(func=bench_load)
+
+    page = commands.add_parser("page", help="CPU per request for one page, full and 304")
+    page.add_argument("--path", default="/")
+    page.add_argument("--menu-items", type=int, default=0, help="extra menu items to seed")
+    page.add_argument("--runs", type=int, default=1000)
+    page.set_defaults(func=bench_page)
+
+    receipt = commands.add_parser("receipt", help="PDF receipt latency and memory")
+    receipt.add_argument("--items", type=int, default=5)
+    receipt.add_argument("--runs", type=int, default=50)
+    receipt.set_defaults(func=bench_receipt)
+
+    numbers = commands.add_parser("order-numbers", help="order number uniqueness under concurrency")
+    numbers.add_argument("--processes", type=int, default=4)
+    numbers.add_argument("--threads", type=int, default=8)
+    numbers.add_argument("--count", type=int, default=200, help="numbers per thread")
+    numbers.add_argument("--insert", action="store_true", help="create real orders instead of just reserving numbers")
+    numbers.set_defaults(func=bench_order_numbers)
+
+    writes = commands.add_parser("order-writes", help="checkout bursts: per-call commit vs group commit")
+    writes.add_argument("--threads", type=lambda s: [int(n) for n in s.split(",")], default=[1, 8, 32],
+                        help="comma-separated concurrent checkouts, one run each")
+    writes.add_argument("--count", type=int, default=50, help="orders per thread")
+    writes.add_argument("--queue-size", type=int, default=256, help="order writer queue bound")
+    writes.set_defaults(func=bench_order_writes)
+
+    stock = commands.add_parser("stock", help="concurrent checkouts against limited stock: never oversold, throughput")
+    stock.add_argument("--processes", type=int, default=4)
+    stock.add_argument("--threads", type=int, default=8, help="per process")
+    stock.add_argument("--count", type=int, default=50, help="checkouts per thread")
+    stock.add_argument("--items", type=int, default=4, help="menu items everyone is buying")
+    stock.add_argument("--stock", type=int, default=500, help="servings of each item")
+    stock.set_defaults(func=bench_stock)
+
+    keys = commands.add_parser("checkout-keys", help="parallel submits of the same checkout: one order per key")
+    keys.add_argument("--processes", type=int, default=4)
+    keys.add_argument("--threads", type=int, default=8, help="per process, each submitting every key")
+    keys.add_argument("--keys", type=int, default=200)
+    keys.add_argument("--customers", type=int, default=20, help="logged-in browsers double tapping checkout")
+    keys.add_argument("--taps", type=int, default=4, help="concurrent submits per customer")
+    keys.set_defaults(func=bench_checkout_keys)
+
+    startup = commands.add_parser("startup", help="boot time and memory per worker, preloaded vs spawned")
+    startup.add_argument("--workers", type=int, default=4)
+    startup.set_defaults(func=bench_startup)
+
+    serving = commands.add_parser("serve-modes", help="threaded WSGI against asgi.py with kitchen screens connected")
+    serving.add_argument("--modes", type=lambda s: s.split(","), default=["wsgi", "asgi"])
+    serving.add_argument("--screens", type=lambda s: [int(n) for n in s.split(",")], default=[0, 200, 1000],
+                         help="comma-separated open /orders/stream connections, one run each")
+    serving.add_argument("--customers", type=int, default=16, help="concurrent customers checking out")
+    serving.add_argument("--seconds", type=float, default=10)
+    serving.add_argument("--threads", type=int, default=16, help="asgi request threads")
+    serving.set_defaults(func=bench_serve_modes)
+
+    search = commands.add_parser("menu-search", help="menu search latency on a large menu")
+    search.add_argument("--menu-items", type=int, default=5000, help="extra menu items to seed")
+    search.add_argument("--runs", type=int, default=200)
+    search.set_defaults(func=bench_menu_search)
+
+    menu_import = commands.add_parser("menu-import", help="bulk menu import against item-by-item inserts")
+    menu_import.add_argument("--items", type=int, default=2000)
+    menu_import.set_defaults(func=bench_menu_import)
+
+    reports = commands.add_parser("reports", help="sales report latency as order history grows")
+    reports.add_argument("--orders", type=lambda s: [int(n) for n in s.split(",")], default=[10000, 100000],
+                         help="comma-separated order history sizes, one run each")
+    reports.add_argument("--days", type=int, default=365, help="spread seeded orders over this many days")
+    reports.add_argument("--range-days", type=int, default=30, help="days covered by the report")
+    reports.add_argument("--runs", type=int, default=20)
+    reports.set_defaults(func=bench_reports)
+
+    archiving = commands.add_parser("archive", help="archive a long order history under checkout load")
+    archiving.add_argument("--orders", type=int, default=2000000, help="order history to seed")
+    archiving.add_argument("--days", type=int, default=730, help="spread the history over this many days")
+    archiving.add_argument("--retention-days", type=float, default=90, help="keep orders this recent live")
+    archiving.add_argument("--chunk", type=int, default=500, help="orders per archive transaction")
+    archiving.set_defaults(func=bench_archive)
+
+    kdf = commands.add_parser("kdf", help="password hashing cost and pool throughput")
+    kdf.add_argument("--runs", type=int, default=10)
+    kdf.add_argument("--clients", type=int, default=8)
+    kdf.set_defaults(func=bench_kdf)
+
+    combos = commands.add_parser("suggest", help="budget combo suggestion latency")
+    combos.add_argument("--items", type=int, default=300)
+    combos.add_argument("--budget", type=float, default=5000)
+    combos.add_argument("--runs", type=int, default=20)
+    combos.set_defaults(func=bench_suggest)
+
+    rush = commands.add_parser("rush", help="lunch-rush session flows against a seeded database")
+    rush.add_argument("--concurrency", type=lambda s: [int(n) for n in s.split(",")], default=[1, 8, 32],
+                      help="comma-separated client counts, one run each")
+    rush.add_argument("--seconds", type=float, default=10, help="per concurrency level")
+    rush.add_argument("--mode", choices=("client", "server"), default="server",
+                      help="Flask test client in-process, or HTTP against a local WSGI server")
+    rush.add_argument("--menu-items", type=int, default=50, help="extra menu items to seed")
+    rush.add_argument("--users", type=int, default=200)
+    rush.add_argument("--orders", type=int, default=20000, help="order history to seed")
+    rush.add_argument("--days", type=int, default=30, help="spread the order history over this many days")
+    rush.add_argument("--json", help="save the results here")
+    rush.set_defaults(func=bench_rush)
+
+    compare = commands.add_parser("compare", help="compare two rush --json results")
+    compare.add_argument("before")
+    compare.add_argument("after")
+    compare.add_argument("--threshold", type=float, default=10, help="p95 slowdown in percent that counts as a regression")
+    compare.set_defaults(func=bench_compare, scratch=False)
+
+    args = parser.parse_args()
+    if not getattr(args, "scratch", True):
+        args.func(args)
+        return
+    workdir = tempfile.mkdtemp(prefix="restaurant-bench-")
+    try:
+        copy_database(workdir)
+        args.func(args)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
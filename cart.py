@@ -0,0 +1,201 @@
+# cart.py
+# Session cart keyed by menu item id.
+#
+# The session only stores [[item_id, qty], ...]; names, images and prices come
+# from the menu snapshot, so a price change reaches carts that are already
+# open. Money is kept in integer centavos so the running subtotal can be
+# updated per line without float drift.
+
+TAX_RATE = 0.12  # 12% VAT
+MAX_BATCH = 50  # operations per Cart.apply() call
+MAX_LINE_QTY = 99
+
+
+def to_cents(amount):
+    return int(round(float(amount) * 100))
+
+
+class CartLine:
+    __slots__ = ("item", "qty", "price_cents")
+
+    def __init__(self, item, qty, price_cents):
+        self.item = item
+        self.qty = qty
+        self.price_cents = price_cents
+
+    @property
+    def id(self):
+        return self.item["id"]
+
+    @property
+    def name(self):
+        return self.item["name"]
+
+    @property
+    def image(self):
+        return self.item["image"]
+
+    @property
+    def price(self):
+        return self.price_cents / 100
+
+    @property
+    def subtotal(self):
+        return self.qty * self.price_cents / 100
+
+    def __getitem__(self, key):
+        # lets templates and older code keep using line["name"] etc.
+        return getattr(self, key)
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "name": self.name,
+            "qty": self.qty,
+            "price": self.price,
+            "subtotal": self.subtotal,
+            "image": self.image,
+        }
+
+
+class Cart:
+    __slots__ = ("_lines", "subtotal_cents")
+
+    def __init__(self):
+        self._lines = {}
+        self.subtotal_cents = 0
+
+    @classmethod
+    def from_session(cls, data, menu):
+        cart = cls()
+        for entry in data or ():
+            if isinstance(entry, dict):
+                # pre-Cart sessions stored full dicts keyed by name
+                item = menu.by_name.get(entry.get("name"))
+                qty = entry.get("qty", 0)
+            else:
+                # older sessions also stored the unit price, which is ignored
+                item = menu.by_id.get(entry[0])
+                qty = entry[1]
+            if item is None:
+                continue
+            cart.add(item, int(qty))
+        return cart
+
+    def to_session(self):
+        return [[line.id, line.qty] for line in self._lines.values()]
+
+    def add(self, item, qty):
+        # Merge qty into the line for item (negative qty removes); the whole
+        # line takes the item's current menu price.
+        line = self._lines.get(item["id"])
+        price_cents = to_cents(item["price"])
+        if line is None:
+            if qty <= 0:
+                return None
+            line = CartLine(item, qty, price_cents)
+            self._lines[item["id"]] = line
+            self.subtotal_cents += qty * price_cents
+            return line
+        new_qty = line.qty + qty
+        self.subtotal_cents -= line.qty * line.price_cents
+        if new_qty <= 0:
+            del self._lines[item["id"]]
+            return None
+        line.item = item
+        line.qty = new_qty
+        line.price_cents = price_cents
+        self.subtotal_cents += new_qty * price_cents
+        return line
+
+    def apply(self, ops, menu):
+        # Batch of {"item_id", "delta"} (or {"item_id", "qty"} to set a line,
+        # 0 removes it) checked against the menu snapshot. Everything is
+        # validated before anything changes; raises ValueError on a bad op.
+        # Returns the ids of the lines touched, in order.
+        if not isinstance(ops, list) or not ops:
+            raise ValueError("ops must be a non-empty list")
+        if len(ops) > MAX_BATCH:
+            raise ValueError(f"at most {MAX_BATCH} ops per request")
+        changes = []
+        for n, op in enumerate(ops):
+            if not isinstance(op, dict):
+                raise ValueError(f"op {n}: expected an object")
+            item = menu.get(op.get("item_id"))
+            if item is None:
+                raise ValueError(f"op {n}: unknown item_id {op.get('item_id')!r}")
+            if "qty" in op:
+                value, absolute = op["qty"], True
+            else:
+                value, absolute = op.get("delta"), False
+            if isinstance(value, bool) or not isinstance(value, int) or abs(value) > MAX_LINE_QTY:
+                raise ValueError(f"op {n}: quantity must be an integer up to {MAX_LINE_QTY}")
+            if absolute and value < 0:
+                raise ValueError(f"op {n}: qty can't be negative")
+            if item["sold_out"] and (value > self.qty(item["id"]) if absolute else value > 0):
+                raise ValueError(f"op {n}: item {item['id']} is sold out")
+            changes.append((item, value, absolute))
+
+        touched = {}
+        for item, value, absolute in changes:
+            current = self.qty(item["id"])
+            target = value if absolute else current + value
+            target = min(max(target, 0), MAX_LINE_QTY)
+            if target != current:
+                self.add(item, target - current)
+            touched[item["id"]] = None
+        return list(touched)
+
+    def delta(self, item_ids):
+        # The touched lines (qty 0 once removed) and the new totals
+        lines = []
+        for item_id in item_ids:
+            line = self._lines.get(item_id)
+            lines.append(line.to_dict() if line else {"id": item_id, "qty": 0, "subtotal": 0.0})
+        return {
+            "lines": lines,
+            "count": len(self._lines),
+            "subtotal": self.subtotal,
+            "taxes": self.taxes,
+            "total": self.total,
+        }
+
+    def remove(self, item_id):
+        line = self._lines.pop(item_id, None)
+        if line is not None:
+            self.subtotal_cents -= line.qty * line.price_cents
+
+    def clear(self):
+        self._lines.clear()
+        self.subtotal_cents = 0
+
+    def qty(self, item_id):
+        line = self._lines.get(item_id)
+        return line.qty if line else 0
+
+    def lines(self):
+        return list(self._lines.values())
+
+    def to_list(self):
+        return [line.to_dict() for line in self._lines.values()]
+
+    def __iter__(self):
+        return iter(self._lines.values())
+
+    def __len__(self):
+        return len(self._lines)
+
+    def __bool__(self):
+        return bool(self._lines)
+
+    @property
+    def subtotal(self):
+        return self.subtotal_cents / 100
+
+    @property
+    def taxes(self):
+        return round(self.subtotal * TAX_RATE, 2)
+
+    @property
+    def total(self):
+        return round(self.subtotal + self.taxes, 2)
@@ -0,0 +1,185 @@
+# catalog.py
+# Bulk menu import and export, as CSV or JSON.
+#
+# A file has one item per row (CSV) or per line (JSON Lines, or a single
+# JSON array), with the fields name and price and optionally image and
+# description. Items are matched to the menu by name: known names are
+# updated, new ones added, and with --prune items missing from the file are
+# removed. A field left out keeps its current value.
+#
+# The whole file is validated before anything is written; any error stops
+# the import. The changes are then written in one transaction with batched
+# statements, and the menu cache is invalidated once. --dry-run prints the
+# changes without making them. Export writes the same format back out.
+#
+#   python catalog.py export -o menu.csv
+#   python catalog.py import menu.csv --dry-run
+#   python catalog.py import menu.jsonl --prune
+import argparse
+import csv
+import json
+import os
+import sys
+
+import crud
+import images
+
+FIELDS = ("name", "price", "image", "description")
+FORMATS = ("csv", "jsonl", "json")
+
+
+class CatalogError(ValueError):
+    # errors is a list of (line, message)
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__("\n".join(f"line {line}: {message}" for line, message in errors))
+
+
+def _format(path, fmt=None):
+    if fmt:
+        return fmt
+    ext = os.path.splitext(path)[1].lower().lstrip(".")
+    return ext if ext in FORMATS else "csv"
+
+def _rows(f, fmt):
+    # (line, dict) pairs; CSV and JSON Lines are read a row at a time
+    if fmt == "csv":
+        reader = csv.DictReader(f)
+        for row in reader:
+            yield reader.line_num, row
+    elif fmt == "jsonl":
+        for line, text in enumerate(f, 1):
+            if text.strip():
+                try:
+                    yield line, json.loads(text)
+                except ValueError as e:
+                    yield line, e
+    else:
+        try:
+            rows = json.load(f)
+        except ValueError as e:
+            raise CatalogError([(getattr(e, "lineno", 1), str(e))])
+        if not isinstance(rows, list):
+            raise CatalogError([(1, "expected a JSON array of items")])
+        yield from enumerate(rows, 1)
+
+def _item(row):
+    # (item, problems) for one row; item fields left out are None
+    if isinstance(row, ValueError):
+        return None, [f"invalid JSON: {row}"]
+    if not isinstance(row, dict):
+        return None, ["expected an object with name and price"]
+    problems = []
+    name = str(row.get("name") or "").strip()
+    if not name:
+        problems.append("name is required")
+
+    price = row.get("price")
+    try:
+        price = float(price)
+        if not 0 <= price < float("inf") or round(price, 2) != price:
+            raise ValueError
+    except (TypeError, ValueError):
+        problems.append(f"price must be a non-negative amount with at most 2 decimals, got {row.get('price')!r}")
+
+    image = row.get("image")
+    if image is not None:
+        image = str(image).strip().lstrip("/")
+        path = os.path.normpath(os.path.join(images.STATIC_FOLDER, image))
+        if image and not path.startswith(os.path.normpath(images.STATIC_FOLDER) + os.sep):
+            problems.append(f"image must be a path under {images.STATIC_FOLDER}/, got {row['image']!r}")
+
+    description = row.get("description")
+    if description is not None:
+        description = str(description).strip()
+    return {"name": name, "price": price, "image": image, "description": description}, problems
+
+def read_items(f, fmt="csv"):
+    # Validates every row; returns (items, warnings) or raises CatalogError
+    # with all the problems found
+    items, errors, warnings = [], [], []
+    seen = {}
+    for line, row in _rows(f, fmt):
+        item, problems = _item(row)
+        errors += [(line, problem) for problem in problems]
+        if problems:
+            continue
+        if item["name"] in seen:
+            errors.append((line, f"{item['name']!r} is already on line {seen[item['name']]}"))
+            continue
+        seen[item["name"]] = line
+        if item["image"] and not os.path.isfile(os.path.join(images.STATIC_FOLDER, item["image"])):
+            warnings.append((line, f"image {item['image']!r} not found"))
+        items.append(item)
+    if errors:
+        raise CatalogError(errors)
+    return items, warnings
+
+def import_file(path, fmt=None, prune=False, dry_run=False):
+    # Returns (plan, warnings); see crud.import_menu_items for the plan
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        items, warnings = read_items(f, _format(path, fmt))
+    return crud.import_menu_items(items, prune=prune, dry_run=dry_run), warnings
+
+
+def write_items(f, items, fmt="csv"):
+    rows = ({field: item[field] for field in FIELDS} for item in items)
+    if fmt == "csv":
+        writer = csv.DictWriter(f, FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+    elif fmt == "jsonl":
+        for row in rows:
+            f.write(json.dumps(row, ensure_ascii=False) + "\n")
+    else:
+        json.dump(list(rows), f, ensure_ascii=False, indent=1)
+        f.write("\n")
+
+
+def _print_plan(plan, dry_run):
+    for item in plan["add"]:
+        print(f"+ {item['name']}")
+    for update in plan["update"]:
+        changes = ", ".join(f"{field} {old!r} -> {new!r}" for field, (old, new) in update["changes"].items())
+        print(f"~ {update['name']}: {changes}")
+    for item in plan["remove"]:
+        print(f"- {item['name']}")
+    counts = (len(plan["add"]), len(plan["update"]), len(plan["remove"]))
+    template = "Would add {}, update {}, remove {}" if dry_run else "Added {}, updated {}, removed {}"
+    print(f"{template.format(*counts)}; {plan['unchanged']} unchanged")
+
+def main():
+    parser = argparse.ArgumentParser(description="Import or export the menu")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export = commands.add_parser("export", help="write the menu out")
+    export.add_argument("-o", "--output", help="file to write (default: stdout)")
+    export.add_argument("--format", choices=FORMATS, help="default: from the file extension, else csv")
+    load = commands.add_parser("import", help="add and update menu items from a file")
+    load.add_argument("path")
+    load.add_argument("--format", choices=FORMATS, help="default: from the file extension, else csv")
+    load.add_argument("--prune", action="store_true", help="remove items that aren't in the file")
+    load.add_argument("--dry-run", action="store_true", help="show the changes without making them")
+    args = parser.parse_args()
+
+    crud.migrate()
+    if args.command == "export":
+        items = crud.get_menu_items()
+        if args.output:
+            with open(args.output, "w", newline="", encoding="utf-8") as f:
+                write_items(f, items, _format(args.output, args.format))
+            print(f"Wrote {len(items)} items to {args.output}")
+        else:
+            write_items(sys.stdout, items, args.format or "csv")
+        return
+
+    try:
+        plan, warnings = import_file(args.path, args.format, prune=args.prune, dry_run=args.dry_run)
+    except CatalogError as e:
+        sys.exit(f"{args.path}: nothing imported\n{e}")
+    for line, warning in warnings:
+        print(f"line {line}: warning: {warning}")
+    _print_plan(plan, args.dry_run)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,140 @@
 # crud.py
+import ast
+import hashlib
+import json
+import math
+import os
+import queue
+import re
 import sqlite3
+import threading
+import time
+from bisect import bisect_right
+from collections import OrderedDict
+from concurrent.futures import Future
+from functools import wraps
+
+import analytics
+import events
+import images
+import metrics
 
 DATABASE = "database/database.db"
 
+# CONNECTION POOL
+# Each thread keeps at most one connection while it is handling a request;
+# close_db() hands it back to a bounded idle pool so the next request (often
+# on a brand new thread under the threaded dev server) can reuse it instead of
+# paying for sqlite3.connect() and the pragma setup again.
+POOL_SIZE = 8
+BUSY_TIMEOUT = 5.0
+BUSY_RETRIES = 3
+BUSY_BACKOFF = 0.05
+
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -8000",
+    "PRAGMA mmap_size = 67108864",
+    "PRAGMA temp_store = MEMORY",
+)
+
+# Orders moved out of the live tables by archive.py live in a second
+# database file, attached to every connection as "archive"
+ARCHIVE_PRAGMAS = (
+    "PRAGMA archive.journal_mode = WAL",
+    "PRAGMA archive.synchronous = NORMAL",
+)
+
+_local = threading.local()
+_idle = []
+_idle_lock = threading.Lock()
+
+
+def archive_path():
+    return os.path.splitext(DATABASE)[0] + "-archive.db"
+
+def _connect():
+    conn = sqlite3.connect(
+        DATABASE,
+        timeout=BUSY_TIMEOUT,
+        check_same_thread=False,
+        cached_statements=256,
+    )
+    conn.row_factory = sqlite3.Row
+    conn.set_trace_callback(metrics.statement)
+    metrics.connection_opened()
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    conn.execute("ATTACH DATABASE ? AS archive", (archive_path(),))
+    for pragma in ARCHIVE_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
 def get_connection():
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row 
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        with _idle_lock:
+            conn = _idle.pop() if _idle else None
+        if conn is None:
+            conn = _connect()
+        _local.conn = conn
     return conn
 
+def close_db(exception=None):
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        return
+    _local.conn = None
+    if conn.in_transaction:
+        conn.rollback()
+    with _idle_lock:
+        if len(_idle) < POOL_SIZE:
+            _idle.append(conn)
+            return
+    conn.close()
+
+def close_pool(keep_menu=False):
+    # keep_menu holds on to the menu snapshot, e.g. before forking workers
+    # that should inherit it but not the connections
+    global _menu_watch, _menu_data_version
+    close_db()
+    with _idle_lock:
+        while _idle:
+            _idle.pop().close()
+    with _menu_lock:
+        if _menu_watch is not None:
+            _menu_watch.close()
+            _menu_watch = None
+            _menu_data_version = None  # only comparable within one connection
+    if not keep_menu:
+        invalidate_menu()
+
+def init_app(app):
+    app.teardown_appcontext(close_db)
+
+def retry_on_busy(f):
+    # busy_timeout already waits on the lock; this covers the cases SQLite
+    # refuses to wait for (e.g. a read transaction upgrading to a write in WAL)
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        for attempt in range(BUSY_RETRIES):
+            try:
+                return f(*args, **kwargs)
+            except sqlite3.OperationalError as e:
+                if "locked" not in str(e) and "busy" not in str(e):
+                    raise
+                conn = getattr(_local, "conn", None)
+                if conn is not None and conn.in_transaction:
+                    conn.rollback()
+                if attempt == BUSY_RETRIES - 1:
+                    raise
+                time.sleep(BUSY_BACKOFF * (2 ** attempt))
+    return decorated_function
+
+
 # USERS CRUD
+@retry_on_busy
 def create_user(username, password, is_staff=0):
     conn = get_connection()
     cursor = conn.cursor()
@@ -17,107 +143,1131 @@ def create_user(username, password, is_staff=0):
         (username, password, is_staff)
     )
     conn.commit()
-    conn.close()
 
+@retry_on_busy
 def get_user_by_username(username):
     conn = get_connection()
     cursor = conn.cursor()
     cursor.execute("SELECT * FROM users WHERE username = ?", (username,))
     user = cursor.fetchone()
-    conn.close()
     return user
 
+@retry_on_busy
 def update_user_password(user_id, new_password):
     conn = get_connection()
     cursor = conn.cursor()
     cursor.execute("UPDATE users SET password = ? WHERE id = ?", (new_password, user_id))
     conn.commit()
-    conn.close()
 
+@retry_on_busy
 def delete_user(user_id):
     conn = get_connection()
     cursor = conn.cursor()
     cursor.execute("DELETE FROM users WHERE id = ?", (user_id,))
     conn.commit()
-    conn.close()
 
 
 # MENU ITEMS CRUD
-def create_menu_item(name, price, image):
+@retry_on_busy
+def create_menu_item(name, price, image, description=""):
+    images.variants(image)  # build the resized copies now, not on the next page view
     conn = get_connection()
     cursor = conn.cursor()
     cursor.execute(
-        "INSERT INTO menu_items (name, price, image) VALUES (?, ?, ?)",
-        (name, price, image)
+        "INSERT INTO menu_items (name, price, image, description) VALUES (?, ?, ?, ?)",
+        (name, price, image, description)
     )
+    _index_menu_item(cursor, cursor.lastrowid, name, description)
     conn.commit()
-    conn.close()
+    invalidate_menu()
 
 def get_menu_items():
+    return get_menu().items
+
+@retry_on_busy
+def _load_menu_items():
     conn = get_connection()
     cursor = conn.cursor()
-    cursor.execute("SELECT * FROM menu_items")
+    # stock itself is left out: it moves with every order, and pages only
+    # need to know whether an item has run out
+    cursor.execute(
+        "SELECT id, name, price, image, description, COALESCE(stock <= 0, 0) AS sold_out"
+        " FROM menu_items ORDER BY id"
+    )
     items = cursor.fetchall()
-    conn.close()
     return items
 
-def update_menu_item(item_id, name, price, image):
+@retry_on_busy
+def update_menu_item(item_id, name, price, image, description=None):
+    # description=None leaves the current one in place
+    images.variants(image)
     conn = get_connection()
     cursor = conn.cursor()
     cursor.execute(
-        "UPDATE menu_items SET name = ?, price = ?, image = ? WHERE id = ?",
-        (name, price, image, item_id)
+        "UPDATE menu_items SET name = ?, price = ?, image = ?, description = COALESCE(?, description) WHERE id = ?",
+        (name, price, image, description, item_id)
     )
+    if cursor.rowcount:
+        row = cursor.execute("SELECT description FROM menu_items WHERE id = ?", (item_id,)).fetchone()
+        _index_menu_item(cursor, item_id, name, row["description"])
     conn.commit()
-    conn.close()
+    invalidate_menu()
 
+@retry_on_busy
 def delete_menu_item(item_id):
     conn = get_connection()
     cursor = conn.cursor()
     cursor.execute("DELETE FROM menu_items WHERE id = ?", (item_id,))
+    _index_menu_item(cursor, item_id, None, None)
     conn.commit()
-    conn.close()
+    invalidate_menu()
 
+_MENU_FIELDS = ("price", "image", "description")
 
-# ORDERS CRUD
-def create_order(user_id, items, total, status="pending"):
+def _plan_menu_import(conn, items, prune):
+    # Diff `items` against menu_items by name. A field given as None keeps
+    # the current value (or the column default for a new item).
+    current = {row["name"]: row for row in conn.execute("SELECT * FROM menu_items")}
+    plan = {"add": [], "update": [], "remove": [], "unchanged": 0}
+    for item in items:
+        row = current.pop(item["name"], None)
+        if row is None:
+            plan["add"].append(item)
+            continue
+        changes = {
+            field: (row[field], item[field]) for field in _MENU_FIELDS
+            if item[field] is not None and item[field] != row[field]
+        }
+        if changes:
+            plan["update"].append({"id": row["id"], "name": row["name"], "changes": changes})
+        else:
+            plan["unchanged"] += 1
+    if prune:
+        plan["remove"] = [{"id": row["id"], "name": row["name"]} for row in current.values()]
+    return plan
+
+@retry_on_busy
+def import_menu_items(items, prune=False, dry_run=False):
+    # Bulk upsert by name in one transaction: items are dicts with name,
+    # price, image and description, names unique, already validated.
+    # prune also deletes items missing from `items`. Returns the plan
+    # ({"add", "update", "remove", "unchanged"}); dry_run rolls it back.
+    for image in {item["image"] for item in items if item["image"]}:
+        images.variants(image)
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        plan = _plan_menu_import(conn, items, prune)
+        if dry_run:
+            conn.rollback()
+            return plan
+        cursor.executemany(
+            "INSERT INTO menu_items (name, price, image, description) VALUES (?, ?, ?, ?)",
+            [(item["name"], item["price"], item["image"], item["description"] or "") for item in plan["add"]]
+        )
+        for field in _MENU_FIELDS:
+            # field names come from _MENU_FIELDS, never from the input
+            cursor.executemany(
+                f"UPDATE menu_items SET {field} = ? WHERE id = ?",
+                [(update["changes"][field][1], update["id"]) for update in plan["update"] if field in update["changes"]]
+            )
+        removed = [(entry["id"],) for entry in plan["remove"]]
+        cursor.executemany("DELETE FROM menu_items WHERE id = ?", removed)
+        cursor.executemany("DELETE FROM menu_search WHERE rowid = ?", removed)
+
+        names = [item["name"] for item in plan["add"]] + [update["name"] for update in plan["update"]]
+        touched = []
+        for start in range(0, len(names), 500):
+            chunk = names[start:start + 500]
+            touched += conn.execute(
+                f"SELECT id, name, description FROM menu_items WHERE name IN ({', '.join('?' * len(chunk))})", chunk
+            ).fetchall()
+        cursor.executemany("DELETE FROM menu_search WHERE rowid = ?", [(row["id"],) for row in touched])
+        cursor.executemany(
+            "INSERT INTO menu_search (rowid, name, description) VALUES (?, ?, ?)",
+            [(row["id"], _MARKUP.sub(" ", row["name"]), row["description"] or "") for row in touched]
+        )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    invalidate_menu()  # once for the whole batch
+    return plan
+
+
+# STOCK
+# menu_items.stock is the number of servings left, or NULL when the item
+# isn't counted. Checkout takes all of an order's lines off in one UPDATE
+# inside the order's own transaction (see _take_stock), so two checkouts
+# racing for the last servings serialize on SQLite's write lock and the
+# loser's order is rolled back whole, with nothing locked while the
+# customer is still filling the cart. Menu pages only see the sold_out flag
+# in the snapshot, which is refreshed when an item runs out or is restocked.
+class OutOfStock(Exception):
+    def __init__(self, items):
+        # items is a list of (item_id, name, servings left)
+        self.items = items
+        super().__init__(", ".join(f"{name} ({left} left)" for _, name, left in items))
+
+_TAKE_STOCK = (
+    "UPDATE menu_items SET stock = stock - ? * lines.qty"
+    " FROM (SELECT menu_item_id AS id, SUM(qty) AS qty FROM order_items"
+    "       WHERE order_id = ? AND menu_item_id IS NOT NULL GROUP BY 1) AS lines"
+    " WHERE menu_items.id = lines.id AND menu_items.stock IS NOT NULL"
+    " RETURNING menu_items.id, menu_items.name, menu_items.stock"
+)
+
+def _take_stock(cursor, order_id, rows, sign=1):
+    # Takes the order's lines (sign=-1 puts them back) and returns the ids of
+    # items that ran out or came back. Raises OutOfStock when any line is
+    # short; the caller rolls the order's transaction back.
+    wanted = {}
+    for row in rows:
+        wanted[row[1]] = wanted.get(row[1], 0) + row[3]
+    changed = cursor.execute(_TAKE_STOCK, (sign, order_id)).fetchall()
+    short = [(item_id, name, left + sign * wanted[item_id]) for item_id, name, left in changed if left < 0]
+    if short:
+        raise OutOfStock(short)
+    return [item_id for item_id, _, left in changed if (left <= 0) != (left + sign * wanted[item_id] <= 0)]
+
+@retry_on_busy
+def set_stock(item_id, stock=None, add=None):
+    # Staff restock: stock=N sets the count, add=N adjusts it (never below
+    # zero), stock=None with no add stops counting. Returns the new count.
     conn = get_connection()
     cursor = conn.cursor()
+    if add is not None:
+        cursor.execute(
+            "UPDATE menu_items SET stock = MAX(COALESCE(stock, 0) + ?, 0) WHERE id = ? RETURNING stock",
+            (add, item_id)
+        )
+    else:
+        cursor.execute("UPDATE menu_items SET stock = ? WHERE id = ? RETURNING stock", (stock, item_id))
+    row = cursor.fetchone()
+    conn.commit()
+    if row is None:
+        return None
+    invalidate_menu()
+    return row[0]
+
+def get_stock():
+    # {item_id: servings left} for the items being counted
+    conn = get_connection()
+    return dict(conn.execute("SELECT id, stock FROM menu_items WHERE stock IS NOT NULL ORDER BY id").fetchall())
+
+
+# MENU CACHE
+# The menu changes a few times a day but is read on nearly every request, so
+# routes read an immutable snapshot instead of querying menu_items. Writes
+# through this module drop the snapshot right away; edits made by other
+# worker processes are picked up through PRAGMA data_version, checked at most
+# once every MENU_CHECK_INTERVAL seconds on a dedicated connection (the value
+# only moves when some *other* connection commits). Any commit moves it, the
+# sessions and orders of this very process included, so a reload that finds
+# the same content keeps the current snapshot and its version: the caches
+# keyed on it (fragments, combos, search facets) survive busy traffic.
+MENU_CHECK_INTERVAL = 1.0
+
+class MenuSnapshot:
+    __slots__ = ("version", "items", "by_id", "by_name", "images", "digest")
+
+    def __init__(self, version, items, images=None):
+        self.version = version
+        self.items = tuple(items)
+        self.by_id = {item["id"]: item for item in self.items}
+        self.by_name = {item["name"]: item for item in self.items}
+        # image path -> responsive variants (images.variants), for srcset
+        self.images = images if images is not None else {}
+        # identifies the menu's content across processes (for ETags)
+        self.digest = hashlib.sha1(repr((
+            [[item[key] for key in item.keys()] for item in self.items], self.images
+        )).encode()).hexdigest()
+
+    def get(self, item_id):
+        try:
+            return self.by_id.get(int(item_id))
+        except (TypeError, ValueError):
+            return None
+
+_menu = None
+_menu_built = None  # the last snapshot loaded, kept across invalidate_menu()
+_menu_version = 0
+_menu_checked = 0.0
+_menu_lock = threading.Lock()
+_menu_watch = None
+_menu_data_version = None
+
+
+def invalidate_menu():
+    global _menu
+    _menu = None
+
+def _menu_changed_elsewhere():
+    global _menu_watch, _menu_data_version
+    if _menu_watch is None:
+        _menu_watch = sqlite3.connect(DATABASE, timeout=BUSY_TIMEOUT, check_same_thread=False)
+    data_version = _menu_watch.execute("PRAGMA data_version").fetchone()[0]
+    changed = _menu_data_version is not None and data_version != _menu_data_version
+    _menu_data_version = data_version
+    return changed
+
+def get_menu():
+    global _menu, _menu_built, _menu_version, _menu_checked
+    menu = _menu
+    if menu is not None and time.monotonic() - _menu_checked < MENU_CHECK_INTERVAL:
+        return menu
+    with _menu_lock:
+        now = time.monotonic()
+        menu = _menu
+        if menu is not None and now - _menu_checked < MENU_CHECK_INTERVAL:
+            return menu
+        if _menu_changed_elsewhere() or menu is None:
+            items = _load_menu_items()
+            menu = MenuSnapshot(_menu_version + 1, items, {
+                item["image"]: images.variants(item["image"]) for item in items if item["image"]
+            })
+            if _menu_built is not None and menu.digest == _menu_built.digest:
+                menu = _menu_built
+            else:
+                _menu_version += 1
+                _menu_built = menu
+            _menu = menu
+        _menu_checked = now
+    return menu
+
+
+# MENU SEARCH
+# menu_search is an FTS5 index over item names (markup stripped) and
+# descriptions. It uses the trigram tokenizer, so a word matches anywhere
+# inside a name: "bur" finds "Burger Steak" and "silog" finds "Tapsilog",
+# both from the index. Words shorter than MIN_SEARCH_WORD can't be looked
+# up that way and are ignored. The index is written in the same transaction
+# as the menu_items row it mirrors. Price ranges are applied in SQL, with
+# idx_menu_items_price when there are no words to match.
+# Results are rows of the menu snapshot, best match first (cheapest first
+# without a query), and are cached until the menu changes.
+SEARCH_LIMIT = 50
+MIN_SEARCH_WORD = 3
+PRICE_BANDS = (100, 150, 200, 300)  # facet boundaries in pesos
+SEARCH_CACHE_SIZE = 512  # pages and facet counts kept, per menu version
+
+_MARKUP = re.compile(r"<[^>]+>")
+_WORD = re.compile(r"\w+")
+_search_cache = OrderedDict()
+_search_lock = threading.Lock()
+
+
+def _index_menu_item(cursor, item_id, name, description):
+    # name None drops the item from the index
+    cursor.execute("DELETE FROM menu_search WHERE rowid = ?", (item_id,))
+    if name is not None:
+        cursor.execute(
+            "INSERT INTO menu_search (rowid, name, description) VALUES (?, ?, ?)",
+            (item_id, _MARKUP.sub(" ", name), description or "")
+        )
+
+def rebuild_menu_search(conn=None):
+    # Reindex every item, e.g. after menu_items was loaded with plain SQL
+    conn = conn or get_connection()
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM menu_search")
+    for row in conn.execute("SELECT id, name, description FROM menu_items").fetchall():
+        _index_menu_item(cursor, row["id"], row["name"], row["description"])
+    conn.commit()
+
+def _match_query(text):
+    # Every word must match; quoting each one keeps FTS5 syntax (AND, NEAR,
+    # *, ...) in customer input from being interpreted
+    return " ".join(f'"{word}"' for word in _WORD.findall(text.lower()) if len(word) >= MIN_SEARCH_WORD)
+
+# one column per price band, counting the rows (aliased m) that fall in it
+_BAND_COUNTS = ", ".join(
+    f"COALESCE(SUM({' AND '.join(filter(None, (low and f'm.price >= {low}', high and f'm.price < {high}')))}), 0)"
+    for low, high in zip((None,) + PRICE_BANDS, PRICE_BANDS + (None,))
+)
+
+def _band_counts(conn, menu, match):
+    # Matches per price band, in one pass; the whole menu's (match "") from
+    # the snapshot, which is quicker than SQLite stepping every row
+    if not match:
+        counts = [0] * (len(PRICE_BANDS) + 1)
+        for item in menu.items:
+            counts[bisect_right(PRICE_BANDS, item["price"])] += 1
+        return counts
+    row = conn.execute(
+        f"SELECT {_BAND_COUNTS} FROM menu_search s JOIN menu_items m ON m.id = s.rowid WHERE menu_search MATCH ?",
+        (match,)
+    ).fetchone()
+    return list(row)
+
+def _matching_ids(conn, match, prices):
+    # prices is (min, max, limit); the range and the limit are applied in SQL
+    # so only the page asked for comes back, best match first
+    if match:
+        rows = conn.execute(
+            "SELECT s.rowid FROM menu_search s JOIN menu_items m ON m.id = s.rowid"
+            " WHERE menu_search MATCH ? AND m.price >= ? AND m.price <= ? ORDER BY s.rank LIMIT ?",
+            (match, *prices)
+        ).fetchall()
+    else:
+        rows = conn.execute(
+            "SELECT id FROM menu_items WHERE price >= ? AND price <= ? ORDER BY price, id LIMIT ?", prices
+        ).fetchall()
+    return tuple(row[0] for row in rows)
+
+def _search_cached(key, compute):
+    # LRU of search answers keyed on the menu version: FTS5 scores every
+    # match to rank them, which on a big menu costs more than the rest of
+    # the request, and customers keep typing the same few words
+    with _search_lock:
+        if key in _search_cache:
+            _search_cache.move_to_end(key)
+            return _search_cache[key]
+    value = compute()
+    with _search_lock:
+        _search_cache[key] = value
+        while len(_search_cache) > SEARCH_CACHE_SIZE:
+            _search_cache.popitem(last=False)
+    return value
+
+@retry_on_busy
+def search_menu(query="", min_price=None, max_price=None, limit=SEARCH_LIMIT, menu=None):
+    # Returns {"items": [menu rows], "facets": [{"min", "max", "count"}]};
+    # facets count the matches per price band, ignoring the price filter
+    menu = menu or get_menu()
+    conn = get_connection()
+    match = _match_query(query or "")
+    prices = (
+        -math.inf if min_price is None else min_price,
+        math.inf if max_price is None else max_price,
+        -1 if limit is None else limit,
+    )
+    ids = _search_cached((menu.version, match, prices), lambda: _matching_ids(conn, match, prices))
+    counts = _search_cached((menu.version, match), lambda: _band_counts(conn, menu, match))
+    items = [menu.by_id[item_id] for item_id in ids if item_id in menu.by_id]
+    bounds = (None,) + PRICE_BANDS + (None,)
+    return {
+        "items": items,
+        "facets": [
+            {"min": bounds[band], "max": bounds[band + 1], "count": count}
+            for band, count in enumerate(counts)
+        ],
+    }
+
+
+# ORDERS CRUD
+# Order lines live in order_items; orders.items is the old JSON / repr blob
+# and is left empty for new and migrated orders. Orders archived by
+# archive.py move, lines and all, to the same tables in the archive schema:
+# writes and the kitchen's live views only touch main, while lookups and
+# history read both (_all_orders). An order archive.py has copied but not
+# yet deleted from main is in both for a moment; lists read it from the
+# archive.
+ORDER_SCHEMAS = ("main", "archive")
+_LIVE_ORDERS = "(SELECT * FROM main.orders WHERE id NOT IN (SELECT id FROM archive.orders))"
+
+def _all_orders(select):
+    # `select` written against {orders} / {order_items}, run over the live
+    # and the archived tables as one UNION ALL; pass its parameters twice
+    return " UNION ALL ".join(
+        select.format(orders=_LIVE_ORDERS if schema == "main" else f"{schema}.orders",
+                      order_items=f"{schema}.order_items")
+        for schema in ORDER_SCHEMAS
+    )
+
+def parse_items(raw):
+    # orders.items holds JSON (confirm_checkout) or a Python repr (checkout)
+    if not raw:
+        return []
+    if not isinstance(raw, str):
+        return raw
+    try:
+        return json.loads(raw)
+    except ValueError:
+        return ast.literal_eval(raw)
+
+def _order_item_rows(order_id, items, by_name=None):
+    if by_name is None:
+        by_name = get_menu().by_name
+    rows = []
+    for item in items:
+        menu_item_id = item.get("id")
+        if menu_item_id is None and item.get("name") in by_name:
+            menu_item_id = by_name[item["name"]]["id"]
+        qty = int(item.get("qty", 0))
+        unit_price = item.get("price")
+        if unit_price is None:
+            unit_price = item.get("subtotal", 0) / qty if qty else 0
+        rows.append((order_id, menu_item_id, item.get("name", ""), qty, unit_price))
+    return rows
+
+def _insert_order(cursor, order_id, user_id, items, total, status, checkout_key=None):
+    # Returns the ids of menu items this order sold out
+    if checkout_key:
+        _claim_checkout_key(cursor, checkout_key, order_id, user_id)
     cursor.execute(
-        "INSERT INTO orders (user_id, items, total, status) VALUES (?, ?, ?, ?)",
-        (user_id, items, total, status)
+        "INSERT INTO orders (id, user_id, items, total, status) VALUES (?, ?, '', ?, ?)",
+        (order_id, user_id, total, status)
     )
-    conn.commit()
-    conn.close()
+    rows = _order_item_rows(order_id, items)
+    cursor.executemany(
+        "INSERT INTO order_items (order_id, menu_item_id, name, qty, unit_price) VALUES (?, ?, ?, ?, ?)",
+        rows
+    )
+    sold_out = _take_stock(cursor, order_id, rows) if status not in analytics.EXCLUDED_STATUSES else []
+    analytics.add_order(cursor, order_id)
+    return sold_out
 
+def _publish_order_created(order_id, user_id, items, total, status):
+    events.publish("order_created", {
+        "id": order_id,
+        "user_id": user_id,
+        "total": total,
+        "status": status,
+        "items": [{"name": item.get("name", ""), "qty": item.get("qty", 0)} for item in items],
+    })
+
+def create_order(user_id, items, total, status="pending", order_id=None, checkout_key=None):
+    # items is a list of cart line dicts (a JSON string is still accepted).
+    # Returns the committed order id once it is durable on disk. order_id is
+    # normally a number reserved earlier with get_next_order_number() so the
+    # customer saw it up front. Raises OrderQueueFull under backpressure,
+    # OutOfStock when a counted item doesn't have enough servings left and
+    # DuplicateCheckout when checkout_key was already used.
+    return order_writer.submit(user_id, items, total, status, order_id, checkout_key).result(ORDER_COMMIT_TIMEOUT)
+
+@retry_on_busy
+def create_order_direct(user_id, items, total, status="pending", order_id=None, checkout_key=None):
+    # One order, one transaction, on the calling thread; for scripts that
+    # shouldn't start the writer thread, and the baseline in benchmark.py
+    items = parse_items(items)
+    order_id = order_id or get_next_order_number()
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            sold_out = _insert_order(cursor, order_id, user_id, items, total, status, checkout_key)
+        except sqlite3.IntegrityError as e:
+            if not _order_number_taken(e):
+                raise
+            # the reserved number was taken by an insert that bypassed the
+            # sequence; fall back to a fresh one rather than failing checkout
+            conn.rollback()
+            order_id = get_next_order_number()
+            cursor.execute("BEGIN IMMEDIATE")
+            sold_out = _insert_order(cursor, order_id, user_id, items, total, status, checkout_key)
+        conn.commit()
+    except Exception:
+        if conn.in_transaction:
+            conn.rollback()
+        raise
+    if sold_out:
+        invalidate_menu()
+    if checkout_key:
+        _remember_checkout(checkout_key, order_id, user_id)
+    _publish_order_created(order_id, user_id, items, total, status)
+    return order_id
+
+@retry_on_busy
 def get_orders():
     conn = get_connection()
     cursor = conn.cursor()
     cursor.execute("SELECT * FROM orders")
     orders = cursor.fetchall()
-    conn.close()
     return orders
 
+@retry_on_busy
+def get_order(order_id):
+    conn = get_connection()
+    cursor = conn.cursor()
+    for schema in ORDER_SCHEMAS:
+        cursor.execute(f"SELECT * FROM {schema}.orders WHERE id = ?", (order_id,))
+        order = cursor.fetchone()
+        if order is not None:
+            return order
+    return None
+
+@retry_on_busy
+def get_order_items(order_id):
+    conn = get_connection()
+    cursor = conn.cursor()
+    for schema in ORDER_SCHEMAS:
+        cursor.execute(
+            "SELECT oi.menu_item_id AS id, oi.name, oi.qty, oi.unit_price AS price,"
+            " oi.qty * oi.unit_price AS subtotal, m.image"
+            f" FROM {schema}.order_items oi LEFT JOIN main.menu_items m ON m.id = oi.menu_item_id"
+            " WHERE oi.order_id = ? ORDER BY oi.rowid",
+            (order_id,)
+        )
+        items = cursor.fetchall()
+        if items:
+            break
+    return items
+
+@retry_on_busy
+def get_items_for_orders(order_ids):
+    # One query for a whole page of orders instead of one per order
+    items = {order_id: [] for order_id in order_ids}
+    if not items:
+        return items
+    conn = get_connection()
+    cursor = conn.cursor()
+    for schema in reversed(ORDER_SCHEMAS):
+        # an order's lines are all in the same schema as the order, or in
+        # both while archive.py moves it; the archived ones are read first
+        missing = [order_id for order_id, lines in items.items() if not lines]
+        if not missing:
+            break
+        cursor.execute(
+            "SELECT order_id, menu_item_id AS id, name, qty, unit_price AS price,"
+            " qty * unit_price AS subtotal"
+            f" FROM {schema}.order_items WHERE order_id IN ({', '.join('?' * len(missing))}) ORDER BY rowid",
+            missing
+        )
+        for row in cursor:
+            items[row["order_id"]].append(row)
+    return items
+
+@retry_on_busy
+def get_orders_for_day(day):
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        _all_orders("SELECT * FROM {orders} WHERE created_at >= date(?) AND created_at < date(?, '+1 day')")
+        + " ORDER BY id",
+        (day, day) * 2
+    )
+    orders = cursor.fetchall()
+    return orders
+
+@retry_on_busy
+def get_pending_orders_since(since):
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT * FROM orders WHERE status = 'pending' AND created_at >= ? ORDER BY created_at",
+        (since,)
+    )
+    orders = cursor.fetchall()
+    return orders
+
+@retry_on_busy
+def get_orders_for_user(user_id, limit=50):
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        _all_orders("SELECT * FROM {orders} WHERE user_id = ?") + " ORDER BY created_at DESC LIMIT ?",
+        (user_id, user_id, limit)
+    )
+    orders = cursor.fetchall()
+    return orders
+
+@retry_on_busy
+def get_top_sellers(day, limit=10):
+    conn = get_connection()
+    cursor = conn.cursor()
+    lines = _all_orders(
+        "SELECT oi.menu_item_id, oi.name, oi.qty, oi.unit_price"
+        " FROM {orders} o JOIN {order_items} oi ON oi.order_id = o.id"
+        " WHERE o.created_at >= date(?) AND o.created_at < date(?, '+1 day')"
+    )
+    cursor.execute(
+        "SELECT menu_item_id AS id, name, SUM(qty) AS units, SUM(qty * unit_price) AS revenue"
+        f" FROM ({lines}) GROUP BY menu_item_id, name ORDER BY units DESC LIMIT ?",
+        (day, day) * 2 + (limit,)
+    )
+    sellers = cursor.fetchall()
+    return sellers
+
+@retry_on_busy
+def get_item_popularity(since):
+    # {menu_item_id: units sold since `since`}, for ranking budget combos
+    conn = get_connection()
+    cursor = conn.cursor()
+    lines = _all_orders(
+        "SELECT oi.menu_item_id, oi.qty FROM {orders} o JOIN {order_items} oi ON oi.order_id = o.id"
+        " WHERE o.created_at >= ? AND oi.menu_item_id IS NOT NULL"
+    )
+    cursor.execute(f"SELECT menu_item_id, SUM(qty) FROM ({lines}) GROUP BY menu_item_id", (since,) * 2)
+    popularity = dict(cursor.fetchall())
+    return popularity
+
+@retry_on_busy
+def get_sales_report(start, end, by="day", limit=10):
+    # Read from the analytics rollups only; start and end are UTC dates
+    conn = get_connection()
+    return {
+        "summary": analytics.summary(conn, start, end),
+        "periods": analytics.sales(conn, start, end, by),
+        "items": analytics.top_items(conn, start, end, limit),
+    }
+
+@retry_on_busy
 def update_order(order_id, status):
+    # Cancelling an order puts its servings back; un-cancelling takes them
+    # again and raises OutOfStock if they are gone
     conn = get_connection()
     cursor = conn.cursor()
-    cursor.execute("UPDATE orders SET status = ? WHERE id = ?", (status, order_id))
-    conn.commit()
-    conn.close()
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        row = cursor.execute("SELECT status FROM orders WHERE id = ?", (order_id,)).fetchone()
+        changed = []
+        if row is not None:
+            was_sale = row["status"] not in analytics.EXCLUDED_STATUSES
+            if was_sale != (status not in analytics.EXCLUDED_STATUSES):
+                rows = cursor.execute(
+                    "SELECT order_id, menu_item_id, name, qty, unit_price FROM order_items WHERE order_id = ?",
+                    (order_id,)
+                ).fetchall()
+                changed = _take_stock(cursor, order_id, rows, -1 if was_sale else 1)
+        analytics.remove_order(cursor, order_id)  # recounted under the new status
+        cursor.execute("UPDATE orders SET status = ? WHERE id = ?", (status, order_id))
+        analytics.add_order(cursor, order_id)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    if changed:
+        invalidate_menu()
+    if row is not None:
+        events.publish("order_updated", {"id": order_id, "status": status})
 
+@retry_on_busy
 def delete_order(order_id):
     conn = get_connection()
     cursor = conn.cursor()
+    analytics.remove_order(cursor, order_id)
+    cursor.execute("DELETE FROM order_items WHERE order_id = ?", (order_id,))
     cursor.execute("DELETE FROM orders WHERE id = ?", (order_id,))
     conn.commit()
-    conn.close()
+    if cursor.rowcount:
+        events.publish("order_deleted", {"id": order_id})
 
 
 # ORDER UTILS
+# Order numbers come from an order_sequence row. Each process reserves a
+# block of ORDER_BLOCK_SIZE numbers in one short IMMEDIATE transaction and
+# then hands them out from memory, so numbers are unique across threads and
+# worker processes without a MAX(id) scan per page view. Numbers left in a
+# block when a process exits are simply skipped.
+ORDER_BLOCK_SIZE = 20
+
+@retry_on_busy
+def _reserve_order_block(size):
+    conn = get_connection()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS order_sequence ("
+            " name TEXT PRIMARY KEY,"
+            " next_id INTEGER NOT NULL)"
+        )
+        row = conn.execute(
+            "SELECT MAX(COALESCE((SELECT next_id FROM order_sequence WHERE name = 'orders'), 1),"
+            " (SELECT COALESCE(MAX(id), 0) + 1 FROM main.orders),"
+            " (SELECT COALESCE(MAX(id), 0) + 1 FROM archive.orders))"
+        ).fetchone()
+        start = row[0]
+        conn.execute(
+            "INSERT INTO order_sequence (name, next_id) VALUES ('orders', ?) "
+            "ON CONFLICT(name) DO UPDATE SET next_id = excluded.next_id",
+            (start + size,)
+        )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return start, start + size
+
+class OrderSequence:
+    def __init__(self, block_size=ORDER_BLOCK_SIZE):
+        self.block_size = block_size
+        self._next = 0
+        self._limit = 0
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def next(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                # forked worker: the parent's block isn't ours to hand out
+                self._next = self._limit = 0
+                self._pid = os.getpid()
+            if self._next >= self._limit:
+                self._next, self._limit = _reserve_order_block(self.block_size)
+            number = self._next
+            self._next += 1
+            return number
+
+_order_sequence = OrderSequence()
+
+
 def get_next_order_number():
+    return _order_sequence.next()
+
+
+# CHECKOUT KEYS
+# The confirm page carries a random idempotency key, and the order that
+# claims it records it in checkout_keys inside its own transaction (see
+# _claim_checkout_key). A double tap or a browser retry of the same
+# submission then finds the key taken and gets DuplicateCheckout with the
+# first order's id instead of a second order, however the submits race:
+# claims serialize on SQLite's write lock, across threads and worker
+# processes alike. Keys expire after CHECKOUT_KEY_TTL seconds. Each process
+# also remembers the keys it has seen recently, so a replay is usually
+# answered without a query or a trip through the order writer.
+CHECKOUT_KEY_TTL = 1800
+CHECKOUT_KEY_CACHE = 1024
+CHECKOUT_KEY_PURGE_INTERVAL = 600
+
+_checkout_keys = {}  # key -> (order_id, user_id, expires)
+_checkout_keys_lock = threading.Lock()
+_last_key_purge = 0.0
+
+
+class DuplicateCheckout(Exception):
+    def __init__(self, order_id, user_id):
+        self.order_id = order_id
+        self.user_id = user_id
+        super().__init__(f"already checked out as order {order_id}")
+
+
+def _remember_checkout(key, order_id, user_id, expires=None):
+    with _checkout_keys_lock:
+        _checkout_keys.pop(key, None)
+        _checkout_keys[key] = (order_id, user_id, expires or time.time() + CHECKOUT_KEY_TTL)
+        while len(_checkout_keys) > CHECKOUT_KEY_CACHE:
+            del _checkout_keys[next(iter(_checkout_keys))]
+
+def _claim_checkout_key(cursor, key, order_id, user_id):
+    # Called with the order's transaction open; a key past its TTL is taken over
+    global _last_key_purge
+    now = time.time()
+    cursor.execute(
+        "INSERT INTO checkout_keys (key, order_id, user_id, created_at) VALUES (?, ?, ?, ?)"
+        " ON CONFLICT(key) DO UPDATE SET order_id = excluded.order_id, user_id = excluded.user_id,"
+        " created_at = excluded.created_at WHERE created_at < ?",
+        (key, order_id, user_id, now, now - CHECKOUT_KEY_TTL)
+    )
+    if cursor.rowcount == 0:
+        row = cursor.execute("SELECT order_id, user_id FROM checkout_keys WHERE key = ?", (key,)).fetchone()
+        raise DuplicateCheckout(row[0], row[1])
+    if now - _last_key_purge > CHECKOUT_KEY_PURGE_INTERVAL:
+        _last_key_purge = now
+        cursor.execute("DELETE FROM checkout_keys WHERE created_at < ?", (now - CHECKOUT_KEY_TTL,))
+
+@retry_on_busy
+def find_checkout(key):
+    # (order_id, user_id) of the order that already used this key, or None
+    now = time.time()
+    with _checkout_keys_lock:
+        seen = _checkout_keys.get(key)
+    if seen and seen[2] > now:
+        return seen[:2]
+    row = get_connection().execute(
+        "SELECT order_id, user_id, created_at FROM checkout_keys WHERE key = ? AND created_at >= ?",
+        (key, now - CHECKOUT_KEY_TTL)
+    ).fetchone()
+    if row is None:
+        return None
+    _remember_checkout(key, row[0], row[1], row[2] + CHECKOUT_KEY_TTL)
+    return row[0], row[1]
+
+
+# ORDER WRITER
+# Checkouts hand their order to one writer thread through a bounded queue.
+# The writer takes everything queued behind the first order (up to
+# ORDER_GROUP_SIZE) and commits it as one transaction, so a burst of
+# checkouts shares a single fsync and a single trip through SQLite's write
+# lock instead of queueing on it one by one. Its connection runs with
+# synchronous = FULL: create_order() returns only after the commit is on
+# disk. When the queue stays full for ORDER_SUBMIT_TIMEOUT, submit() raises
+# OrderQueueFull and the caller should ask the customer to retry.
+ORDER_QUEUE_SIZE = 256
+ORDER_GROUP_SIZE = 64
+ORDER_SUBMIT_TIMEOUT = 2.0
+ORDER_COMMIT_TIMEOUT = 10.0
+ORDER_RETRY_ROUNDS = 3  # fresh numbers tried before an order fails
+
+
+class OrderQueueFull(Exception):
+    pass
+
+
+def _order_number_taken(error):
+    # the only IntegrityError worth another number; anything else (a NOT
+    # NULL or CHECK failure, ...) would fail the same way again
+    return "orders.id" in str(error)
+
+
+class _PendingOrder:
+    __slots__ = ("future", "user_id", "items", "total", "status", "order_id", "checkout_key")
+
+    def __init__(self, user_id, items, total, status, order_id, checkout_key=None):
+        self.future = Future()
+        self.user_id = user_id
+        self.items = items
+        self.total = total
+        self.status = status
+        self.order_id = order_id
+        self.checkout_key = checkout_key
+
+
+class OrderWriter:
+    def __init__(self, queue_size=ORDER_QUEUE_SIZE, group_size=ORDER_GROUP_SIZE):
+        self.queue_size = queue_size
+        self.group_size = group_size
+        self._queue = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                # first use, or a forked worker that didn't inherit the thread
+                self._queue = queue.Queue(self.queue_size)
+                self._pid = os.getpid()
+                threading.Thread(target=self._run, args=(self._queue,), name="order-writer", daemon=True).start()
+        return self._queue
+
+    def submit(self, user_id, items, total, status="pending", order_id=None, checkout_key=None):
+        # Returns a Future for the committed order id
+        order = _PendingOrder(user_id, parse_items(items), total, status, order_id, checkout_key)
+        try:
+            self._start().put(order, timeout=ORDER_SUBMIT_TIMEOUT)
+        except queue.Full:
+            raise OrderQueueFull() from None
+        return order.future
+
+    def _run(self, orders):
+        conn = None
+        database = None
+        while True:
+            group = [orders.get()]
+            while len(group) < self.group_size:
+                try:
+                    group.append(orders.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                if conn is None or database != DATABASE:
+                    if conn is not None:
+                        conn.close()
+                    database = DATABASE
+                    conn = _connect()
+                    conn.execute("PRAGMA synchronous = FULL")
+                self._commit(conn, group)
+            except Exception as e:
+                for order in group:
+                    if not order.future.done():
+                        order.future.set_exception(e)
+
+    def _commit(self, conn, group):
+        for _ in range(ORDER_RETRY_ROUNDS):
+            if not group:
+                return
+            # numbers are reserved before BEGIN: the sequence takes its own
+            # write lock, which this connection would otherwise be holding
+            for order in group:
+                if order.order_id is None:
+                    order.order_id = get_next_order_number()
+            retry = self._write(conn, group)
+            for order in group:
+                if order.future.done() or order in retry:
+                    continue
+                if order.checkout_key:
+                    _remember_checkout(order.checkout_key, order.order_id, order.user_id)
+                _publish_order_created(order.order_id, order.user_id, order.items, order.total, order.status)
+                order.future.set_result(order.order_id)
+            group = retry
+        for order in group:
+            order.future.set_exception(sqlite3.IntegrityError("no free order number after retrying"))
+
+    def _write(self, conn, group):
+        # One transaction for the whole group. Each order has a savepoint: one
+        # whose reserved number was taken by an insert that bypassed the
+        # sequence is rolled back and returned for another round with a fresh
+        # number, and one that fails outright fails alone.
+        for attempt in range(BUSY_RETRIES):
+            retry = []
+            failed = []
+            try:
+                cursor = conn.cursor()
+                cursor.execute("BEGIN IMMEDIATE")
+                sold_out = False
+                for order in group:
+                    cursor.execute("SAVEPOINT pending_order")
+                    try:
+                        if _insert_order(cursor, order.order_id, order.user_id, order.items, order.total, order.status,
+                                         order.checkout_key):
+                            sold_out = True
+                    except sqlite3.IntegrityError as e:
+                        cursor.execute("ROLLBACK TO pending_order")
+                        if _order_number_taken(e):
+                            order.order_id = None
+                            retry.append(order)
+                        else:
+                            failed.append((order, e))
+                    except sqlite3.OperationalError:
+                        raise
+                    except Exception as e:
+                        cursor.execute("ROLLBACK TO pending_order")
+                        failed.append((order, e))
+                    cursor.execute("RELEASE pending_order")
+                conn.commit()
+                if sold_out:
+                    invalidate_menu()
+                for order, e in failed:
+                    order.future.set_exception(e)
+                return retry
+            except sqlite3.OperationalError as e:
+                if conn.in_transaction:
+                    conn.rollback()
+                if ("locked" not in str(e) and "busy" not in str(e)) or attempt == BUSY_RETRIES - 1:
+                    raise
+                time.sleep(BUSY_BACKOFF * (2 ** attempt))
+
+order_writer = OrderWriter()
+
+
+# SCHEMA MIGRATIONS
+# PRAGMA user_version records the last migration applied; migrate() is cheap
+# to call on every start once the database is current.
+MIGRATION_CHUNK = 500
+
+def _migrate_order_items(conn):
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS order_items ("
+        " order_id INTEGER NOT NULL REFERENCES orders(id),"
+        " menu_item_id INTEGER,"
+        " name TEXT NOT NULL,"
+        " qty INTEGER NOT NULL,"
+        " unit_price REAL NOT NULL)"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_order_items_order ON order_items (order_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_order_items_menu_item ON order_items (menu_item_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_status_created ON orders (status, created_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_user_created ON orders (user_id, created_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_created ON orders (created_at)")
+    conn.commit()
+
+    # Convert the blobs a chunk at a time so writers aren't blocked for long;
+    # IMMEDIATE keeps two workers migrating at once from converting a row twice
+    # names are looked up directly: the menu snapshot expects columns that
+    # later migrations add
+    by_name = {row["name"]: row for row in conn.execute("SELECT id, name FROM menu_items ORDER BY id")}
+    last_id = 0
+    while True:
+        conn.execute("BEGIN IMMEDIATE")
+        rows = conn.execute(
+            "SELECT id, items FROM orders WHERE id > ? AND items != '' ORDER BY id LIMIT ?",
+            (last_id, MIGRATION_CHUNK)
+        ).fetchall()
+        if not rows:
+            conn.rollback()
+            break
+        for row in rows:
+            try:
+                items = parse_items(row["items"])
+            except (ValueError, SyntaxError):
+                continue  # leave unreadable blobs in place
+            conn.executemany(
+                "INSERT INTO order_items (order_id, menu_item_id, name, qty, unit_price) VALUES (?, ?, ?, ?, ?)",
+                _order_item_rows(row["id"], items, by_name)
+            )
+            conn.execute("UPDATE orders SET items = '' WHERE id = ?", (row["id"],))
+        conn.commit()
+        last_id = rows[-1]["id"]
+
+def _migrate_analytics(conn):
+    analytics.create_tables(conn)
+    analytics.backfill(conn)
+
+def _migrate_menu_search(conn):
+    columns = [row["name"] for row in conn.execute("PRAGMA table_info(menu_items)")]
+    if "description" not in columns:
+        conn.execute("ALTER TABLE menu_items ADD COLUMN description TEXT NOT NULL DEFAULT ''")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_menu_items_price ON menu_items (price)")
+    conn.execute(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS menu_search USING fts5("
+        " name, description, tokenize='trigram')"
+    )
+    # names weigh more than descriptions in the ranking
+    conn.execute("INSERT INTO menu_search (menu_search, rank) VALUES ('rank', 'bm25(10.0, 1.0)')")
+    rebuild_menu_search(conn)
+
+def _migrate_stock(conn):
+    columns = [row["name"] for row in conn.execute("PRAGMA table_info(menu_items)")]
+    if "stock" not in columns:
+        conn.execute("ALTER TABLE menu_items ADD COLUMN stock INTEGER")  # NULL: not counted
+
+def _migrate_checkout_keys(conn):
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS checkout_keys ("
+        " key TEXT PRIMARY KEY,"
+        " order_id INTEGER NOT NULL,"
+        " user_id INTEGER,"
+        " created_at REAL NOT NULL) WITHOUT ROWID"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_checkout_keys_created ON checkout_keys (created_at)")
+
+def _create_archive_tables(conn):
+    # Run on every migrate(): the archive is a separate file and may be new
+    # even when the main database is current. Same columns as the live
+    # tables; archived orders are never written again.
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS archive.orders ("
+        " id INTEGER PRIMARY KEY,"
+        " user_id INTEGER,"
+        " items TEXT NOT NULL,"
+        " total REAL NOT NULL,"
+        " status TEXT,"
+        " created_at TIMESTAMP)"
+    )
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS archive.order_items ("
+        " order_id INTEGER NOT NULL,"
+        " menu_item_id INTEGER,"
+        " name TEXT NOT NULL,"
+        " qty INTEGER NOT NULL,"
+        " unit_price REAL NOT NULL)"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS archive.idx_order_items_order ON order_items (order_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS archive.idx_orders_user_created ON orders (user_id, created_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS archive.idx_orders_created ON orders (created_at)")
+
+MIGRATIONS = (
+    _migrate_order_items,
+    _migrate_analytics,
+    _migrate_menu_search,
+    _migrate_stock,
+    _migrate_checkout_keys,
+)
+# UPDATE ... RETURNING (stock) needs 3.35, the trigram tokenizer (menu
+# search) 3.34
+MIN_SQLITE_VERSION = (3, 35, 0)
+
+@retry_on_busy
+def migrate():
+    if sqlite3.sqlite_version_info < MIN_SQLITE_VERSION:
+        raise RuntimeError(
+            f"SQLite {'.'.join(map(str, MIN_SQLITE_VERSION))} or newer is needed, "
+            f"this Python has {sqlite3.sqlite_version}"
+        )
     conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT COALESCE(MAX(id), 0) + 1 AS next_id FROM orders")
-    row = cursor.fetchone()
-    conn.close()
-    return row[0] if row else 1
\ No newline at end of file
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        migration(conn)
+        conn.execute(f"PRAGMA user_version = {number}")
+        conn.commit()
+    _create_archive_tables(conn)
+    conn.commit()
+    if version < len(MIGRATIONS):
+        invalidate_menu()  # a menu loaded mid-migration has the old columns
+    return len(MIGRATIONS)
+
+
+if __name__ == "__main__":
+    print(f"Database schema at version {migrate()}")
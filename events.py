@@ -0,0 +1,143 @@
+# events.py
+# In-process pub/sub for order events, streamed to kitchen screens as
+# Server-Sent Events. Each event is formatted into its SSE frame once at
+# publish time, and the last HISTORY events are kept so a reconnecting
+# screen can resume from its Last-Event-ID instead of reloading everything.
+#
+# stream() waits for events on its own thread; astream() is the same stream
+# for the asyncio server in asgi.py, where a waiting screen is a future on
+# the event loop rather than a parked thread.
+#
+# The bus belongs to one process: a screen only hears about orders placed
+# and updated by the worker it is connected to. Run the kitchen screens
+# against a single worker (e.g. its own asgi.py process). Event ids carry a
+# per-process epoch ("<epoch>-<n>"), and a fork gets a fresh bus, so a
+# Last-Event-ID from another worker or from before a restart is never
+# mistaken for one of ours; the screen is told to reset instead.
+import asyncio
+import itertools
+import json
+import os
+import secrets
+import threading
+from collections import deque
+
+HISTORY = 1000
+HEARTBEAT = 15  # seconds between keep-alive comments on an idle stream
+
+
+class EventBus:
+    def __init__(self, history=HISTORY):
+        self.epoch = secrets.token_hex(4)
+        self._events = deque(maxlen=history)
+        self._last_id = 0
+        self._cond = threading.Condition()
+        self._waiters = []  # (loop, future) of asyncio streams
+
+    @property
+    def last_id(self):
+        return self._last_id
+
+    def parse_id(self, value):
+        # The number in a Last-Event-ID this bus sent, None without one, and
+        # -1 (which always resets) for an id from another process or epoch
+        if not value:
+            return None
+        epoch, _, number = value.partition("-")
+        if epoch != self.epoch or not number.isdigit():
+            return -1
+        return int(number)
+
+    def publish(self, event, data):
+        with self._cond:
+            self._last_id += 1
+            frame = f"id: {self.epoch}-{self._last_id}\nevent: {event}\ndata: {json.dumps(data)}\n\n"
+            self._events.append((self._last_id, frame))
+            self._cond.notify_all()
+            waiters, self._waiters = self._waiters, []
+            for loop, future in waiters:
+                loop.call_soon_threadsafe(_wake, future)
+            return self._last_id
+
+    def since(self, last_id):
+        # Frames after last_id, or None when they are no longer (or never
+        # were, e.g. after a restart) in the history and the client must reload
+        with self._cond:
+            if last_id == self._last_id:
+                return []
+            if last_id > self._last_id or not self._events or last_id < self._events[0][0] - 1:
+                return None
+            start = last_id - self._events[0][0] + 1  # ids are consecutive
+            return [frame for _, frame in itertools.islice(self._events, start, None)]
+
+    def wait(self, last_id, timeout):
+        with self._cond:
+            return self._cond.wait_for(lambda: self._last_id != last_id, timeout)
+
+    async def await_event(self, last_id, timeout):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._cond:
+            if self._last_id != last_id:
+                return True
+            self._waiters.append((loop, future))
+        try:
+            await asyncio.wait_for(future, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            with self._cond:
+                if (loop, future) in self._waiters:
+                    self._waiters.remove((loop, future))
+
+    def _next(self, last_id):
+        # (SSE text, new last_id) for what the client hasn't seen yet, or
+        # None when it is up to date
+        frames = self.since(last_id)
+        if frames is None:
+            last_id = self._last_id
+            return f"id: {self.epoch}-{last_id}\nevent: reset\ndata: {{}}\n\n", last_id
+        if frames:
+            return "".join(frames), last_id + len(frames)
+        return None
+
+    def stream(self, last_id=None, heartbeat=HEARTBEAT):
+        # Generator of SSE text for one connected client
+        if last_id is None:
+            last_id = self._last_id
+        yield "retry: 3000\n\n"
+        while True:
+            pending = self._next(last_id)
+            if pending:
+                text, last_id = pending
+                yield text
+            elif not self.wait(last_id, heartbeat):
+                yield ": keep-alive\n\n"
+
+    async def astream(self, last_id=None, heartbeat=HEARTBEAT):
+        if last_id is None:
+            last_id = self._last_id
+        yield "retry: 3000\n\n"
+        while True:
+            pending = self._next(last_id)
+            if pending:
+                text, last_id = pending
+                yield text
+            elif not await self.await_event(last_id, heartbeat):
+                yield ": keep-alive\n\n"
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
+
+
+bus = EventBus()
+# a forked worker starts with an empty bus of its own, not a copy of the
+# parent's (whose lock may have been held mid-publish)
+os.register_at_fork(after_in_child=lambda: bus.__init__(bus._events.maxlen))
+
+
+def publish(event, data):
+    return bus.publish(event, data)
@@ -0,0 +1,81 @@
+# fragments.py
+# Cached HTML for the menu grid on index and budget_mode.
+#
+# The cards only change with the menu, so they are rendered once per menu
+# version and kept in a small LRU. The one per-session value inside a card,
+# the quantity badge, is rendered as a marker and split out, so a request
+# just joins the cached pieces around its own cart quantities.
+#
+# page_etag() builds validators for those pages from the menu contents and
+# the session state they show, so a browser revalidating an unchanged page
+# gets a 304 without anything being rendered.
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+from flask import render_template
+from markupsafe import Markup
+
+CACHE_SIZE = 32
+TEMPLATE_FOLDER = "templates"
+
+_QUANTITY = "\x00"
+_CARD_END = "\x01"
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+_templates_token = None
+
+
+def _cards(menu, return_to):
+    # {item_id: (html before the quantity, html after it)}
+    key = (menu.version, return_to)
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+
+    html = render_template(
+        "menu_cards.html",
+        menu=menu.items,
+        return_to=return_to,
+        quantity=lambda item_id: Markup(f"{_QUANTITY}{item_id}{_QUANTITY}"),
+        card_end=Markup(_CARD_END),
+    )
+    cards = {}
+    for chunk in html.split(_CARD_END)[:-1]:
+        before, item_id, after = chunk.split(_QUANTITY)
+        cards[int(item_id)] = (before, after)
+
+    with _cache_lock:
+        _cache[key] = cards
+        if len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return cards
+
+def menu_grid(menu, quantity, items=None, return_to=None):
+    # quantity(item_id) -> int; items defaults to the whole menu
+    cards = _cards(menu, return_to)
+    parts = []
+    for item in menu.items if items is None else items:
+        before, after = cards[item["id"]]
+        parts += (before, str(quantity(item["id"])), after)
+    return Markup("".join(parts))
+
+
+def _templates():
+    # Changes when any template does, so a deploy never revalidates old pages
+    global _templates_token
+    if _templates_token is None:
+        stamp = hashlib.sha1()
+        for entry in sorted(os.scandir(TEMPLATE_FOLDER), key=lambda e: e.name):
+            stat = entry.stat()
+            stamp.update(f"{entry.name}:{stat.st_mtime_ns}:{stat.st_size};".encode())
+        _templates_token = stamp.hexdigest()
+    return _templates_token
+
+def page_etag(menu, *state):
+    # menu.digest rather than menu.version: versions are per process, and
+    # two workers may number the same menu differently
+    return hashlib.sha1(f"{_templates()}:{menu.digest}:{state!r}".encode()).hexdigest()
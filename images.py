@@ -0,0 +1,126 @@
+# images.py
+# Responsive variants of the menu photos.
+#
+# Every menu image is resized to a few widths, each saved as WebP and as a
+# JPEG fallback, under static/images/v/ with a hash of the source bytes in
+# the name. A changed photo gets new names, so the variants can be served
+# with an immutable, year-long cache lifetime (see /img/<name> in
+# restaurant.py). The menu cache keeps each image's srcset strings, so
+# rendering a page never touches the disk.
+#
+#   python images.py      # build variants for every menu item
+import hashlib
+import os
+import threading
+
+STATIC_FOLDER = "static"
+VARIANT_FOLDER = os.path.join(STATIC_FOLDER, "images", "v")
+WIDTHS = (160, 320, 640)
+WEBP_QUALITY = 75
+JPEG_QUALITY = 80
+
+_manifests = {}  # image path -> (mtime_ns, size, manifest)
+_lock = threading.Lock()
+
+
+def variant_name(stem, digest, width, ext):
+    return f"{stem}-{digest}-{width}.{ext}"
+
+def _save(img, path, **options):
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    img.save(tmp_path, **options)
+    os.replace(tmp_path, path)  # readers never see a half-written file
+
+def _build(source, stem, digest):
+    # Returns (width, height, widths built); the photo is only decoded
+    # when it is new or has changed
+    from PIL import Image
+
+    os.makedirs(VARIANT_FOLDER, exist_ok=True)
+    with Image.open(source) as img:
+        width, height = img.size  # from the header; no need to decode yet
+        widths = [w for w in WIDTHS if w < width] or [width]
+        if all(os.path.exists(os.path.join(VARIANT_FOLDER, variant_name(stem, digest, w, ext)))
+               for w in widths for ext in ("webp", "jpg")):
+            return width, height, widths
+        img.load()
+    if img.mode not in ("RGB", "RGBA"):
+        img = img.convert("RGBA" if "A" in img.getbands() else "RGB")
+    for w in widths:
+        resized = img.resize((w, max(1, round(height * w / width))), Image.LANCZOS) if w != width else img
+        webp = os.path.join(VARIANT_FOLDER, variant_name(stem, digest, w, "webp"))
+        if not os.path.exists(webp):
+            _save(resized, webp, format="WEBP", quality=WEBP_QUALITY, method=4)
+        jpeg = os.path.join(VARIANT_FOLDER, variant_name(stem, digest, w, "jpg"))
+        if not os.path.exists(jpeg):
+            if resized.mode == "RGBA":
+                flat = Image.new("RGB", resized.size, "white")
+                flat.paste(resized, mask=resized.getchannel("A"))
+                resized = flat
+            _save(resized, jpeg, format="JPEG", quality=JPEG_QUALITY, optimize=True, progressive=True)
+    return width, height, widths
+
+def _prune(stem, digest):
+    # drop variants of earlier versions of this photo
+    prefix = f"{stem}-"
+    for entry in os.scandir(VARIANT_FOLDER):
+        name = entry.name
+        if name.startswith(prefix) and not name.startswith(f"{prefix}{digest}-") \
+                and name[len(prefix):].count("-") == 1:
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+def variants(image):
+    # image is a path relative to static/, as stored in menu_items.image.
+    # Returns {"src", "srcset", "webp_srcset", "width", "height"} or None
+    # when the file is missing or isn't an image the pipeline can read.
+    if not image:
+        return None
+    source = os.path.join(STATIC_FOLDER, image)
+    try:
+        stat = os.stat(source)
+    except OSError:
+        return None
+    cached = _manifests.get(image)
+    if cached and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+        return cached[2]
+
+    with _lock:
+        with open(source, "rb") as f:
+            digest = hashlib.sha256(f.read()).hexdigest()[:12]
+        stem = os.path.splitext(os.path.basename(image))[0]
+        try:
+            width, height, widths = _build(source, stem, digest)
+        except (OSError, ValueError):
+            return None
+        _prune(stem, digest)
+        names = {ext: [(w, variant_name(stem, digest, w, ext)) for w in widths] for ext in ("webp", "jpg")}
+        manifest = {
+            "src": "/img/" + names["jpg"][len(widths) // 2][1],
+            "srcset": ", ".join(f"/img/{name} {w}w" for w, name in names["jpg"]),
+            "webp_srcset": ", ".join(f"/img/{name} {w}w" for w, name in names["webp"]),
+            "width": width,
+            "height": height,
+        }
+        _manifests[image] = (stat.st_mtime_ns, stat.st_size, manifest)
+    return manifest
+
+
+def main():
+    import crud
+
+    for item in crud.get_menu_items():
+        manifest = variants(item["image"])
+        if manifest is None:
+            print(f"{item['image']}: skipped")
+            continue
+        original = os.path.getsize(os.path.join(STATIC_FOLDER, item["image"]))
+        largest = manifest["webp_srcset"].rsplit(", ", 1)[-1].split()[0][len("/img/"):]
+        print(f"{item['image']}: {original / 1024:.0f}KiB -> "
+              f"{os.path.getsize(os.path.join(VARIANT_FOLDER, largest)) / 1024:.0f}KiB webp at the largest width")
+
+
+if __name__ == "__main__":
+    main()
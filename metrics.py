@@ -0,0 +1,237 @@
+# metrics.py
+# Request instrumentation, exposed as Prometheus text on /metrics.
+#
+# Every counter is sharded per thread: a thread only ever writes its own
+# lists, so the hot path takes no locks, and a scrape sums the shards. The
+# per-request state is one reusable record per thread (start time, route,
+# statement and connection counts); the SQL text is only kept when the slow
+# request log is on.
+#
+#   SLOW_REQUEST = 0.5   # log requests slower than this, with their queries
+import re
+import threading
+import time
+from bisect import bisect_left
+
+SLOW_REQUEST = None  # seconds; None turns the slow request log off
+SLOW_QUERY_LIMIT = 50  # statements kept per request for the slow log
+MAX_SHARDS = 256  # dead threads' shards are folded in past this many
+# traced SQL has its parameters inlined; keep session ids and passwords out of logs
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+BYTES_BUCKETS = (64, 128, 256, 512, 1024, 2048, 4096)
+
+
+class _Metric:
+    # Base for per-thread sharded metrics. A shard is a dict of
+    # label -> list of numbers owned by one thread.
+    kind = None
+
+    def __init__(self, name, help, label=None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self._local = threading.local()
+        self._shards = []  # (thread, shard)
+        self._retired = {}  # merged shards of threads that have exited
+        self._lock = threading.Lock()
+
+    def _new_values(self):
+        raise NotImplementedError
+
+    def _values(self, label):
+        try:
+            shard = self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            with self._lock:
+                if len(self._shards) >= MAX_SHARDS:
+                    self._fold()
+                self._shards.append((threading.current_thread(), shard))
+        values = shard.get(label)
+        if values is None:
+            values = shard[label] = self._new_values()
+        return values
+
+    def _merge(self, total, shard):
+        for label, values in list(shard.items()):
+            into = total.setdefault(label, self._new_values())
+            for i, value in enumerate(values):
+                into[i] += value
+
+    def _fold(self):
+        # called with the lock held; dead threads no longer write their shard
+        live = []
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                live.append((thread, shard))
+            else:
+                self._merge(self._retired, shard)
+        self._shards = live
+
+    def collect(self):
+        with self._lock:
+            self._fold()
+            total = {}
+            self._merge(total, self._retired)
+            for _, shard in self._shards:
+                self._merge(total, shard)
+        return total
+
+    def _labels(self, label, extra=""):
+        parts = []
+        if self.label is not None:
+            escaped = str(label).replace("\\", "\\\\").replace('"', '\\"')
+            parts.append(f'{self.label}="{escaped}"')
+        if extra:
+            parts.append(extra)
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for label, values in sorted(self.collect().items()):
+            lines.extend(self._render_values(label, values))
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_values(self):
+        return [0]
+
+    def inc(self, amount=1, label=None):
+        self._values(label)[0] += amount
+
+    def _render_values(self, label, values):
+        return [f"{self.name}{self._labels(label)} {values[0]}"]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets, label=None):
+        super().__init__(name, help, label)
+        self.buckets = buckets
+
+    def _new_values(self):
+        # one slot per bucket, one for +Inf, then the sum
+        return [0] * (len(self.buckets) + 2)
+
+    def observe(self, value, label=None):
+        values = self._values(label)
+        values[bisect_left(self.buckets, value)] += 1
+        values[-1] += value
+
+    def _render_values(self, label, values):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ("+Inf",), values):
+            cumulative += count
+            le = f'le="{bound}"'
+            lines.append(f"{self.name}_bucket{self._labels(label, le)} {cumulative}")
+        lines.append(f"{self.name}_sum{self._labels(label)} {values[-1]}")
+        lines.append(f"{self.name}_count{self._labels(label)} {cumulative}")
+        return lines
+
+
+request_seconds = Histogram("restaurant_request_seconds", "Request latency by route.", LATENCY_BUCKETS, "route")
+request_errors = Counter("restaurant_request_errors_total", "Responses with a 5xx status by route.", "route")
+sql_statements = Histogram("restaurant_sql_statements", "SQL statements executed per request.", COUNT_BUCKETS, "route")
+sql_connections = Counter("restaurant_sql_connections_total", "SQLite connections opened, by route.", "route")
+qr_seconds = Histogram("restaurant_qr_render_seconds", "Time to render one QR code PNG.", LATENCY_BUCKETS)
+pdf_seconds = Histogram("restaurant_pdf_render_seconds", "Time to render one PDF receipt.", LATENCY_BUCKETS)
+cookie_bytes = Histogram("restaurant_request_cookie_bytes", "Size of the Cookie header sent with each request.", BYTES_BUCKETS)
+session_bytes = Histogram("restaurant_session_bytes", "Size of the serialized session on each write.", BYTES_BUCKETS)
+
+METRICS = (request_seconds, request_errors, sql_statements, sql_connections,
+           qr_seconds, pdf_seconds, cookie_bytes, session_bytes)
+
+
+# PER-REQUEST RECORD
+class _Record:
+    __slots__ = ("active", "start", "route", "status", "statements", "connections", "queries")
+
+    def __init__(self):
+        self.active = False
+        self.queries = None
+
+_local = threading.local()
+
+def _record():
+    try:
+        return _local.record
+    except AttributeError:
+        _local.record = _Record()
+        return _local.record
+
+def statement(sql):
+    # sqlite3 trace callback, installed on every pooled connection
+    record = _record()
+    if record.active:
+        record.statements += 1
+        if record.queries is not None and len(record.queries) < SLOW_QUERY_LIMIT:
+            record.queries.append(sql)
+
+def connection_opened():
+    record = _record()
+    if record.active:
+        record.connections += 1
+    else:
+        sql_connections.inc(label="(none)")
+
+
+def init_app(app):
+    # Times the whole WSGI call, so session load/save and teardown count too
+    from flask import request
+
+    wsgi_app = app.wsgi_app
+
+    def instrumented(environ, start_response):
+        record = _record()
+        record.active = True
+        record.start = time.perf_counter()
+        record.route = "(unmatched)"
+        record.status = 500  # unless after_request says otherwise
+        record.statements = 0
+        record.connections = 0
+        record.queries = [] if SLOW_REQUEST is not None else None
+        cookie_bytes.observe(len(environ.get("HTTP_COOKIE", "")))
+        try:
+            return wsgi_app(environ, start_response)
+        finally:
+            record.active = False
+            elapsed = time.perf_counter() - record.start
+            request_seconds.observe(elapsed, record.route)
+            sql_statements.observe(record.statements, record.route)
+            if record.connections:
+                sql_connections.inc(record.connections, record.route)
+            if record.status >= 500:
+                request_errors.inc(label=record.route)
+            if SLOW_REQUEST is not None and elapsed >= SLOW_REQUEST:
+                app.logger.warning(
+                    "slow request %s %s (%s) %.1fms, %d statements, %d new connections:\n  %s",
+                    environ.get("REQUEST_METHOD"), environ.get("PATH_INFO"), record.route, elapsed * 1000,
+                    record.statements, record.connections,
+                    "\n  ".join(_STRING_LITERAL.sub("'?'", sql) for sql in record.queries)
+                )
+            record.queries = None
+
+    @app.after_request
+    def note_route(response):
+        record = _record()
+        if record.active:
+            # labelled without the blueprint name, as before the app factory
+            record.route = (request.endpoint or "(unmatched)").rpartition(".")[2]
+            record.status = response.status_code
+        return response
+
+    app.wsgi_app = instrumented
+
+def render():
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
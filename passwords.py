@@ -0,0 +1,127 @@
+# passwords.py
+# Password hashing with scrypt (or PBKDF2) from hashlib.
+#
+# Hashes are stored as "scrypt$n$r$p$salt$hash" / "pbkdf2_sha256$iterations$salt$hash"
+# so cost parameters can be raised later: verify() reports when a stored hash
+# is weaker than the current settings (or still plaintext) and login rehashes
+# it. KDF work runs on a small bounded executor so a burst of logins can't eat
+# every CPU the menu pages need, and a token bucket per username / IP caps
+# how much of that work a single attacker can trigger.
+import base64
+import hashlib
+import hmac
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+ALGORITHM = "scrypt"
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+PBKDF2_ITERATIONS = 600000
+SALT_BYTES = 16
+HASH_BYTES = 32
+
+KDF_WORKERS = 2
+KDF_MAX_PENDING = 16  # beyond this, logins fail fast instead of queueing
+KDF_TIMEOUT = 10
+
+
+class Busy(Exception):
+    pass
+
+
+def _b64(data):
+    return base64.b64encode(data).decode("ascii")
+
+def _scrypt(password, salt, n, r, p):
+    return hashlib.scrypt(password.encode("utf-8"), salt=salt, n=n, r=r, p=p,
+                          maxmem=256 * n * r, dklen=HASH_BYTES)
+
+def _pbkdf2(password, salt, iterations):
+    return hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, iterations, dklen=HASH_BYTES)
+
+def hash_password(password):
+    salt = os.urandom(SALT_BYTES)
+    if ALGORITHM == "scrypt":
+        digest = _scrypt(password, salt, SCRYPT_N, SCRYPT_R, SCRYPT_P)
+        return f"scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${_b64(salt)}${_b64(digest)}"
+    digest = _pbkdf2(password, salt, PBKDF2_ITERATIONS)
+    return f"pbkdf2_sha256${PBKDF2_ITERATIONS}${_b64(salt)}${_b64(digest)}"
+
+def verify_password(stored, password):
+    # Returns (matches, needs_rehash)
+    parts = stored.split("$")
+    if parts[0] == "scrypt" and len(parts) == 6:
+        n, r, p = int(parts[1]), int(parts[2]), int(parts[3])
+        digest = _scrypt(password, base64.b64decode(parts[4]), n, r, p)
+        current = ALGORITHM == "scrypt" and (n, r, p) >= (SCRYPT_N, SCRYPT_R, SCRYPT_P)
+    elif parts[0] == "pbkdf2_sha256" and len(parts) == 4:
+        iterations = int(parts[1])
+        digest = _pbkdf2(password, base64.b64decode(parts[2]), iterations)
+        current = ALGORITHM == "pbkdf2_sha256" and iterations >= PBKDF2_ITERATIONS
+    else:
+        # rows created before hashing store the password itself
+        return hmac.compare_digest(stored.encode("utf-8"), password.encode("utf-8")), True
+    matches = hmac.compare_digest(digest, base64.b64decode(parts[-1]))
+    return matches, matches and not current
+
+
+# KDF EXECUTOR
+_executor = ThreadPoolExecutor(max_workers=KDF_WORKERS, thread_name_prefix="kdf")
+_pending = threading.BoundedSemaphore(KDF_MAX_PENDING)
+
+def _run(fn, *args):
+    # hashlib releases the GIL while deriving, so the pool bounds real CPU use
+    if not _pending.acquire(blocking=False):
+        raise Busy()
+    try:
+        return _executor.submit(fn, *args).result(KDF_TIMEOUT)
+    finally:
+        _pending.release()
+
+def hash_password_async(password):
+    return _run(hash_password, password)
+
+def verify_password_async(stored, password):
+    return _run(verify_password, stored, password)
+
+_DUMMY_HASH = None
+
+def burn_verify(password):
+    # Same cost as a real check, for unknown usernames (no timing oracle)
+    global _DUMMY_HASH
+    if _DUMMY_HASH is None:
+        _DUMMY_HASH = hash_password("not a real password")
+    verify_password_async(_DUMMY_HASH, password)
+
+
+# RATE LIMITING
+class TokenBucket:
+    # `rate` tokens per second refill up to `burst`; keys are evicted LRU
+    def __init__(self, rate, burst, max_keys=10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def allow(self, key, cost=1):
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            return allowed
+
+
+# 5 attempts, then one every 12s per username; IPs get more room for NAT'd cafés
+username_limiter = TokenBucket(rate=1 / 12, burst=5)
+ip_limiter = TokenBucket(rate=1 / 2, burst=20)
@@ -0,0 +1,117 @@
+# qr.py
+# QR code rendering off the request thread.
+#
+# Images are content-addressed: the file name is a hash of the payload, so the
+# same order data is rendered once and shared by the checkout page and the PDF
+# receipt. submit() returns the key immediately; the /qr/<key>.png route (or
+# wait()) blocks only if the render hasn't finished yet. Renders run on a
+# small thread pool, or on the process pool asgi.py hands to use_executor().
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+QR_FOLDER = os.path.join("static", "qr")
+QR_WORKERS = 2
+QR_BOX_SIZE = 10  # pixels per module in the saved PNG
+QR_WAIT = 10  # seconds a request will wait for a pending render
+QR_MAX_AGE = 60 * 60 * 24
+QR_CLEANUP_INTERVAL = 60 * 10
+
+_executor = ThreadPoolExecutor(max_workers=QR_WORKERS, thread_name_prefix="qr")
+_pending = {}
+_lock = threading.Lock()
+_last_cleanup = 0.0
+
+
+def qr_key(payload):
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:32]
+
+def qr_path(key):
+    return os.path.join(QR_FOLDER, f"{key}.png")
+
+def order_payload(order_id, items, total):
+    # Shared by the success page and the PDF receipt so both use one image
+    qr_data = f"Order #{order_id}\nTotal: ₱{total:.2f}\nItems:\n"
+    for item in items:
+        qr_data += f"- {item['name']} x{item['qty']} (₱{item['subtotal']:.2f})\n"
+    return qr_data
+
+def use_executor(executor):
+    global _executor
+    _executor = executor
+
+def _render(key, payload):
+    # Returns the render time; it is recorded by the submitting process
+    path = qr_path(key)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    os.makedirs(QR_FOLDER, exist_ok=True)
+    import qrcode  # loaded on the first checkout rather than at start-up
+
+    start = time.perf_counter()
+    with open(tmp_path, "wb") as f:
+        qrcode.make(payload, box_size=QR_BOX_SIZE).save(f)
+    os.replace(tmp_path, path)  # readers never see a half-written file
+    return time.perf_counter() - start
+
+def _done(key):
+    def callback(future):
+        with _lock:
+            _pending.pop(key, None)
+        if not future.cancelled() and future.exception() is None:
+            metrics.qr_seconds.observe(future.result())
+    return callback
+
+def submit(payload):
+    key = qr_key(payload)
+    path = qr_path(key)
+    if os.path.exists(path):
+        os.utime(path)  # keep recently used images away from cleanup
+    else:
+        with _lock:
+            if key not in _pending:
+                future = _executor.submit(_render, key, payload)
+                _pending[key] = future
+                future.add_done_callback(_done(key))
+    _maybe_cleanup()
+    return key
+
+def wait(key, timeout=QR_WAIT):
+    with _lock:
+        future = _pending.get(key)
+    if future is not None:
+        future.result(timeout)
+    path = qr_path(key)
+    return path if os.path.exists(path) else None
+
+def render(payload):
+    return wait(submit(payload))
+
+def cleanup(max_age=QR_MAX_AGE):
+    cutoff = time.time() - max_age
+    removed = 0
+    try:
+        entries = list(os.scandir(QR_FOLDER))
+    except FileNotFoundError:
+        return 0
+    for entry in entries:
+        if not entry.name.endswith(".png") or not entry.is_file():
+            continue
+        try:
+            if entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+                removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
+
+def _maybe_cleanup():
+    global _last_cleanup
+    now = time.time()
+    if now - _last_cleanup < QR_CLEANUP_INTERVAL:
+        return
+    _last_cleanup = now
+    _executor.submit(cleanup)
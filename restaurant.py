@@ -1,87 +1,216 @@
-from flask import Flask, render_template, request, session, redirect, url_for, flash
-from crud import *
+from flask import Blueprint, Flask, current_app, render_template, request, session, redirect, url_for, flash, g, make_response, jsonify
+from crud import (
+    SEARCH_LIMIT, DuplicateCheckout, OrderQueueFull, OutOfStock, create_order, create_user, find_checkout,
+    get_item_popularity, get_items_for_orders, get_menu, get_next_order_number, get_order, get_order_items,
+    get_pending_orders_since, get_sales_report, get_stock, get_top_sellers, get_user_by_username, search_menu,
+    set_stock, update_user_password,
+)
+from cart import Cart
+from sessions import MemorySessionStore, ServerSessionInterface, SQLiteSessionStore
 from functools import wraps
-import qrcode
-import os
-from flask import send_file
+import crud
+import events
+import fragments
+import images
+import metrics
+import passwords
+import qr
+from suggest import suggest_combos
 import io
-from reportlab.pdfgen import canvas
-from reportlab.lib.pagesizes import letter
+import math
+import os
+import secrets
+from datetime import datetime, timedelta, timezone
+from flask import send_file, send_from_directory, Response
+from markupsafe import Markup
+
+bp = Blueprint("restaurant", __name__)
+
+
+# APP FACTORY
+# create_app() does all the expensive start-up work once: schema migrations,
+# the menu snapshot with its image variants, compiled templates and the
+# rendered menu cards. Under a pre-fork server that preloads the app
+# (gunicorn --preload "restaurant:create_app()"), the workers inherit all of
+# it; no SQLite connection is left open to cross the fork. PDF and QR
+# libraries are imported on first use, not at start-up. Order events are
+# per worker, so point kitchen screens (/orders/stream) at a single one.
+DEFAULT_CONFIG = {
+    # The session cookie is a random id, so the key only signs what Flask
+    # itself signs; set RESTAURANT_SECRET_KEY so every worker shares one
+    "SECRET_KEY": os.environ.get("RESTAURANT_SECRET_KEY"),
+    "DATABASE": crud.DATABASE,
+    "SESSION_STORE": "sqlite",  # "memory" for a single worker
+    "WARM_UP": True,
+    # /metrics answers scrapes from these addresses, and staff sessions
+    "METRICS_ALLOW": ("127.0.0.1", "::1"),
+}
+
+def create_app(config=None):
+    app = Flask(__name__)
+    app.config.update(DEFAULT_CONFIG)
+    app.config.update(config or {})
+    if not app.config["SECRET_KEY"]:
+        app.config["SECRET_KEY"] = secrets.token_hex(32)
+    crud.DATABASE = app.config["DATABASE"]
+
+    crud.init_app(app)  # return pooled SQLite connections at the end of each request
+    metrics.init_app(app)  # per-route timings and SQL counts, served on /metrics
+    # Keep carts server-side; the cookie only holds a session id.
+    store = MemorySessionStore() if app.config["SESSION_STORE"] == "memory" else SQLiteSessionStore()
+    app.session_interface = ServerSessionInterface(store)
+    app.register_blueprint(bp)
+
+    crud.migrate()
+    if app.config["WARM_UP"]:
+        warm_up(app)
+    crud.close_pool(keep_menu=True)
+    return app
+
+def warm_up(app):
+    menu = get_menu()  # loads the menu and builds any missing image variants
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+    with app.test_request_context():
+        for return_to in (None, "budget_mode"):
+            fragments.menu_grid(menu, lambda item_id: 0, return_to=return_to)
 
-app = Flask(__name__)
-app.secret_key = "legaspixyz"
-    # Removed teardown_appcontext(close_db) since close_db is not imported
 
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
         if "logged_in" not in session:
-            return redirect(url_for('login', next=request.url))
+            return redirect(url_for('.login', next=request.url))
+        return f(*args, **kwargs)
+    return decorated_function
+
+def staff_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not session.get("is_staff"):
+            return redirect(url_for('.login', next=request.url))
         return f(*args, **kwargs)
     return decorated_function
 
 
-def _ensure_cart_schema(cart_items):
-    # Ensure each cart item has price and image fields and correct subtotal
-    if not cart_items:
-        return []
-    menu_items = get_menu_items()
-    menu_index = {str(m["id"]): m for m in menu_items}
-    name_index = {m["name"]: m for m in menu_items}
-    normalized = []
-    for c in cart_items:
-        item_name = c.get("name")
-        menu_item = name_index.get(item_name)
-        price = c.get("price") if c.get("price") is not None else (menu_item["price"] if menu_item else 0)
-        image = c.get("image") if c.get("image") else (menu_item["image"] if menu_item else "")
-        qty = int(c.get("qty", 0))
-        subtotal = price * qty
-        normalized.append({
-            "id": menu_item["id"] if menu_item else None,
-            "name": item_name,
-            "qty": qty,
-            "price": price,
-            "subtotal": subtotal,
-            "image": image,
-        })
-    return normalized
-
-def _cart_summary(cart_items):
-    subtotal = sum(item["subtotal"] for item in cart_items)
-    taxes = round(subtotal * 0.12, 2)  # 12% VAT
-    total = round(subtotal + taxes, 2)
-    return subtotal, taxes, total
-
-@app.route("/")
+def _load_cart():
+    # One Cart per request, rebuilt from the compact session form
+    if "cart" not in g:
+        g.cart = Cart.from_session(session.get("cart"), get_menu())
+    return g.cart
+
+def _save_cart(cart):
+    session["cart"] = cart.to_session()
+
+def _form_quantities(field):
+    # Yield (menu_item, qty) for every "<field>_<id>" quantity posted
+    prefix = field + "_"
+    menu = get_menu()
+    for key, qty_str in request.form.items():
+        if not key.startswith(prefix):
+            continue
+        item = menu.get(key[len(prefix):])
+        try:
+            qty = int(qty_str) if qty_str else 0
+        except ValueError:
+            qty = 0
+        if item and qty > 0 and not item["sold_out"]:
+            yield item, qty
+
+def _cached_page(etag, render):
+    # Answer a matching If-None-Match with 304 instead of rendering. Pages
+    # carrying flashed messages are one-offs and get no validator.
+    if etag is None or "_flashes" in session:
+        return render()
+    if request.method == "GET" and request.if_none_match.contains(etag):
+        response = current_app.response_class(status=304)
+    else:
+        response = make_response(render())
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+def _order_number(cart):
+    # Reserve this customer's order number once there is something in the
+    # cart and keep it until checkout, so two people ordering at the same
+    # time never see the same number. A page view with an empty cart gets
+    # none: it shouldn't cost a reservation and a session row.
+    if "order_number" not in session and cart:
+        session["order_number"] = get_next_order_number()
+    return session.get("order_number")
+
+def _checkout_key():
+    # The idempotency key for this cart's checkout: issued with the confirm
+    # page, posted back with it and dropped once the order goes through
+    if "checkout_key" not in session:
+        session["checkout_key"] = secrets.token_urlsafe(16)
+    return session["checkout_key"]
+
+def _posted_checkout_key():
+    key = request.form.get("checkout_key") or session.get("checkout_key")
+    return key if key and len(key) <= 64 else None
+
+def _search_args():
+    # (query, min_price, max_price) from the query string; bad prices are ignored
+    prices = []
+    for field in ("min_price", "max_price"):
+        try:
+            prices.append(float(request.args[field]))
+        except (KeyError, ValueError):
+            prices.append(None)
+    return (request.args.get("q", "").strip()[:100], *prices)
+
+@bp.route("/")
 def index():
-    menu = get_menu_items()
-    # Normalize session cart
-    session["cart"] = _ensure_cart_schema(session.get("cart", []))
-    cart = session.get("cart", [])
-
-    # Convert sqlite3.Row to dict and include current quantity in menu listing
-    menu_list = []
-    for item in menu:
-        item_dict = dict(item)
-        item_dict["quantity"] = 0
-        for cart_item in cart:
-            if cart_item["name"] == item_dict["name"]:
-                item_dict["quantity"] = cart_item["qty"]
-                break
-        menu_list.append(item_dict)
-
-    order_number = get_next_order_number()
-    subtotal, taxes, total = _cart_summary(cart)
-
-    return render_template("index.html", menu=menu_list, cart=cart, order_number=order_number, subtotal=subtotal, taxes=taxes, total=total)
-
-@app.route("/register", methods=["GET", "POST"])
+    menu = get_menu()
+    cart = _load_cart()
+    order_number = _order_number(cart)
+    search = _search_args()
+    etag = fragments.page_etag(menu, "index", session.get("logged_in"), cart.to_session(), order_number, search)
+
+    def render():
+        results = None
+        if search != ("", None, None):
+            results = search_menu(*search, menu=menu)
+        menu_grid = fragments.menu_grid(menu, cart.qty, results and results["items"])
+        return render_template(
+            "index.html", menu_grid=menu_grid, results=results, search=search, search_limit=SEARCH_LIMIT, cart=cart,
+            order_number=order_number, subtotal=cart.subtotal, taxes=cart.taxes, total=cart.total
+        )
+    return _cached_page(etag, render)
+
+@bp.route("/api/menu/search")
+def menu_search_api():
+    # ?q=bur&min_price=100&max_price=150&limit=20 -> ranked items and price facets
+    menu = get_menu()
+    search = _search_args()
+    limit = min(request.args.get("limit", SEARCH_LIMIT, type=int), SEARCH_LIMIT)
+
+    def render():
+        results = search_menu(*search, limit=max(limit, 0), menu=menu)
+        items = []
+        for item in results["items"]:
+            items.append({
+                "id": item["id"],
+                "name": item["name"],
+                "description": item["description"],
+                "price": item["price"],
+                "image_url": _image_url(item["image"], menu.images.get(item["image"])),
+            })
+        return jsonify({"items": items, "facets": results["facets"]})
+    return _cached_page(fragments.page_etag(menu, "search", search, limit), render)
+
+@bp.route("/register", methods=["GET", "POST"])
 def register():
     if request.method == "POST":
         username = request.form.get("username")
         password = request.form.get("password")
         confirm_password = request.form.get("confirm_password")
 
+        if not passwords.ip_limiter.allow(request.remote_addr):
+            return render_template("register.html", error="Too many attempts. Please wait a minute and try again."), 429
+
         # Check if passwords match
         if password != confirm_password:
             return render_template("register.html", error="Passwords do not match")
@@ -92,432 +221,472 @@ def register():
             return render_template("register.html", error="Username already taken")
 
         # Create the user
-        create_user(username, password, is_staff=0)
+        try:
+            create_user(username, passwords.hash_password_async(password), is_staff=0)
+        except (passwords.Busy, TimeoutError):
+            return render_template("register.html", error="We're busy right now, please try again."), 503
 
         flash("Registration successful! Please log in.")
-        return redirect(url_for("login"))
+        return redirect(url_for(".login"))
 
     return render_template("register.html")
 
-@app.route("/add_item", methods=["POST"])
+@bp.route("/add_item", methods=["POST"])
 def add_item():
-    items = []
-    total = float(request.form.get("total", 0))
-    for item in get_menu_items():
-        item_id = str(item["id"])
-        name = request.form.get(f"item_name_{item_id}")
-        qty = request.form.get(f"item_qty_{item_id}")
-        subtotal = request.form.get(f"item_subtotal_{item_id}")
-        image = request.form.get(f"item_image_{item_id}")
-        if name and qty and subtotal and image:
-            try:
-                qty = int(qty)
-                subtotal = float(subtotal)
-            except ValueError:
-                continue
-            items.append({"name": name, "qty": qty, "subtotal": subtotal, "image": image})
-    if "cart" not in session:
-        session["cart"] = []
-    cart = session["cart"]
-    for item in items:
-        found = False
-        for cart_item in cart:
-            if cart_item["name"] == item["name"]:
-                cart_item["qty"] += item["qty"]
-                cart_item["subtotal"] += item["subtotal"]
-                found = True
-                break
-        if not found:
-            cart.append(item)
-    session["cart"] = cart
-    session.modified = True
-    return redirect(url_for("cart"))
-
-@app.route("/add_single_item", methods=["POST"])
+    _apply_cart_ops([{"item_id": item["id"], "delta": qty} for item, qty in _form_quantities("item_qty")])
+    return redirect(url_for(".cart"))
+
+@bp.route("/add_single_item", methods=["POST"])
 def add_single_item():
-    item_id = request.form.get("item_id")
-    name = request.form.get("item_name")
-    price = request.form.get("item_price")
+    item = get_menu().get(request.form.get("item_id")) or get_menu().by_name.get(request.form.get("item_name"))
     qty = request.form.get("quantity")
-    image = request.form.get("item_image")
     
-    if name and price and qty and image:
+    if item and qty and not item["sold_out"]:
         try:
             qty = int(qty)
-            price = float(price)
-            subtotal = qty * price
         except ValueError:
-            return redirect(url_for("index"))
-        
-        if "cart" not in session:
-            session["cart"] = []
+            return redirect(url_for(".index"))
         
-        cart = session["cart"]
-        found = False
-        for cart_item in cart:
-            if cart_item["name"] == name:
-                cart_item["qty"] += qty
-                cart_item["price"] = price
-                cart_item["image"] = image
-                cart_item["subtotal"] = cart_item["qty"] * price
-                found = True
-                break
-        
-        if not found:
-            cart.append({"name": name, "qty": qty, "price": price, "subtotal": subtotal, "image": image})
-        
-        session["cart"] = cart
-        session.modified = True
+        # the line is priced from the menu, never from the posted item_price
+        cart = _load_cart()
+        cart.add(item, qty)
+        _save_cart(cart)
     
-    return redirect(url_for("cart"))
+    return redirect(url_for(".cart"))
 
-@app.route("/update_cart", methods=["POST"])
+@bp.route("/update_cart", methods=["POST"])
 def update_cart():
-    item_id = request.form.get("item_id")
-    change = int(request.form.get("change", 0))
-    return_to = request.form.get("return_to")
-    
-    if not item_id or change == 0:
-        return redirect(url_for("index"))
-    
-    # Get the menu item details
-    menu_items = get_menu_items()
-    item = None
-    for menu_item in menu_items:
-        if str(menu_item["id"]) == str(item_id):
-            item = menu_item
-            break
-    
-    if not item:
-        return redirect(url_for("index"))
-    
-    if "cart" not in session:
-        session["cart"] = []
-    
-    cart = session["cart"]
-    found = False
-    
-    # Find existing item in cart
-    for cart_item in cart:
-        if cart_item["name"] == item["name"]:
-            new_qty = cart_item["qty"] + change
-            if new_qty <= 0:
-                # Remove item from cart if quantity becomes 0 or negative
-                cart.remove(cart_item)
-            else:
-                # Update quantity and subtotal
-                cart_item["qty"] = new_qty
-                cart_item["price"] = item["price"]
-                cart_item["image"] = item["image"]
-                cart_item["subtotal"] = new_qty * item["price"]
-            found = True
-            break
-    
-    # If item not in cart and we're adding (change > 0)
-    if not found and change > 0:
-        cart.append({
-            "name": item["name"],
-            "qty": change,
-            "price": item["price"],
-            "subtotal": change * item["price"],
-            "image": item["image"]
-        })
-    
-    session["cart"] = cart
-    session.modified = True
-    
-    if return_to == "budget_mode":
+    # Form fallback for the +/- buttons; with JavaScript they use /api/cart
+    try:
+        change = int(request.form.get("change", 0))
+    except ValueError:
+        change = 0
+    if change:
+        _apply_cart_ops([{"item_id": request.form.get("item_id"), "delta": change}])
+    if request.form.get("return_to") == "budget_mode":
         # Return to budget mode without enforcing budget yet; enforcement happens on Order
-        return redirect(url_for("budget_mode"))
-    return redirect(url_for("index"))
+        return redirect(url_for(".budget_mode"))
+    return redirect(url_for(".index"))
 
-@app.route("/remove_item", methods=["POST"])
+@bp.route("/remove_item", methods=["POST"])
 def remove_item():
-    name = request.form.get("item_name")
-    if not name:
-        return redirect(url_for("index"))
-    cart = session.get("cart", [])
-    cart = [c for c in cart if c.get("name") != name]
-    session["cart"] = cart
-    session.modified = True
-    return redirect(url_for("index"))
+    item = get_menu().get(request.form.get("item_id")) or get_menu().by_name.get(request.form.get("item_name"))
+    if item:
+        _apply_cart_ops([{"item_id": item["id"], "qty": 0}])
+    return redirect(url_for(".index"))
 
 
-@app.route("/budget_mode", methods=["GET", "POST"])
+# CART API
+def _apply_cart_ops(ops):
+    # Shared by the form routes and /api/cart; returns the touched item ids,
+    # or None when the batch was rejected (the cart is left unchanged)
+    cart = _load_cart()
+    try:
+        touched = cart.apply(ops, get_menu())
+    except ValueError:
+        return None
+    _save_cart(cart)
+    return touched
+
+def _image_url(image, variants):
+    # None for an item without a photo
+    if variants:
+        return variants["src"]
+    return url_for("static", filename=image) if image else None
+
+def _cart_delta(cart, item_ids):
+    delta = cart.delta(item_ids)
+    for line in delta["lines"]:
+        if line["qty"]:
+            line["image_url"] = _image_url(line["image"], images.variants(line["image"]))
+    return delta
+
+@bp.route("/api/cart", methods=["GET", "POST"])
+def cart_api():
+    # GET: the whole cart. POST {"ops": [{"item_id": 3, "delta": 1}, ...]}:
+    # applies the batch and returns only the touched lines and the totals.
+    cart = _load_cart()
+    if request.method == "GET":
+        response = jsonify(_cart_delta(cart, [line.id for line in cart]))
+    else:
+        # JSON only, so a plain cross-site form post can't reach it
+        if not request.is_json:
+            return jsonify({"error": "expected application/json"}), 415
+        data = request.get_json(silent=True)
+        try:
+            touched = cart.apply(data.get("ops") if isinstance(data, dict) else None, get_menu())
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        _save_cart(cart)
+        response = jsonify(_cart_delta(cart, touched))
+    response.cache_control.no_store = True
+    return response
+
+
+def _budget(value):
+    # A budget in pesos, or None for anything that isn't a finite amount >= 0
+    # ("inf", "1e400" and "nan" all get past float())
+    try:
+        budget = float(value)
+    except (TypeError, ValueError):
+        return None
+    return budget if math.isfinite(budget) and budget >= 0 else None
+
+@bp.route("/budget_mode", methods=["GET", "POST"])
 def budget_mode():
     if request.method == "POST":
-        budget = float(request.form.get("budget_value", 0))
+        budget = _budget(request.form.get("budget_value", 0))
+        if budget is None:
+            flash("Please enter a valid budget.", "danger")
+            return redirect(url_for(".index"))
         session["budget_value"] = budget
     else:
-        budget = float(session.get("budget_value", 0))
-    menu = get_menu_items()
-    session["cart"] = _ensure_cart_schema(session.get("cart", []))
-    cart = session.get("cart", [])
-    suggested = []
-    
-    for item in menu:
-        if item["price"] <= budget:
-            # Convert Row to dictionary and add current quantity
-            item_dict = dict(item)
-            item_dict["quantity"] = 0
-            for cart_item in cart:
-                if cart_item["name"] == item_dict["name"]:
-                    item_dict["quantity"] = cart_item["qty"]
-                    break
-            suggested.append(item_dict)
-    
-    order_number = get_next_order_number()
-    subtotal, taxes, total = _cart_summary(cart)
-    return render_template("budget_order.html", suggested=suggested, budget=budget, cart=cart, order_number=order_number, subtotal=subtotal, taxes=taxes, total=total)
+        budget = _budget(session.get("budget_value", 0)) or 0.0
+    menu = get_menu()
+    cart = _load_cart()
+    suggested = [item for item in menu.items if item["price"] <= budget and not item["sold_out"]]
+    popular = request.args.get("rank") == "popularity"
+    order_number = _order_number(cart)
+    etag = None
+    if not popular:  # popularity moves with every order
+        etag = fragments.page_etag(menu, "budget_mode", session.get("logged_in"), cart.to_session(), order_number, budget)
+
+    def render():
+        if popular:
+            since = (datetime.now(timezone.utc) - timedelta(days=30)).strftime("%Y-%m-%d")
+            combos = suggest_combos(menu, budget, rank="popularity", popularity=get_item_popularity(since))
+        else:
+            combos = suggest_combos(menu, budget)
+        menu_grid = fragments.menu_grid(menu, cart.qty, suggested, return_to="budget_mode")
+        return render_template("budget_order.html", suggested=suggested, menu_grid=menu_grid, combos=combos, budget=budget, cart=cart, order_number=order_number, subtotal=cart.subtotal, taxes=cart.taxes, total=cart.total)
+    return _cached_page(etag, render)
 
-@app.route("/budget_order", methods=["POST"])
+@bp.route("/budget_order", methods=["POST"])
 def budget_order():
-    budget = float(request.form.get("budget_value", 0))
-    total = 0
-    selected_items = []
-    for item in get_menu_items():
-        qty_str = request.form.get(f"quantity_{item['id']}")
-        try:
-            qty = int(qty_str) if qty_str else 0
-        except ValueError:
-            qty = 0
-        if qty > 0:
-            subtotal = qty * item["price"]
-            selected_items.append({
-                "id": item["id"],
-                "name": item["name"],
-                "qty": qty,
-                "price": item["price"],
-                "subtotal": subtotal,
-                "image": item["image"]
-            })
-            total += subtotal
-    if total > budget:
-        return render_template("budget_exceed.html", total=total, budget=budget, order=selected_items)
-    if "cart" not in session:
-        session["cart"] = []
-    cart = session["cart"]
-    for item in selected_items:
-        found = False
-        for cart_item in cart:
-            if cart_item["name"] == item["name"]:
-                cart_item["qty"] += item["qty"]
-                cart_item["subtotal"] += item["subtotal"]
-                found = True
-                break
-        if not found:
-            cart.append(item)
-    session["cart"] = cart
-    session.modified = True
-    return redirect(url_for("cart"))
-
-@app.route("/order_confirm", methods=["POST"])
+    budget = _budget(request.form.get("budget_value", 0)) or 0.0
+    selected = Cart()
+    for item, qty in _form_quantities("quantity"):
+        selected.add(item, qty)
+    if selected.subtotal > budget:
+        return render_template("budget_exceed.html", total=selected.subtotal, budget=budget, order=selected.lines(),
+                               checkout_key=_checkout_key())
+    cart = _load_cart()
+    for line in selected:
+        cart.add(line.item, line.qty)
+    _save_cart(cart)
+    return redirect(url_for(".cart"))
+
+@bp.route("/order_confirm", methods=["POST"])
 def order_confirm():
-    items = []
-    total = float(request.form.get("total", 0))
-    for item in get_menu_items():
-        item_id = str(item["id"])
-        name = request.form.get(f"item_name_{item_id}")
-        qty = request.form.get(f"item_qty_{item_id}")
-        subtotal = request.form.get(f"item_subtotal_{item_id}")
-        image = request.form.get(f"item_image_{item_id}")
-        if name and qty and subtotal and image:
-            try:
-                qty = int(qty)
-                subtotal = float(subtotal)
-            except ValueError:
-                continue
-            items.append({"name": name, "qty": qty, "subtotal": subtotal, "image": image})
-    if "cart" not in session:
-        session["cart"] = []
-    cart = session["cart"]
-    for item in items:
-        found = False
-        for cart_item in cart:
-            if cart_item["name"] == item["name"]:
-                cart_item["qty"] += item["qty"]
-                cart_item["subtotal"] += item["subtotal"]
-                found = True
-                break
-        if not found:
-            cart.append(item)
-    session["cart"] = cart
-    session.modified = True
-    return redirect(url_for("cart"))
-
-@app.route("/login", methods=["GET", "POST"])
+    _apply_cart_ops([{"item_id": item["id"], "delta": qty} for item, qty in _form_quantities("item_qty")])
+    return redirect(url_for(".cart"))
+
+@bp.route("/login", methods=["GET", "POST"])
 def login():
     if request.method == "POST":
-        username = request.form.get("username")
-        password = request.form.get("password")
+        username = request.form.get("username") or ""
+        password = request.form.get("password") or ""
+        if not (passwords.username_limiter.allow(username) and passwords.ip_limiter.allow(request.remote_addr)):
+            return render_template("login.html", error="Too many login attempts. Please wait a minute and try again."), 429
         user = get_user_by_username(username)
-        if user and user['password'] == password:
+        try:
+            if user:
+                ok, needs_rehash = passwords.verify_password_async(user['password'], password)
+            else:
+                passwords.burn_verify(password)
+                ok = needs_rehash = False
+        except (passwords.Busy, TimeoutError):
+            return render_template("login.html", error="We're busy right now, please try again."), 503
+        if ok:
+            if needs_rehash:
+                # upgrade plaintext / weaker hashes now that we know the password;
+                # with the KDF pool busy it waits for the next login
+                try:
+                    update_user_password(user['id'], passwords.hash_password_async(password))
+                except (passwords.Busy, TimeoutError):
+                    pass
+            session.regenerate()
             session["logged_in"] = True
             session["username"] = username
             session["user_id"] = user['id']
-            return redirect(url_for("index"))
+            session["is_staff"] = bool(user['is_staff'])
+            return redirect(url_for(".index"))
         else:
             return render_template("login.html", error="Invalid username or password.")
     return render_template("login.html")
 
-@app.route("/logout")
+@bp.route("/logout")
 def logout():
-    session.pop("logged_in", None)
-    session.pop("username", None)
-    return redirect(url_for("index"))
+    session.clear()
+    session.regenerate()
+    return redirect(url_for(".index"))
 
-@app.route("/cart")
+@bp.route("/cart")
 def cart():
-    return render_template("cart.html", cart=session.get("cart", []))
+    return render_template("cart.html", cart=_load_cart())
 
-@app.route("/checkout_confirm", methods=["POST"])
+@bp.route("/checkout_confirm", methods=["POST"])
 @login_required
 def checkout_confirm():
-    cart_items = session.get("cart", [])
-    if not cart_items:
-        return redirect(url_for("cart"))
+    cart = _load_cart()
+    if not cart:
+        return redirect(url_for(".cart"))
     # If budget mode is active, enforce budget before confirming
     try:
         budget_value = float(session.get("budget_value", 0))
     except (TypeError, ValueError):
         budget_value = 0
-    if budget_value > 0:
-        subtotal = sum(item['subtotal'] for item in cart_items)
-        if subtotal > budget_value:
-            return render_template("budget_exceed.html", total=subtotal, budget=budget_value, order=cart_items)
-    return render_template("checkout_confirm.html", cart=cart_items)
+    if budget_value > 0 and cart.subtotal > budget_value:
+        return render_template("budget_exceed.html", total=cart.subtotal, budget=budget_value, order=cart.lines(),
+                               checkout_key=_checkout_key())
+    return render_template("checkout_confirm.html", cart=cart, checkout_key=_checkout_key())
 
-@app.route("/confirm_checkout", methods=["POST"])
+@bp.route("/confirm_checkout", methods=["POST"])
 @login_required
 def confirm_checkout():
-    cart_items = session.get("cart", [])
-    total = sum(item['subtotal'] for item in cart_items)
+    cart = _load_cart()
+    cart_items = cart.to_list()
+    total = cart.subtotal
+
+    # A resubmitted form (double tap, browser retry) gets the first order back
+    key = _posted_checkout_key()
+    done = find_checkout(key) if key else None
+    if done:
+        return _replay_checkout(cart, key, *done)
 
     if not cart_items:
         flash("Cart is empty!", "danger")
-        return redirect(url_for("cart"))
+        return redirect(url_for(".cart"))
 
     # Save order in DB
     order_id = None
     if session.get("logged_in"):
         user_id = session.get("user_id")
         try:
-            order_id = create_order(user_id, json.dumps(cart_items), total, status="pending")
+            order_id = create_order(user_id, cart_items, total, status="pending",
+                                    order_id=session.get("order_number"), checkout_key=key)
+        except DuplicateCheckout as e:
+            # the same submission raced in on another request and won
+            return _replay_checkout(cart, key, e.order_id, e.user_id)
         except Exception as e:
-            print("DB error:", e)
-
-    # ✅ Generate QR Code with full order details
-    qr_data = f"Order #{order_id}\nTotal: ₱{total:.2f}\nItems:\n"
-    for item in cart_items:
-        qr_data += f"- {item['name']} x{item['qty']} (₱{item['subtotal']})\n"
-
-    qr_img = qrcode.make(qr_data)
-    qr_folder = os.path.join("static", "qr")
-    os.makedirs(qr_folder, exist_ok=True)
-    qr_path = os.path.join(qr_folder, f"order_{order_id or 'temp'}.png")
-    qr_img.save(qr_path)
-    
-    session["last_order"] = cart_items.copy()       
-    
-    session["cart"] = []
-    session.pop("budget_value", None)
-    session.modified = True
+            return _checkout_failed(cart, key, e)
+
+    # ✅ Generate QR Code with full order details (rendered in the background)
+    qr_key = qr.submit(qr.order_payload(order_id, cart_items, total))
+    _finish_checkout(cart, order_id)
 
     return render_template(
         "checkout_success.html",
         order=cart_items,
         total=total,
         order_id=order_id,
-        qr_image=f"/{qr_path}"
+        qr_image=url_for(".qr_image", key=qr_key)
     )
 
 
-@app.route("/checkout", methods=["POST"])
+@bp.route("/checkout", methods=["POST"])
 @login_required
 def checkout():
-    cart_items = session.get("cart", [])
-    total = sum(item['subtotal'] for item in cart_items)
+    cart = _load_cart()
+    cart_items = cart.to_list()
+    total = cart.subtotal
+    key = _posted_checkout_key()
+    done = find_checkout(key) if key else None
+    if done:
+        return _replay_checkout(cart, key, *done)
     if session.get("logged_in"):
         user_id = session.get("user_id")
         try:
-            create_order(user_id, str(cart_items), total, status="pending")
-        except Exception:
-            pass
-    session["cart"] = []
-    session.modified = True
+            create_order(user_id, cart_items, total, status="pending",
+                         order_id=session.get("order_number"), checkout_key=key)
+        except DuplicateCheckout as e:
+            return _replay_checkout(cart, key, e.order_id, e.user_id)
+        except Exception as e:
+            return _checkout_failed(cart, key, e)
+    cart.clear()
+    session.pop("order_number", None)
+    session.pop("checkout_key", None)
+    _save_cart(cart)
     return render_template("checkout_success.html", order=cart_items, total=total)
 
-@app.route("/clear_cart", methods=["POST"])
+def _checkout_failed(cart, key, error):
+    # Back to the confirm page with the cart kept, so they can adjust it or retry
+    if isinstance(error, OutOfStock):
+        # someone else got the last servings
+        short = ", ".join(f"{Markup(name).striptags()} ({left} left)" for _, name, left in error.items)
+        message, status = f"Sorry, not enough left of: {short}.", 409
+    elif isinstance(error, (OrderQueueFull, TimeoutError)):
+        # the order writer is backed up
+        message, status = "We're busy right now, please try again.", 503
+    else:
+        current_app.logger.exception("Could not save the order")
+        message, status = "We couldn't save your order, please try again.", 500
+    return render_template("checkout_confirm.html", cart=cart, checkout_key=key, error=message), status
+
+def _finish_checkout(cart, order_id):
+    if cart:
+        session["last_order"] = cart.to_session()
+    session["last_order_id"] = order_id
+    cart.clear()
+    _save_cart(cart)
+    session.pop("budget_value", None)
+    session.pop("order_number", None)
+    session.pop("checkout_key", None)
+
+def _replay_checkout(cart, key, order_id, user_id):
+    # The success page of an order already placed with this checkout key,
+    # rebuilt from the database: nothing is inserted and the QR code isn't
+    # submitted again (its key is a hash of the same payload).
+    if user_id != session.get("user_id"):
+        return "This checkout belongs to someone else", 403
+    order = get_order(order_id)
+    items = [dict(item) for item in get_order_items(order_id)]
+    if session.get("checkout_key") == key:
+        # a racing request, still holding the cart this order was placed from
+        _finish_checkout(cart, order_id)
+    return render_template(
+        "checkout_success.html",
+        order=items,
+        total=order["total"],
+        order_id=order_id,
+        qr_image=url_for(".qr_image", key=qr.qr_key(qr.order_payload(order_id, items, order["total"])))
+    )
+
+@bp.route("/orders")
+@staff_required
+def orders():
+    # Kitchen view: today's pending orders, oldest first (created_at is UTC)
+    today = datetime.now(timezone.utc).date().isoformat()
+    since = request.args.get("since") or today
+    pending = get_pending_orders_since(since)
+    items = get_items_for_orders([order["id"] for order in pending])
+    return render_template("orders.html", orders=pending, items=items, since=since,
+                           top_sellers=get_top_sellers(today, limit=5))
+
+@bp.route("/reports")
+@staff_required
+def reports():
+    # Sales from the analytics rollups; dates are UTC and inclusive
+    today = datetime.now(timezone.utc).date()
+    try:
+        start = datetime.strptime(request.args.get("start", ""), "%Y-%m-%d").date()
+    except ValueError:
+        start = today - timedelta(days=6)
+    try:
+        end = datetime.strptime(request.args.get("end", ""), "%Y-%m-%d").date()
+    except ValueError:
+        end = today
+    by = "hour" if request.args.get("by") == "hour" else "day"
+    report = get_sales_report(start.isoformat(), end.isoformat(), by)
+    return render_template("reports.html", report=report, start=start, end=end, by=by)
+
+@bp.route("/api/stock", methods=["GET", "POST"])
+@staff_required
+def stock_api():
+    # GET: {item_id: servings left} for the counted items. POST
+    # {"item_id": 3, "stock": 20} sets a count (null stops counting),
+    # {"item_id": 3, "add": 10} restocks.
+    if request.method == "POST":
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict) or get_menu().get(data.get("item_id")) is None:
+            return jsonify({"error": "expected a known item_id"}), 400
+        value = data["add"] if "add" in data else data.get("stock")
+        if isinstance(value, bool) or not (isinstance(value, int) or (value is None and "add" not in data)):
+            return jsonify({"error": "stock and add must be integers"}), 400
+        if "add" in data:
+            set_stock(data["item_id"], add=value)
+        else:
+            set_stock(data["item_id"], None if value is None else max(value, 0))
+    response = jsonify({str(item_id): left for item_id, left in get_stock().items()})
+    response.cache_control.no_store = True
+    return response
+
+@bp.route("/metrics")
+def metrics_endpoint():
+    # Route names, traffic and timings are nobody else's business
+    if request.remote_addr not in current_app.config["METRICS_ALLOW"] and not session.get("is_staff"):
+        return "Not found", 404
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+@bp.route("/orders/stream")
+@staff_required
+def orders_stream():
+    # Server-Sent Events: new orders and status changes pushed to kitchen screens
+    # screens only hear about this worker's orders, see events.py
+    last_id = events.bus.parse_id(request.headers.get("Last-Event-ID") or request.args.get("last_event_id"))
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    if "restaurant.async_stream" in request.environ:
+        # served by asgi.py from its event loop; this thread is done once
+        # the headers are out
+        request.environ["restaurant.async_stream"] = events.bus.astream(last_id)
+        return Response(iter(()), mimetype="text/event-stream", headers=headers)
+    # The generator doesn't need the request context, so the request (and its
+    # pooled connection) is torn down as soon as the stream starts
+    return Response(events.bus.stream(last_id), mimetype="text/event-stream", headers=headers)
+
+@bp.route("/clear_cart", methods=["POST"])
 def clear_cart():
-    session["cart"] = []
-    session.modified = True
-    return redirect(url_for("cart"))
+    cart = _load_cart()
+    cart.clear()
+    _save_cart(cart)
+    return redirect(url_for(".cart"))
+
 
+@bp.route("/qr/<key>.png")
+def qr_image(key):
+    if len(key) != 32 or not all(c in "0123456789abcdef" for c in key):
+        return "Not found", 404
+    try:
+        path = qr.wait(key)
+    except TimeoutError:
+        return "QR code is still rendering", 503
+    if not path:
+        return "Not found", 404
+    # content-addressed, so it can be cached forever
+    return send_file(os.path.abspath(path), mimetype="image/png", max_age=31536000)
+
+
+@bp.route("/img/<name>")
+def menu_image(name):
+    # variant names carry a hash of the photo, so they never change content
+    response = send_from_directory(os.path.abspath(images.VARIANT_FOLDER), name, max_age=31536000)
+    response.cache_control.immutable = True
+    return response
 
-@app.route("/download_receipt")
+@bp.app_template_global()
+def image_variants(image):
+    return get_menu().images.get(image)
+
+
+@bp.route("/download_receipt")
 def download_receipt():
-    cart_items = session.get("last_order")
+    cart_items = Cart.from_session(session.get("last_order"), get_menu()).to_list()
     if not cart_items:
         flash("No recent order to download.", "warning")
-        return redirect(url_for("index"))
+        return redirect(url_for(".index"))
 
-    buffer = io.BytesIO()
-    
-    # Small receipt page size
-    from reportlab.lib.pagesizes import inch
-    receipt_width = 3 * inch
-    receipt_height = 5 * inch
-
-    pdf = canvas.Canvas(buffer, pagesize=(receipt_width, receipt_height))
-    
-    pdf.setFont("Helvetica-Bold", 10)
-    # Multi-line header
-    header_lines = [
-        "THANK YOU FOR YOUR ORDER",
-        "on JM Restaurant",
-        "Give this to cashier or staff"
-    ]
-    y = receipt_height - 20
-    for line in header_lines:
-        pdf.drawString(10, y, line)
-        y -= 12  # line spacing
-
-    y -= 10  # extra space before QR code
-
-    # Generate QR code
-    import qrcode
-    qr_data = "Order Details:\n"
-    total = 0
-    for item in cart_items:
-        qr_data += f"{item['name']} x{item['qty']} - ₱{item.get('price',0)*item['qty']:.2f}\n"
-        total += item.get('price',0)*item['qty']
-
-    qr_img = qrcode.make(qr_data)
-    qr_buffer = io.BytesIO()
-    qr_img.save(qr_buffer, format="PNG")
-    qr_buffer.seek(0)
-
-    # Embed QR code
-    from reportlab.lib.utils import ImageReader
-    qr_image = ImageReader(qr_buffer)
-    pdf.drawImage(qr_image, 10, y - 120, width=100, height=100)
-    y -= 130
-
-    pdf.setFont("Helvetica", 9)
-    for item in cart_items:
-        line = f"{item['name']} x{item['qty']} - ₱{item.get('price',0)*item['qty']:.2f}"
-        pdf.drawString(10, y, line)
-        y -= 12
-
-    pdf.setFont("Helvetica-Bold", 10)
-    pdf.drawString(10, y - 10, f"Total: ₱{total:.2f}")
-
-    pdf.showPage()
-    pdf.save()
-    buffer.seek(0)
+    order = get_order(session["last_order_id"]) if session.get("last_order_id") else None
+    if order:
+        buffer = _render_receipt(order["id"], get_order_items(order["id"]), order["total"])
+    else:
+        total = sum(item["subtotal"] for item in cart_items)
+        buffer = _render_receipt(session.get("last_order_id"), cart_items, total)
 
     return send_file(buffer, as_attachment=True, download_name="receipt.pdf", mimetype="application/pdf")
 
+def _render_receipt(order_id, items, total):
+    import receipt  # reportlab is only loaded once someone wants a PDF
+
+    pool = current_app.extensions.get("render_pool")  # set by asgi.py
+    if pool is None:
+        return receipt.render(order_id, items, total)
+    # wait for the QR here: the render process can't see this process's
+    # pending renders and would draw it again
+    qr.render(qr.order_payload(order_id, items, total))
+    pdf, seconds = pool.submit(receipt.render_pdf, order_id, [dict(item) for item in items], total).result()
+    metrics.pdf_seconds.observe(seconds)
+    return io.BytesIO(pdf)
+
 # ⬇️ this should stay last
 if __name__ == "__main__":
-    app.run(debug=True)
+    create_app().run(debug=True)
@@ -0,0 +1,182 @@
+# sessions.py
+# Server-side sessions: the cookie only carries a random session id and the
+# session data lives in a store. Data is written back only when it actually
+# changed during the request (or when the TTL needs refreshing), so browsing
+# the menu doesn't re-sign and resend the cart on every response.
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+import crud
+import metrics
+
+SESSION_TTL = 60 * 60 * 24  # one day of inactivity
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, new=False, raw=None, expires=0):
+        def on_update(self):
+            self.modified = True
+            self.accessed = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.raw = raw
+        self.expires = expires
+        self.modified = False
+        self.replaces = None  # the sid given up by regenerate()
+
+    def regenerate(self):
+        # Move the data to a fresh sid and drop the old one when the response
+        # is saved. Call on login and logout, so an id planted or seen before
+        # the user's privileges changed is worthless afterwards.
+        if not self.new and self.replaces is None:
+            self.replaces = self.sid
+        self.sid = secrets.token_urlsafe(32)
+        self.new = True
+        self.raw = None
+        self.modified = True
+
+
+# STORES
+# A store maps sid -> (raw serialized data, expires timestamp).
+class MemorySessionStore:
+    # Per-process LRU with TTL eviction; fine for a single worker or tests.
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def load(self, sid):
+        with self._lock:
+            entry = self._data.get(sid)
+            if entry is None:
+                return None
+            if entry[1] < time.time():
+                del self._data[sid]
+                return None
+            self._data.move_to_end(sid)
+            return entry
+
+    def save(self, sid, raw, expires):
+        with self._lock:
+            self._data[sid] = (raw, expires)
+            self._data.move_to_end(sid)
+            now = time.time()
+            while self._data:
+                oldest_sid, (_, oldest_expires) = next(iter(self._data.items()))
+                if len(self._data) <= self.max_entries and oldest_expires >= now:
+                    break
+                del self._data[oldest_sid]
+
+    def delete(self, sid):
+        with self._lock:
+            self._data.pop(sid, None)
+
+
+class SQLiteSessionStore:
+    # Shared by every worker process through the app database.
+    PURGE_INTERVAL = 600
+
+    def __init__(self):
+        self._ready = None
+        self._last_purge = 0.0
+
+    def _conn(self):
+        conn = crud.get_connection()
+        if self._ready != crud.DATABASE:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                " id TEXT PRIMARY KEY,"
+                " data TEXT NOT NULL,"
+                " expires REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions (expires)")
+            conn.commit()
+            self._ready = crud.DATABASE
+        return conn
+
+    @crud.retry_on_busy
+    def load(self, sid):
+        row = self._conn().execute(
+            "SELECT data, expires FROM sessions WHERE id = ? AND expires >= ?",
+            (sid, time.time())
+        ).fetchone()
+        return (row["data"], row["expires"]) if row else None
+
+    @crud.retry_on_busy
+    def save(self, sid, raw, expires):
+        conn = self._conn()
+        conn.execute(
+            "INSERT INTO sessions (id, data, expires) VALUES (?, ?, ?) "
+            "ON CONFLICT(id) DO UPDATE SET data = excluded.data, expires = excluded.expires",
+            (sid, raw, expires)
+        )
+        now = time.time()
+        if now - self._last_purge > self.PURGE_INTERVAL:
+            self._last_purge = now
+            conn.execute("DELETE FROM sessions WHERE expires < ?", (now,))
+        conn.commit()
+
+    @crud.retry_on_busy
+    def delete(self, sid):
+        conn = self._conn()
+        conn.execute("DELETE FROM sessions WHERE id = ?", (sid,))
+        conn.commit()
+
+
+class ServerSessionInterface(SessionInterface):
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, store, ttl=SESSION_TTL):
+        self.store = store
+        self.ttl = ttl
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        entry = self.store.load(sid) if sid else None
+        if entry is None:
+            return ServerSideSession(sid=secrets.token_urlsafe(32), new=True)
+        raw, expires = entry
+        return ServerSideSession(self.serializer.loads(raw), sid=sid, raw=raw, expires=expires)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if session.accessed:
+            response.vary.add("Cookie")
+
+        if session.replaces is not None:
+            self.store.delete(session.replaces)
+        if not session:
+            if not session.new:
+                self.store.delete(session.sid)
+            if not session.new or session.replaces is not None:
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        raw = self.serializer.dumps(dict(session))
+        now = time.time()
+        # skip the write when nothing changed and the TTL is still fresh
+        if raw == session.raw and session.expires - now > self.ttl / 2:
+            return
+        metrics.session_bytes.observe(len(raw))
+        self.store.save(session.sid, raw, now + self.ttl)
+
+        if session.new or session.permanent:
+            response.set_cookie(
+                name,
+                session.sid,
+                expires=self.get_expiration_time(app, session),
+                httponly=self.get_cookie_httponly(app),
+                domain=domain,
+                path=path,
+                secure=self.get_cookie_secure(app),
+                samesite=self.get_cookie_samesite(app),
+            )
@@ -0,0 +1,119 @@
+// cart.js
+// Turns the cart's +/- and remove forms into batched /api/cart calls.
+// Clicks made within BATCH_DELAY ms go out as one request, and only the
+// touched lines and the totals come back. Without fetch() (or if a call
+// fails) the plain form posts still work.
+(function () {
+    var BATCH_DELAY = 150;
+    var MAX_BATCH = 50;
+    var api = document.currentScript.dataset.api;
+    var pending = [];
+    var timer = null;
+    var busy = false;
+
+    function money(value) {
+        return "₱ " + value.toFixed(2);
+    }
+
+    function setText(selector, text) {
+        document.querySelectorAll(selector).forEach(function (el) { el.textContent = text; });
+    }
+
+    function addLine(line) {
+        var template = document.getElementById("cart-line-template");
+        var items = document.getElementById("cart-items");
+        if (!template || !items) {
+            return;
+        }
+        var row = template.content.firstElementChild.cloneNode(true);
+        row.dataset.line = line.id;
+        var img = row.querySelector("img");
+        if (line.image_url) {
+            img.src = line.image_url;
+            img.alt = line.name;
+        } else {
+            img.remove();
+        }
+        row.querySelector(".cart-item-name").textContent = line.name;
+        row.querySelector(".cart-item-price").textContent = money(line.price);
+        row.querySelector("[data-qty-for]").dataset.qtyFor = line.id;
+        row.querySelectorAll("input[name=item_id]").forEach(function (input) { input.value = line.id; });
+        var empty = items.querySelector("[data-cart=empty]");
+        if (empty) {
+            empty.remove();
+        }
+        items.appendChild(row);
+    }
+
+    function applyDelta(delta) {
+        delta.lines.forEach(function (line) {
+            var row = document.querySelector('#cart-items [data-line="' + line.id + '"]');
+            if (!line.qty) {
+                if (row) {
+                    row.remove();
+                }
+            } else if (!row) {
+                addLine(line);
+            }
+            setText('[data-qty-for="' + line.id + '"]', line.qty);
+            row = document.querySelector('#cart-items [data-line="' + line.id + '"]');
+            if (row) {
+                row.querySelector("[data-line-subtotal]").textContent = money(line.subtotal);
+            }
+        });
+        var items = document.getElementById("cart-items");
+        if (items && !delta.count && !items.querySelector("[data-cart=empty]")) {
+            var empty = document.createElement("p");
+            empty.dataset.cart = "empty";
+            empty.textContent = "Your cart is empty.";
+            items.appendChild(empty);
+        }
+        setText("[data-cart=count]", delta.count);
+        setText("[data-cart=subtotal]", money(delta.subtotal));
+        setText("[data-cart=taxes]", money(delta.taxes));
+        setText("[data-cart=total]", money(delta.total));
+    }
+
+    function flush() {
+        if (busy || !pending.length) {
+            return;
+        }
+        busy = true;
+        var ops = pending.splice(0, MAX_BATCH);
+        fetch(api, {
+            method: "POST",
+            credentials: "same-origin",
+            headers: {"Content-Type": "application/json"},
+            body: JSON.stringify({ops: ops})
+        }).then(function (response) {
+            if (!response.ok) {
+                throw new Error("cart update failed: " + response.status);
+            }
+            return response.json();
+        }).then(applyDelta).catch(function () {
+            location.reload();  // resync with the server's cart
+        }).then(function () {
+            busy = false;
+            flush();
+        });
+    }
+
+    document.addEventListener("submit", function (event) {
+        var form = event.target;
+        var action = form.getAttribute("action") || "";
+        var itemId = form.elements.item_id ? parseInt(form.elements.item_id.value, 10) : NaN;
+        var op = null;
+        if (/\/update_cart$/.test(action) && form.elements.change) {
+            op = {item_id: itemId, delta: parseInt(form.elements.change.value, 10)};
+        } else if (/\/remove_item$/.test(action)) {
+            op = {item_id: itemId, qty: 0};
+        }
+        if (!op || isNaN(itemId) || !window.fetch) {
+            return;
+        }
+        event.preventDefault();
+        pending.push(op);
+        clearTimeout(timer);
+        timer = setTimeout(flush, BATCH_DELAY);
+    });
+})();
@@ -0,0 +1,149 @@
+# suggest.py
+# Budget combo suggestions for budget_mode.
+#
+# A bounded knapsack over integer prices: every menu item can be taken
+# 0..max_qty times and the combo total must stay within the budget. The best
+# combos are the ones that use the most of the budget; with rank="popularity"
+# those are then ordered by how many units of their items have sold.
+#
+# Prices are divided by their GCD (menus are priced in whole 5s and 10s), so a
+# 5,000 peso budget is ~1,000 DP columns rather than 500,000 centavos. The DP
+# is a reachability table kept as Python ints used as bitsets: reach[i][need]
+# has bit c set when items[i:] can add up to exactly c units while covering
+# the required groups in `need`. One shift-and-or per item and quantity
+# builds it, and every branch the combo search follows is known to complete,
+# so each combo costs O(items) to read out. Results are memoized per
+# (menu version, budget bucket, options).
+import math
+import threading
+from collections import OrderedDict
+from functools import reduce
+
+from cart import to_cents
+
+MAX_QTY = 3
+TOP_K = 3
+POPULARITY_POOL = 8  # combos considered per result when ranking by popularity
+MAX_STATES = 4000  # DP columns; beyond this prices are rounded up to coarser units
+CACHE_SIZE = 256
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+_menu_unit = (None, 1)  # (menu version, GCD of its prices in centavos)
+
+
+def _units(menu, budget_cents):
+    global _menu_unit
+    version, unit = _menu_unit
+    if version != menu.version:
+        unit = reduce(math.gcd, (to_cents(item["price"]) for item in menu.items), 0) or 1
+        _menu_unit = (menu.version, unit)
+    if budget_cents // unit > MAX_STATES:
+        unit = -(-budget_cents // MAX_STATES)
+    return unit
+
+def _reach(items, capacity, masks):
+    limit = (1 << (capacity + 1)) - 1
+    last = [1] + [0] * (masks - 1)
+    reach = [last]
+    for weight, max_qty, group_mask, _ in reversed(items):
+        rows = []
+        for need in range(masks):
+            bits = last[need]
+            source = last[need & ~group_mask]
+            for qty in range(1, max_qty + 1):
+                bits |= source << (qty * weight)
+            rows.append(bits & limit)
+        last = rows
+        reach.append(last)
+    reach.reverse()
+    return reach
+
+def _combos(items, reach, target, need, limit):
+    # Depth-first walk of every combo adding up to exactly `target` units;
+    # reach[] prunes each branch that can't complete, so nothing is wasted.
+    # `taken` is a linked list (previous, item, qty) so a push is O(1).
+    n = len(items)
+    found = []
+    stack = [(0, target, need, None)]
+    while stack and len(found) < limit:
+        i, left, need, taken = stack.pop()
+        if i == n:
+            combo = []
+            while taken is not None:
+                taken, item, qty = taken
+                combo.append((item, qty))
+            combo.reverse()
+            found.append(combo)
+            continue
+        weight, max_qty, group_mask, item = items[i]
+        # pushed low qty first so the largest quantity is explored first
+        for qty in range(0, max_qty + 1):
+            rest = left - qty * weight
+            if rest < 0:
+                break
+            rest_need = need & ~group_mask if qty else need
+            if (reach[i + 1][rest_need] >> rest) & 1:
+                stack.append((i + 1, rest, rest_need, (taken, item, qty) if qty else taken))
+    return found
+
+def suggest_combos(menu, budget, k=TOP_K, max_qty=MAX_QTY, rank="value", popularity=None, require=()):
+    # menu is a crud.MenuSnapshot; require is a sequence of item-id groups and
+    # every combo must contain at least one item from each group (e.g. drinks).
+    # Returns [{"items": [(menu_row, qty), ...], "total": pesos, "score": ...}]
+    if not math.isfinite(budget):
+        return []
+    budget_cents = to_cents(budget)
+    if budget_cents <= 0 or not menu.items:
+        return []
+    unit = _units(menu, budget_cents)
+    capacity = budget_cents // unit
+    groups = tuple(frozenset(group) for group in require)
+    scores = tuple(sorted((popularity or {}).items())) if rank == "popularity" else None
+    key = (menu.version, capacity, unit, k, max_qty, rank, groups, scores)
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+
+    popularity = popularity or {}
+    items = []
+    cents = {}
+    for item in menu.items:
+        cents[item["id"]] = to_cents(item["price"])
+        weight = -(-cents[item["id"]] // unit)
+        if weight > capacity or weight <= 0 or item["sold_out"]:
+            continue
+        group_mask = sum(1 << g for g, group in enumerate(groups) if item["id"] in group)
+        items.append((weight, min(max_qty, capacity // weight), group_mask, item))
+    if rank == "popularity":
+        # best sellers are tried first, so the pool leans towards them
+        items.sort(key=lambda entry: -popularity.get(entry[3]["id"], 0))
+
+    full = (1 << len(groups)) - 1
+    reach = _reach(items, capacity, 1 << len(groups))
+    wanted = k * POPULARITY_POOL if rank == "popularity" else k
+    found = []
+    target = reach[0][full].bit_length() - 1
+    while target > 0 and len(found) < wanted:
+        if (reach[0][full] >> target) & 1:
+            found.extend(_combos(items, reach, target, full, wanted - len(found)))
+        target -= 1
+
+    combos = []
+    for taken in found:
+        total = sum(cents[item["id"]] * qty for item, qty in taken)
+        if rank == "popularity":
+            score = sum(popularity.get(item["id"], 0) * qty for item, qty in taken)
+        else:
+            score = total
+        combos.append({"items": taken, "total": total / 100, "score": score})
+    if rank == "popularity":
+        combos.sort(key=lambda combo: (-combo["score"], -combo["total"]))
+    combos = combos[:k]
+
+    with _cache_lock:
+        _cache[key] = combos
+        if len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return combos